@@ -0,0 +1,368 @@
+"""Size-bounded garbage collection of a pydra cache root.
+
+Evicts the least recently used task directories (``shell-*``, ``python-*``,
+``workflow-*``) of a cache root until it fits in a byte budget, while
+
+* keeping the directories of expensive stages (FastSurfer, eddy, tckgen by default)
+  "pinned", so that they can be reused by later runs,
+* never removing a directory whose job is running (pydra holds ``<dir>.lock`` while
+  it runs or reuses a job, and the collector takes the same lock while it evicts),
+  nor one that a running job reads its inputs from (i.e. that is referenced by the
+  pickled job of a locked directory),
+* leaving directories that were used more recently than ``min_age``, so that it can run
+  alongside active workflows. Reading the outputs of a task doesn't count as a use of
+  its directory, so this is what protects the outputs of a finished task from being
+  evicted before the downstream tasks that will read them have started.
+
+Sizes, last-use times and task names are kept in an index in the cache root
+(``.gc_index.json``) and only recomputed for directories that have changed, so
+repeated collections of a large cache are cheap. The last use of a directory is the
+last access/modification of its ``_result.pklz`` (atime under relatime is updated at
+most daily, which is fine-grained enough for LRU eviction).
+
+Usage:
+
+    python -m australianimagingservice.mri.human.neuro.cache_gc <cache_root> \\
+        --max-size <size> [--pin <TaskName>]... [--no-default-pins] \\
+        [--min-age <seconds>] [--dry-run]
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+import typing as ty
+from dataclasses import dataclass, field
+from pathlib import Path
+from filelock import SoftFileLock, Timeout
+
+logger = logging.getLogger("australianimagingservice.mri.human.neuro.cache_gc")
+
+# Tasks whose cache directories are kept regardless of the budget
+DEFAULT_PINS = ("FastsurferSeg", "FastsurferSurf", "DwiFslpreproc", "TckGen")
+# Directories used more recently than this (in seconds) are never evicted by default
+DEFAULT_MIN_AGE = 3600.0
+INDEX_NAME = ".gc_index.json"
+TASK_DIR_PATTERN = re.compile(r"^(shell|python|workflow)-[0-9a-f]+$")
+# References to task directories (e.g. the paths of inputs) within a pickled job
+TASK_DIR_REFERENCE = re.compile(rb"(?:shell|python|workflow)-[0-9a-f]+")
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+@dataclass
+class CacheEntry:
+    """A task directory in the cache root"""
+
+    path: Path
+    size: int
+    last_used: float
+    task: ty.Optional[str]
+    complete: bool
+    pinned: bool = False
+
+    @property
+    def lockfile(self) -> Path:
+        return self.path.with_suffix(".lock")
+
+    @property
+    def locked(self) -> bool:
+        return self.lockfile.exists()
+
+
+@dataclass
+class GcReport:
+    """What a collection did (or would do, in a dry run)"""
+
+    total_size: int
+    evicted: list[CacheEntry] = field(default_factory=list)
+    skipped_in_use: int = 0
+
+    @property
+    def freed(self) -> int:
+        return sum(e.size for e in self.evicted)
+
+
+def parse_size(size: ty.Union[str, int]) -> int:
+    """Parse a size in bytes with an optional K/M/G/T suffix, e.g. "200G" """
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)I?B?\s*", size.upper())
+    if not match:
+        raise ValueError(f"Could not parse size '{size}'")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def _tree_size(path: Path) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def _task_names(path: Path, names: ty.Iterable[str]) -> list[str]:
+    """Which of ``names`` are referenced by the pickled job of a task directory (the
+    class of a task is pickled by name, so the job doesn't need to be unpickled)"""
+    try:
+        data = (path / "_job.pklz").read_bytes()
+    except OSError:
+        return []
+    return [
+        n
+        for n in names
+        if re.search(rb"(?<!\w)" + re.escape(n.encode()) + rb"(?!\w)", data)
+    ]
+
+
+def _referenced_dirs(path: Path) -> set[str]:
+    """Names of the other task directories referenced by the pickled job of a task
+    directory, e.g. those its inputs were produced in"""
+    try:
+        data = (path / "_job.pklz").read_bytes()
+    except OSError:
+        return set()
+    return {m.decode() for m in TASK_DIR_REFERENCE.findall(data)} - {path.name}
+
+
+def _last_used(path: Path) -> float:
+    for name in ("_result.pklz", "_job.pklz"):
+        try:
+            stat = (path / name).stat()
+        except OSError:
+            continue
+        return max(stat.st_atime, stat.st_mtime)
+    return path.stat().st_mtime
+
+
+def _load_index(cache_root: Path) -> dict[str, dict[str, ty.Any]]:
+    try:
+        with open(cache_root / INDEX_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_index(cache_root: Path, index: dict[str, dict[str, ty.Any]]) -> None:
+    tmp_path = cache_root / f"{INDEX_NAME}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, cache_root / INDEX_NAME)
+    except OSError as e:
+        logger.warning("Could not save cache index: %s", e)
+
+
+def task_dirs(cache_root: ty.Union[str, Path]) -> list[Path]:
+    """The task directories of a cache root (none if it doesn't exist yet)"""
+    cache_root = Path(cache_root)
+    if not cache_root.is_dir():
+        return []
+    return [
+        p for p in cache_root.iterdir() if TASK_DIR_PATTERN.match(p.name) and p.is_dir()
+    ]
+
+
+def scan_cache(
+    cache_root: ty.Union[str, Path], pins: ty.Sequence[str] = DEFAULT_PINS
+) -> list[CacheEntry]:
+    """List the task directories of a cache root, with their sizes, last-use times and
+    whether they are pinned, updating the index for directories that have changed"""
+    cache_root = Path(cache_root)
+    index = _load_index(cache_root)
+    updated: dict[str, dict[str, ty.Any]] = {}
+    entries = []
+    for path in task_dirs(cache_root):
+        try:
+            stat = path.stat()
+            complete = (path / "_result.pklz").exists()
+            cached = index.get(path.name)
+            key = {
+                "mtime_ns": stat.st_mtime_ns,
+                "complete": complete,
+                "pins": sorted(pins),
+            }
+            if cached is None or any(cached.get(k) != v for k, v in key.items()):
+                matched = _task_names(path, pins)
+                cached = {
+                    **key,
+                    "size": _tree_size(path),
+                    "task": matched[0] if matched else None,
+                }
+            entry = CacheEntry(
+                path=path,
+                size=cached["size"],
+                last_used=_last_used(path),
+                task=cached["task"],
+                complete=complete,
+                pinned=cached["task"] is not None,
+            )
+        except OSError:
+            continue  # removed while scanning
+        updated[path.name] = cached
+        entries.append(entry)
+    if updated != index:
+        _save_index(cache_root, updated)
+    return entries
+
+
+def _evict(entry: CacheEntry, min_age: float) -> bool:
+    """Remove a task directory unless its job is running, holding the job's lock so
+    that pydra can't start it meanwhile, and moving it out of the way first so that it
+    is never seen half-removed"""
+    lock = SoftFileLock(entry.lockfile)
+    try:
+        lock.acquire(timeout=0)
+    except Timeout:
+        return False
+    try:
+        if time.time() - _last_used(entry.path) < min_age:
+            return False  # used since it was scanned
+        trash = entry.path.with_name(f".gc-{entry.path.name}-{os.getpid()}")
+        os.rename(entry.path, trash)
+    except OSError:
+        return False
+    finally:
+        lock.release()
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
+
+
+def collect_garbage(
+    cache_root: ty.Union[str, Path],
+    max_size: ty.Union[str, int],
+    pins: ty.Sequence[str] = DEFAULT_PINS,
+    min_age: float = DEFAULT_MIN_AGE,
+    protect: ty.Iterable[ty.Union[str, Path]] = (),
+    owned: ty.Iterable[ty.Union[str, Path]] = (),
+    dry_run: bool = False,
+) -> GcReport:
+    """Evict the least recently used task directories of a cache root until the
+    unpinned and pinned directories together fit in ``max_size``
+
+    Parameters
+    ----------
+    cache_root : str or Path
+        the pydra cache root
+    max_size : str or int
+        the byte budget of the cache, e.g. "200G" (pinned directories count towards it
+        but are never evicted)
+    pins : Sequence[str]
+        names of the tasks whose directories are never evicted
+    min_age : float
+        directories used more recently than this (in seconds) are not evicted, unless
+        they are ``owned``
+    protect : Iterable[str or Path]
+        paths (e.g. final outputs) whose task directories must be kept
+    owned : Iterable[str or Path]
+        task directories created by the caller's own run, which has finished, so
+        they are evicted however recently they were used (``min_age`` still applies
+        to the directories of other runs sharing the cache root)
+    dry_run : bool
+        only report what would be evicted
+
+    Returns
+    -------
+    report : GcReport
+        the size of the cache before the collection and the evicted entries
+    """
+    budget = parse_size(max_size)
+    protected = [Path(p).absolute() for p in protect]
+    own = {Path(p).name for p in owned}
+    entries = scan_cache(cache_root, pins)
+    report = GcReport(total_size=sum(e.size for e in entries))
+    size = report.total_size
+    now = time.time()
+
+    # The inputs of running jobs are in use, however long ago they were produced
+    in_use: set[str] = set()
+    for entry in entries:
+        if entry.locked:
+            in_use.update(_referenced_dirs(entry.path))
+
+    def protects(entry: CacheEntry) -> bool:
+        return any(p.is_relative_to(entry.path.absolute()) for p in protected)
+
+    candidates = sorted(
+        (e for e in entries if not e.pinned and not protects(e)),
+        key=lambda e: e.last_used,
+    )
+    for entry in candidates:
+        if size <= budget:
+            break
+        age = 0.0 if entry.path.name in own else min_age
+        if now - entry.last_used < age or entry.locked or entry.path.name in in_use:
+            report.skipped_in_use += 1
+            continue
+        if dry_run or _evict(entry, age):
+            report.evicted.append(entry)
+            size -= entry.size
+        else:
+            report.skipped_in_use += 1
+    logger.info(
+        "%s %d task directories (%.1f GB) of '%s', %.1f GB left",
+        "Would evict" if dry_run else "Evicted",
+        len(report.evicted),
+        report.freed / 1024**3,
+        cache_root,
+        size / 1024**3,
+    )
+    return report
+
+
+def main(argv: ty.Optional[ty.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Evict least recently used task directories from a pydra cache"
+    )
+    parser.add_argument("cache_root", type=Path)
+    parser.add_argument(
+        "--max-size", required=True, help="byte budget of the cache, e.g. 200G"
+    )
+    parser.add_argument(
+        "--pin",
+        action="append",
+        default=[],
+        help="name of a task whose directories are never evicted (repeatable)",
+    )
+    parser.add_argument(
+        "--no-default-pins",
+        action="store_true",
+        help=f"don't pin {', '.join(DEFAULT_PINS)}",
+    )
+    parser.add_argument(
+        "--min-age",
+        type=float,
+        default=DEFAULT_MIN_AGE,
+        help=(
+            "never evict directories used in the last <seconds>. Only the inputs of "
+            "jobs that are running are known to be in use, so this should exceed the "
+            "time between a task finishing and the tasks that read its outputs "
+            "starting"
+        ),
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    pins = list(args.pin) + ([] if args.no_default_pins else list(DEFAULT_PINS))
+    report = collect_garbage(
+        args.cache_root,
+        args.max_size,
+        pins=pins,
+        min_age=args.min_age,
+        dry_run=args.dry_run,
+    )
+    for entry in report.evicted:
+        print(f"{entry.size / 1024**2:10.1f} MB  {entry.path.name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
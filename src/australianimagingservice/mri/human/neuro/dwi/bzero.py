@@ -0,0 +1,114 @@
+"""Native mean b=0 image of a DWI series, replacing the dwiextract -bzero → mrcalc -max 0
+→ mrmath mean chain (and its two full-size intermediate images). The b=0 volumes are
+accumulated one slab at a time straight from the input, so memory use stays bounded
+by a slab (a volume, or a slice of all volumes) whatever the size of the series."""
+
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from fileformats.generic import File
+from pydra.compose import python
+from australianimagingservice.mri.human.neuro.image_header import (
+    bzero_volumes,
+    read_image_header,
+)
+from australianimagingservice.mri.human.neuro.mif import (
+    iter_mif_slabs,
+    read_mif_header,
+    save_mif,
+    storage_affine,
+    storage_axes,
+)
+
+
+def _sum_mif(
+    path: Path, volumes: list[int], clamp: bool
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sum of the (clamped) b=0 volumes of a MIF, with the spatial axes in storage
+    order, and the affine of that order"""
+    header = read_mif_header(path)
+    axes = storage_axes(header)
+    if len(axes) != 4:
+        raise ValueError(f"{path} is not a 4D image")
+    dims = [int(d) for d in header["dim"].split(",")]
+    spatial = [a for a in axes if a < 3]
+    total = np.zeros([dims[a] for a in spatial], dtype=np.float32)
+    slowest = axes[-1]
+    if slowest == 3:
+        # Volume-contiguous: each slab is a volume and only the b=0 ones are read
+        for _, volume in iter_mif_slabs(path, only=set(volumes)):
+            volume = volume.astype(np.float32)
+            if clamp:
+                np.maximum(volume, 0, out=volume)
+            total += volume
+    else:
+        # Each slab is a slice of all the volumes
+        slab_axes = axes[:-1]
+        index: list[ty.Any] = [slice(None)] * 3
+        for i, slab in iter_mif_slabs(path):
+            selected = np.take(slab, volumes, axis=slab_axes.index(3)).astype(
+                np.float32
+            )
+            if clamp:
+                np.maximum(selected, 0, out=selected)
+            index[spatial.index(slowest)] = i
+            total[tuple(index)] = selected.sum(axis=slab_axes.index(3))
+    return total, storage_affine(header)
+
+
+def _sum_nifti(
+    path: Path, volumes: list[int], clamp: bool
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sum of the (clamped) b=0 volumes of a NIfTI, read one volume at a time"""
+    img = nib.load(str(path))
+    total = np.zeros(img.shape[:3], dtype=np.float32)
+    for i in volumes:
+        volume = np.array(img.dataobj[..., i], dtype=np.float32)
+        if clamp:
+            np.maximum(volume, 0, out=volume)
+        total += volume
+    return total, img.affine
+
+
+def mean_bzero(
+    in_file: ty.Union[str, Path], out_file: ty.Union[str, Path], clamp: bool = True
+) -> Path:
+    """Write the mean of the b=0 volumes of a DWI series (.mif/.mif.gz with an embedded
+    gradient table, or .nii/.nii.gz with .bval/.bvec sidecars) as a 3D float32 image
+
+    Parameters
+    ----------
+    in_file : str or Path
+        the DWI series
+    out_file : str or Path
+        the mean b=0 image to write (.nii/.nii.gz or .mif/.mif.gz)
+    clamp : bool
+        set negative intensities to zero before averaging (as ``mrcalc -max 0``)
+    """
+    in_file, out_file = Path(in_file), Path(out_file)
+    dw_scheme = read_image_header(in_file).dw_scheme
+    if dw_scheme is None:
+        raise ValueError(f"No diffusion gradient table found for {in_file}")
+    volumes = bzero_volumes(dw_scheme)
+    if not volumes:
+        raise ValueError(f"No b=0 volumes found in {in_file}")
+    if in_file.name.endswith((".mif", ".mif.gz")):
+        total, affine = _sum_mif(in_file, volumes, clamp)
+    else:
+        total, affine = _sum_nifti(in_file, volumes, clamp)
+    mean = total / np.float32(len(volumes))
+    if out_file.name.endswith((".mif", ".mif.gz")):
+        save_mif(out_file, mean, affine)
+    else:
+        nib.save(nib.Nifti1Image(mean, affine), str(out_file))
+    return out_file
+
+
+@python.define
+def MeanBzero(
+    in_file: File, out_file: str = "meanb0.nii.gz", clamp: bool = True
+) -> File:
+    """Mean of the b=0 volumes of a DWI series, with negative intensities clamped to
+    zero unless ``clamp`` is False (see ``mean_bzero``)"""
+    return File(mean_bzero(in_file, Path(out_file).absolute(), clamp=clamp))
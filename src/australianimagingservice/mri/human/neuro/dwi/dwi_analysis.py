@@ -12,8 +12,6 @@ from pydra.tasks.mrtrix3.v3_1 import (
     MrTransform,
     MrConvert,
     MrGrid,
-    DwiExtract,
-    MrMath,
     Dwi2Response_Dhollander,
     Dwi2Fod,
     MtNormalise,
@@ -29,6 +27,8 @@ from fileformats.vendor.mrtrix3.medimage import (
     ImageIn,
     ImageOut,
 )  # noqa: F401
+from australianimagingservice.mri.human.neuro.dwi.bzero import MeanBzero
+from australianimagingservice.mri.human.neuro.image_header import image_summary
 from australianimagingservice.mri.human.neuro.dwi.dwi_preprocessing import get_eddy_nthr
 
 # Define the path and output_path variables
@@ -318,14 +318,14 @@ def WriteExecutionLog(
         "  2.  MrConvert — reimport DWI with corrected gradients",
         "  3.  DwiDenoise — MP-PCA denoising",
         "  4.  MrDegibbs — Gibbs ringing removal",
-        "  5.  DwiExtract / MrcalcMax / MrMath / MriSynthstrip — early mean b0 brain mask (eddy_mask)",
+        "  5.  MeanBzero / MriSynthstrip — early mean b0 brain mask (eddy_mask)",
         "  6.  DwiFslpreproc — motion and distortion correction (eddy/topup)",
         f"       Options: {dwifslpreproc_options}",
-        "  7.  DwiExtract / MrcalcMax / MrMath / MriSynthstrip — corrected mean b0 brain mask",
+        "  7.  MeanBzero / MriSynthstrip — corrected mean b0 brain mask",
         "  8.  DwiBiascorrect_Ants — ANTs bias field correction",
         "  9.  MrGrid (crop) — crop to brain mask at native DWI resolution (DWI and mask)",
         " 10.  JoinTask / MrConvert — FreeSurfer path construction and .mgz → NIfTI",
-        " 11.  DwiExtract / MrcalcMax / MrMath — mean b0 for registration",
+        " 11.  MeanBzero — mean b0 for registration",
         " 12.  EpiReg — DWI-to-T1 registration",
         " 13.  TransformConvert — convert FLIRT transform to MRtrix3 format",
         " 14.  MrTransform — apply transform + reslice to T1 grid (DWI and mask)",
@@ -366,21 +366,15 @@ def WriteExecutionLog(
 
 def detect_shell_structure(dwi_path: str) -> str:
     """Return 'ss3t' for single-shell data (b=0 + one non-zero shell) or
-    'msmt_csd' for multi-shell data, by inspecting the DWI header with mrinfo.
+    'msmt_csd' for multi-shell data, from the shells of the DWI header.
 
     Call this before constructing DwiPipeline and pass the result as
     fod_algorithm.
     """
-    import subprocess
-
-    result = subprocess.run(
-        ["mrinfo", str(dwi_path), "-shell_bvalues"],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    bvalues = result.stdout.strip().split()
-    non_zero_shells = [b for b in bvalues if float(b) > 50]
+    bvalues = image_summary(dwi_path).shell_bvalues
+    if bvalues is None:
+        raise ValueError(f"No shelled diffusion gradient table found for {dwi_path}")
+    non_zero_shells = [b for b in bvalues if b > 50]
     return "ss3t" if len(non_zero_shells) == 1 else "msmt_csd"
 
 
@@ -435,7 +429,6 @@ def resolve_inputs(subject_dir: str) -> dict:
     (dwicat, dwiextract, mrmath, mrcat) run inside the workflow with full caching.
     """
     import re
-    import subprocess
 
     root = Path(subject_dir)
     if not root.is_dir():
@@ -476,26 +469,14 @@ def resolve_inputs(subject_dir: str) -> dict:
 
     def _has_nonzero_bvals(path):
         try:
-            r = subprocess.run(
-                ["mrinfo", str(path), "-shell_bvalues"],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            return any(float(s) > 50 for s in r.stdout.strip().split())
+            bvalues = image_summary(path).shell_bvalues
+            return bvalues is None or any(b > 50 for b in bvalues)
         except Exception:
-            return True  # assume non-zero if mrinfo unavailable
+            return True  # assume non-zero if the gradient table can't be read
 
     def _get_nvols(path):
         try:
-            r = subprocess.run(
-                ["mrinfo", str(path), "-size"],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            parts = r.stdout.strip().split()
-            return int(parts[3]) if len(parts) >= 4 else 1
+            return image_summary(path).nvols
         except Exception:
             return None
 
@@ -649,16 +630,14 @@ def detect_dwi_pe_and_mode(dwi_path: str) -> tuple[str, str]:
     Detection order:
       1. Filename patterns (_AP_, _PA_, _LR_, _RL_, _SI_, _IS_)
       2. JSON sidecar PhaseEncodingDirection (for NIfTI inputs)
-      3. mrinfo -petable on MIF header
+      3. Phase-encoding table of the MIF header
 
     Returns (pe_dir, rpe_mode) where rpe_mode is one of
     'rpe_none', 'rpe_pair', 'rpe_all', 'rpe_split'.
     For a single-file input the mode is always 'rpe_none'; call
     plan_workflow() from dwi_processing.py for multi-series DICOM inputs.
     """
-    import json
     import re
-    import subprocess
 
     name = Path(dwi_path).name
 
@@ -680,9 +659,12 @@ def detect_dwi_pe_and_mode(dwi_path: str) -> tuple[str, str]:
         if re.search(pat, name, re.IGNORECASE):
             return pe, "rpe_none"
 
-    # JSON sidecar (NIfTI inputs)
-    base = re.sub(r"\.nii(\.gz)?$", "", dwi_path)
-    json_path = base + ".json"
+    try:
+        summary = image_summary(dwi_path)
+    except Exception:
+        summary = None
+
+    # JSON sidecar PhaseEncodingDirection (NIfTI inputs)
     _json_map = {
         "j-": "AP",
         "j": "PA",
@@ -691,50 +673,29 @@ def detect_dwi_pe_and_mode(dwi_path: str) -> tuple[str, str]:
         "k": "SI",
         "k-": "IS",
     }
-    if Path(json_path).exists():
-        try:
-            with open(json_path) as f:
-                ped = json.load(f).get("PhaseEncodingDirection", "").strip()
-            if ped in _json_map:
-                return _json_map[ped], "rpe_none"
-        except Exception:
-            pass
+    if summary is not None and summary.sidecar_pe_direction in _json_map:
+        return _json_map[summary.sidecar_pe_direction], "rpe_none"
 
     # MIF header petable
-    try:
-        result = subprocess.run(
-            ["mrinfo", dwi_path, "-petable"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        raw = result.stdout.strip()
-        if raw:
-            _vec_map = {
-                (0, -1, 0): "AP",
-                (0, 1, 0): "PA",
-                (1, 0, 0): "LR",
-                (-1, 0, 0): "RL",
-                (0, 0, 1): "SI",
-                (0, 0, -1): "IS",
-            }
-            dirs = []
-            for line in raw.splitlines():
-                parts = line.split()
-                if len(parts) >= 3:
-                    vec = tuple(round(float(v)) for v in parts[:3])
-                    if vec in _vec_map:
-                        dirs.append(_vec_map[vec])
-            if dirs:
-                unique = set(dirs)
-                if len(unique) == 1:
-                    return dirs[0], "rpe_none"
-                # Multiple PE directions embedded in header → rpe_header
-                counts = {d: dirs.count(d) for d in unique}
-                dominant = max(counts, key=lambda d: counts[d])
-                return dominant, "rpe_header"
-    except Exception:
-        pass
+    if summary is not None and summary.pe_counts is not None:
+        _vec_map = {
+            (0, -1, 0): "AP",
+            (0, 1, 0): "PA",
+            (1, 0, 0): "LR",
+            (-1, 0, 0): "RL",
+            (0, 0, 1): "SI",
+            (0, 0, -1): "IS",
+        }
+        counts = {}
+        for vec, n in summary.pe_counts:
+            if vec in _vec_map:
+                counts[_vec_map[vec]] = counts.get(_vec_map[vec], 0) + n
+        if len(counts) == 1:
+            return next(iter(counts)), "rpe_none"
+        if counts:
+            # Multiple PE directions embedded in header → rpe_header
+            dominant = max(counts, key=lambda d: counts[d])
+            return dominant, "rpe_header"
 
     print(
         f"  WARNING: could not determine PE direction for {name}. "
@@ -797,46 +758,28 @@ def DwiPipeline(
 
     elif rpe_mode == "rpe_pair":
         # Extract mean b0 from FWD DWI
-        fwd_b0_extract = workflow.add(
-            DwiExtract(
-                in_file=dwi_raw_mif,
-                out_file="fwd_bzero.mif.gz",
-                bzero=True,
-            ),
-            name="DwiExtract_fwd_b0",
-        )
         fwd_meanb0 = workflow.add(
-            MrMath(
-                in_file=fwd_b0_extract.out_file,
+            MeanBzero(
+                in_file=dwi_raw_mif,
                 out_file="fwd_meanb0.mif.gz",
-                operation="mean",
-                axis=3,
+                clamp=False,
             ),
-            name="MrMath_fwd_meanb0",
+            name="MeanBzero_fwd",
         )
         # Extract mean b0 from RPE series
-        rpe_b0_extract = workflow.add(
-            DwiExtract(
-                in_file=rpe_file,
-                out_file="rpe_bzero.mif.gz",
-                bzero=True,
-            ),
-            name="DwiExtract_rpe_b0",
-        )
         rpe_meanb0 = workflow.add(
-            MrMath(
-                in_file=rpe_b0_extract.out_file,
+            MeanBzero(
+                in_file=rpe_file,
                 out_file="rpe_meanb0.mif.gz",
-                operation="mean",
-                axis=3,
+                clamp=False,
             ),
-            name="MrMath_rpe_meanb0",
+            name="MeanBzero_rpe",
         )
         # Concatenate: FWD b0 first, RPE b0 second (equal 1+1 pair)
         se_epi_task = workflow.add(
             MrCat(
-                in_file1=fwd_meanb0.out_file,
-                in_file2=rpe_meanb0.out_file,
+                in_file1=fwd_meanb0.out,
+                in_file2=rpe_meanb0.out,
                 out_file="se_epi_pair.mif.gz",
                 axis=3,
             ),
@@ -888,37 +831,17 @@ def DwiPipeline(
     )
 
     # ── Early b0 brain mask — used as eddy_mask in DwiFslpreproc ─────────────
-    early_b0_task = workflow.add(
-        DwiExtract(
-            in_file=dwi_degibbs_task.out,
-            out_file="early_bzero.mif.gz",
-            bzero=True,
-        ),
-        name="DwiExtract_early",
-    )
-
-    early_b0_nonneg = workflow.add(
-        MrcalcMax(
-            in_file=early_b0_task.out_file,
-            number=0.0,
-            operand="max",
-        ),
-        name="MrcalcMax_early_b0",
-    )
-
     early_meanb0_task = workflow.add(
-        MrMath(
-            in_file=early_b0_nonneg.output_image,
+        MeanBzero(
+            in_file=dwi_degibbs_task.out,
             out_file="early_meanb0.nii.gz",
-            operation="mean",
-            axis=3,
         ),
-        name="MrMath_early_meanb0",
+        name="MeanBzero_early",
     )
 
     synthstrip_task = workflow.add(
         MriSynthstrip(
-            in_file=early_meanb0_task.out_file,
+            in_file=early_meanb0_task.out,
         ),
         name="MriSynthstrip_early",
     )
@@ -971,37 +894,17 @@ def DwiPipeline(
     dwifslpreproc_task = workflow.add(DwiFslpreproc(**_fslpreproc_kw))
 
     # ── Corrected brain mask from DwiFslpreproc output ────────────────────────
-    preproc_b0_task = workflow.add(
-        DwiExtract(
-            in_file=dwifslpreproc_task.out_file,
-            out_file="preproc_bzero.mif.gz",
-            bzero=True,
-        ),
-        name="DwiExtract_preproc",
-    )
-
-    preproc_b0_nonneg = workflow.add(
-        MrcalcMax(
-            in_file=preproc_b0_task.out_file,
-            number=0.0,
-            operand="max",
-        ),
-        name="MrcalcMax_preproc_b0",
-    )
-
     preproc_meanb0_task = workflow.add(
-        MrMath(
-            in_file=preproc_b0_nonneg.output_image,
+        MeanBzero(
+            in_file=dwifslpreproc_task.out_file,
             out_file="preproc_meanb0.nii.gz",
-            operation="mean",
-            axis=3,
         ),
-        name="MrMath_preproc_meanb0",
+        name="MeanBzero_preproc",
     )
 
     corrected_synthstrip_task = workflow.add(
         MriSynthstrip(
-            in_file=preproc_meanb0_task.out_file,
+            in_file=preproc_meanb0_task.out,
         ),
         name="MriSynthstrip_corrected",
     )
@@ -1078,33 +981,12 @@ def DwiPipeline(
 
     # extract meanb0 volumes #
 
-    extract_bzeroes_task = workflow.add(
-        DwiExtract(
-            in_file=crop_task_dwi.out_file,
-            out_file="bzero.mif.gz",
-            bzero=True,
-        )
-    )
-
-    # remove negative values from bzero volumes
-    mrcalc_max = workflow.add(
-        MrcalcMax(
-            in_file=extract_bzeroes_task.out_file,
-            output_image="b0_nonneg.mif.gz",
-            number=0.0,
-            operand="max",
-        ),
-        name="MrcalcMax_b0",
-    )
-
-    # # create meanb0 image
     meanb0_task = workflow.add(
-        MrMath(
-            in_file=mrcalc_max.output_image,
+        MeanBzero(
+            in_file=crop_task_dwi.out_file,
             out_file="dwi_meanbzero.nii.gz",
-            operation="mean",
-            axis=3,
-        )
+        ),
+        name="MeanBzero",
     )
 
     # make wm mask a binary image
@@ -1120,7 +1002,7 @@ def DwiPipeline(
     # Step 9: Perform DWI->T1 registration
     epi_reg_task = workflow.add(
         EpiReg(
-            epi=meanb0_task.out_file,
+            epi=meanb0_task.out,
             t1_head=nifti_normimg.out_file,
             t1_brain=nifti_t1brain.out_file,
             wmseg=mrcalc_wmbin.output_image,
@@ -1132,7 +1014,7 @@ def DwiPipeline(
     transformconvert_task = workflow.add(
         TransformConvert(
             input_matrix=epi_reg_task.epi2str_mat,
-            flirt_in=meanb0_task.out_file,
+            flirt_in=meanb0_task.out,
             flirt_ref=nifti_t1brain.out_file,
             operation="flirt_import",
             out_file="epi2struct_mrtrix.txt",
@@ -1340,10 +1222,20 @@ def DwiPipeline(
 
 if __name__ == "__main__":
     import datetime
+    import os
+    from australianimagingservice.mri.human.neuro.image_header import (
+        HEADER_INDEX_ENV,
+        HEADER_INDEX_NAME,
+        enable_header_index,
+    )
 
     subject_dir = "/Users/adso8337/Desktop/5TTmsmt_testing/data/BATMAN/"
     output_path = "/Users/adso8337/Desktop/5TTmsmt_testing/outputs/BATMAN_HSVS/"
 
+    # Reuse the header summaries of the raw DWI series from previous runs
+    if not os.environ.get(HEADER_INDEX_ENV):
+        enable_header_index(Path(output_path) / HEADER_INDEX_NAME)
+
     inputs = resolve_inputs(subject_dir)
     dwi_path = inputs["dwi_raw_mif"]
 
@@ -10,11 +10,19 @@ from pydra.tasks.mrtrix3.v3_1 import (
     DwiBiascorrect_Ants,
     MrConvert,
     MrGrid,
-    DwiExtract,
-    MrMath,
     Dwi2Response_Dhollander,
 )
 from pydra.tasks.fastsurfer.mri_synthstrip import MriSynthstrip
+from australianimagingservice.mri.human.neuro.dwi.bzero import MeanBzero
+from australianimagingservice.mri.human.neuro.dwi.intermediates import (
+    DEFAULT_INTERMEDIATE_FORMAT,
+    final_image,
+    intermediate_name,
+)
+from australianimagingservice.mri.human.neuro.image_header import image_summary
+from australianimagingservice.mri.human.neuro.t1w.preprocess.mri_synthstrip import (
+    MriSynthstripBatch,
+)
 from fileformats.vendor.mrtrix3.medimage import (  # noqa: F401
     ImageIn,
     ImageOut,
@@ -274,10 +282,10 @@ def WritePreprocessingLog(
         "  2.  MrConvert — reimport DWI with corrected gradients",
         "  3.  DwiDenoise — MP-PCA denoising",
         "  4.  MrDegibbs — Gibbs ringing removal",
-        "  5.  DwiExtract / MrcalcMax / MrMath / MriSynthstrip — early mean b0 brain mask (eddy_mask)",
+        "  5.  MeanBzero / MriSynthstrip — early mean b0 brain mask (eddy_mask)",
         "  6.  DwiFslpreproc — motion and distortion correction (eddy/topup)",
         f"       Options: {dwifslpreproc_options}",
-        "  7.  DwiExtract / MrcalcMax / MrMath / MriSynthstrip — corrected mean b0 brain mask",
+        "  7.  MeanBzero / MriSynthstrip — corrected mean b0 brain mask",
         "  8.  DwiBiascorrect_Ants — ANTs bias field correction",
         "  9.  MrGrid (crop) — crop DWI and mask to brain extent (native DWI resolution)",
         "  10. Dwi2Response_Dhollander — tissue response function estimation (native DWI space)",
@@ -307,17 +315,11 @@ def WritePreprocessingLog(
 
 def detect_shell_structure(dwi_path: str) -> str:
     """Return 'ss3t' for single-shell data (b=0 + one non-zero shell) or
-    'msmt_csd' for multi-shell data, by inspecting the DWI header with mrinfo."""
-    import subprocess
-
-    result = subprocess.run(
-        ["mrinfo", str(dwi_path), "-shell_bvalues"],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    bvalues = result.stdout.strip().split()
-    non_zero_shells = [b for b in bvalues if float(b) > 50]
+    'msmt_csd' for multi-shell data, from the shells of the DWI header."""
+    bvalues = image_summary(dwi_path).shell_bvalues
+    if bvalues is None:
+        raise ValueError(f"No shelled diffusion gradient table found for {dwi_path}")
+    non_zero_shells = [b for b in bvalues if b > 50]
     return "ss3t" if len(non_zero_shells) == 1 else "msmt_csd"
 
 
@@ -328,14 +330,12 @@ def detect_dwi_pe_and_mode(dwi_path: str) -> tuple[str, str]:
     Detection order:
       1. Filename patterns (_AP_, _PA_, _LR_, _RL_, _SI_, _IS_)
       2. JSON sidecar PhaseEncodingDirection (for NIfTI inputs)
-      3. mrinfo -petable on MIF header
+      3. Phase-encoding table of the MIF header
 
     Returns (pe_dir, rpe_mode) where rpe_mode is one of
     'rpe_none', 'rpe_pair', 'rpe_all', 'rpe_header'.
     """
-    import json
     import re
-    import subprocess
 
     name = Path(dwi_path).name
 
@@ -357,8 +357,12 @@ def detect_dwi_pe_and_mode(dwi_path: str) -> tuple[str, str]:
         if re.search(pat, name, re.IGNORECASE):
             return pe, "rpe_none"
 
-    base = re.sub(r"\.nii(\.gz)?$", "", dwi_path)
-    json_path = base + ".json"
+    try:
+        summary = image_summary(dwi_path)
+    except Exception:
+        summary = None
+
+    # JSON sidecar PhaseEncodingDirection (NIfTI inputs)
     _json_map = {
         "j-": "AP",
         "j": "PA",
@@ -367,48 +371,29 @@ def detect_dwi_pe_and_mode(dwi_path: str) -> tuple[str, str]:
         "k": "SI",
         "k-": "IS",
     }
-    if Path(json_path).exists():
-        try:
-            with open(json_path) as f:
-                ped = json.load(f).get("PhaseEncodingDirection", "").strip()
-            if ped in _json_map:
-                return _json_map[ped], "rpe_none"
-        except Exception:
-            pass
-
-    try:
-        result = subprocess.run(
-            ["mrinfo", dwi_path, "-petable"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        raw = result.stdout.strip()
-        if raw:
-            _vec_map = {
-                (0, -1, 0): "AP",
-                (0, 1, 0): "PA",
-                (1, 0, 0): "LR",
-                (-1, 0, 0): "RL",
-                (0, 0, 1): "SI",
-                (0, 0, -1): "IS",
-            }
-            dirs = []
-            for line in raw.splitlines():
-                parts = line.split()
-                if len(parts) >= 3:
-                    vec = tuple(round(float(v)) for v in parts[:3])
-                    if vec in _vec_map:
-                        dirs.append(_vec_map[vec])
-            if dirs:
-                unique = set(dirs)
-                if len(unique) == 1:
-                    return dirs[0], "rpe_none"
-                counts = {d: dirs.count(d) for d in unique}
-                dominant = max(counts, key=lambda d: counts[d])
-                return dominant, "rpe_header"
-    except Exception:
-        pass
+    if summary is not None and summary.sidecar_pe_direction in _json_map:
+        return _json_map[summary.sidecar_pe_direction], "rpe_none"
+
+    # MIF header petable
+    if summary is not None and summary.pe_counts is not None:
+        _vec_map = {
+            (0, -1, 0): "AP",
+            (0, 1, 0): "PA",
+            (1, 0, 0): "LR",
+            (-1, 0, 0): "RL",
+            (0, 0, 1): "SI",
+            (0, 0, -1): "IS",
+        }
+        counts = {}
+        for vec, n in summary.pe_counts:
+            if vec in _vec_map:
+                counts[_vec_map[vec]] = counts.get(_vec_map[vec], 0) + n
+        if len(counts) == 1:
+            return next(iter(counts)), "rpe_none"
+        if counts:
+            # Multiple PE directions embedded in header → rpe_header
+            dominant = max(counts, key=lambda d: counts[d])
+            return dominant, "rpe_header"
 
     print(
         f"  WARNING: could not determine PE direction for {name}. "
@@ -443,7 +428,6 @@ def resolve_dwi_inputs(subject_dir: str) -> dict:
       5. Else fallback to any single PE-tagged file  →  rpe_none
     """
     import re
-    import subprocess
 
     root = Path(subject_dir)
     if not root.is_dir():
@@ -473,26 +457,14 @@ def resolve_dwi_inputs(subject_dir: str) -> dict:
 
     def _has_nonzero_bvals(path):
         try:
-            r = subprocess.run(
-                ["mrinfo", str(path), "-shell_bvalues"],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            return any(float(s) > 50 for s in r.stdout.strip().split())
+            bvalues = image_summary(path).shell_bvalues
+            return bvalues is None or any(b > 50 for b in bvalues)
         except Exception:
-            return True
+            return True  # assume non-zero if the gradient table can't be read
 
     def _get_nvols(path):
         try:
-            r = subprocess.run(
-                ["mrinfo", str(path), "-size"],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            parts = r.stdout.strip().split()
-            return int(parts[3]) if len(parts) >= 4 else 1
+            return image_summary(path).nvols
         except Exception:
             return None
 
@@ -623,30 +595,41 @@ def get_eddy_nthr() -> int:
     return max(1, (os.cpu_count() or 1) - 1)
 
 
-# ── Main workflow ──────────────────────────────────────────────────────────────
+# ── Workflow stages ────────────────────────────────────────────────────────────
+#
+# The pipeline is split at the two SynthStrip brain masks, so that the stages can be
+# chained per subject (DwiPreprocessing) or the masks of a whole cohort computed in a
+# single SynthStrip process between them (DwiCohortPreprocessing).
 
 
-@workflow.define(
-    outputs=[
-        "dwi_preprocessed",
-        "dwimask_preprocessed",
-        "response_wm",
-        "response_gm",
-        "response_csf",
-        "execution_log",
-    ]
-)
-def DwiPreprocessing(
+def dwifslpreproc_label(
+    pe_dir: str, rpe_mode: str, readout_time: float | None, eddy_options: str
+) -> str:
+    """Summary of the DwiFslpreproc options for the execution log."""
+    _se_epi_label = "yes" if rpe_mode in ("rpe_pair", "rpe_split") else "no"
+    _pe_label = "from header" if rpe_mode == "rpe_header" else pe_dir
+    _rt_label = (
+        "from header"
+        if rpe_mode == "rpe_header"
+        else (str(readout_time) if readout_time is not None else "from header")
+    )
+    return (
+        f"mode: -{rpe_mode}  pe_dir: {_pe_label}  "
+        f"readout_time: {_rt_label}  "
+        f'eddy_options: "{eddy_options}"  '
+        f"se_epi: {_se_epi_label}"
+    )
+
+
+@workflow.define(outputs=["dwi_degibbs", "se_epi", "early_meanb0", "grad_warning"])
+def DwiPrepareStage(
     dwi_raw_mif: File,
-    pe_dir: str = "AP",
     rpe_mode: str = "rpe_none",
     rpe_file: str | None = None,
-    readout_time: float | None = None,
-    eddy_options: str = f"' --slm=linear --nthr={get_eddy_nthr()}'",
-    fod_algorithm: str = "msmt_csd",
-    start_time: str = "",
-    cache_root: str = "",
-) -> tuple[File, File, File, File, File, str]:
+    intermediate_format: str = DEFAULT_INTERMEDIATE_FORMAT,
+) -> tuple[File, File | None, File, str]:
+    """AP/PA preparation and steps 1–5 up to the early mean b0 (the input of the
+    eddy_mask brain mask)."""
 
     # ── AP/PA preparation ──────────────────────────────────────────────────────
     se_epi_task_out = None
@@ -656,46 +639,34 @@ def DwiPreprocessing(
             DwiCat(
                 in_file1=dwi_raw_mif,
                 in_file2=rpe_file,
-                out_file="dwi_AP_PA_concat.mif.gz",
+                out_file=intermediate_name("dwi_AP_PA_concat", intermediate_format),
             ),
             name="DwiCat_rpe_all",
         )
         dwi_prepared = dwicat_task.out_file
 
     elif rpe_mode == "rpe_pair":
-        fwd_b0_extract = workflow.add(
-            DwiExtract(in_file=dwi_raw_mif, out_file="fwd_bzero.mif.gz", bzero=True, config=[]),
-            name="DwiExtract_fwd_b0",
-        )
         fwd_meanb0 = workflow.add(
-            MrMath(
-                in_file=fwd_b0_extract.out_file,
-                out_file="fwd_meanb0.mif.gz",
-                operation="mean",
-                axis=3,
-                config=[],
+            MeanBzero(
+                in_file=dwi_raw_mif,
+                out_file=intermediate_name("fwd_meanb0", intermediate_format),
+                clamp=False,
             ),
-            name="MrMath_fwd_meanb0",
-        )
-        rpe_b0_extract = workflow.add(
-            DwiExtract(in_file=rpe_file, out_file="rpe_bzero.mif.gz", bzero=True, config=[]),
-            name="DwiExtract_rpe_b0",
+            name="MeanBzero_fwd",
         )
         rpe_meanb0 = workflow.add(
-            MrMath(
-                in_file=rpe_b0_extract.out_file,
-                out_file="rpe_meanb0.mif.gz",
-                operation="mean",
-                axis=3,
-                config=[],
+            MeanBzero(
+                in_file=rpe_file,
+                out_file=intermediate_name("rpe_meanb0", intermediate_format),
+                clamp=False,
             ),
-            name="MrMath_rpe_meanb0",
+            name="MeanBzero_rpe",
         )
         se_epi_task = workflow.add(
             MrCat(
-                in_file1=fwd_meanb0.out_file,
-                in_file2=rpe_meanb0.out_file,
-                out_file="se_epi_pair.mif.gz",
+                in_file1=fwd_meanb0.out,
+                in_file2=rpe_meanb0.out,
+                out_file=intermediate_name("se_epi_pair", intermediate_format),
                 axis=3,
             ),
             name="MrCat_se_epi",
@@ -738,50 +709,38 @@ def DwiPreprocessing(
     # ── Step 4: Gibbs ringing removal ─────────────────────────────────────────
     dwi_degibbs_task = workflow.add(MrDegibbs(in_=dwi_denoise_task.out, config=[]))
 
-    # ── Step 5: Early b0 brain mask (eddy_mask) ───────────────────────────────
-    early_b0_task = workflow.add(
-        DwiExtract(
-            in_file=dwi_degibbs_task.out,
-            out_file="early_bzero.mif.gz",
-            bzero=True,
-            config=[],
-        ),
-        name="DwiExtract_early",
-    )
-    early_b0_nonneg = workflow.add(
-        MrcalcMax(in_file=early_b0_task.out_file, number=0.0, operand="max"),
-        name="MrcalcMax_early_b0",
-    )
+    # ── Step 5: Early mean b0 (input of the eddy_mask) ────────────────────────
     early_meanb0_task = workflow.add(
-        MrMath(
-            in_file=early_b0_nonneg.output_image,
+        MeanBzero(
+            in_file=dwi_degibbs_task.out,
             out_file="early_meanb0.nii.gz",
-            operation="mean",
-            axis=3,
-            config=[],
         ),
-        name="MrMath_early_meanb0",
-    )
-    synthstrip_task = workflow.add(
-        MriSynthstrip(in_file=early_meanb0_task.out_file),
-        name="MriSynthstrip_early",
+        name="MeanBzero_early",
     )
 
-    # ── Step 6: Motion and distortion correction ───────────────────────────────
-    _se_epi_label = "yes" if rpe_mode in ("rpe_pair", "rpe_split") else "no"
-    _pe_label = "from header" if rpe_mode == "rpe_header" else pe_dir
-    _rt_label = (
-        "from header"
-        if rpe_mode == "rpe_header"
-        else (str(readout_time) if readout_time is not None else "from header")
-    )
-    dwifslpreproc_options = (
-        f"mode: -{rpe_mode}  pe_dir: {_pe_label}  "
-        f"readout_time: {_rt_label}  "
-        f'eddy_options: "{eddy_options}"  '
-        f"se_epi: {_se_epi_label}"
+    return (
+        dwi_degibbs_task.out,
+        se_epi_task_out,
+        early_meanb0_task.out,
+        grad_check_task.grad_warning,
     )
 
+
+@workflow.define(outputs=["dwi_corrected", "preproc_meanb0"])
+def DwiCorrectStage(
+    dwi_degibbs: File,
+    eddy_mask: File,
+    se_epi: File | None = None,
+    pe_dir: str = "AP",
+    rpe_mode: str = "rpe_none",
+    readout_time: float | None = None,
+    eddy_options: str = f"' --slm=linear --nthr={get_eddy_nthr()}'",
+    intermediate_format: str = DEFAULT_INTERMEDIATE_FORMAT,
+) -> tuple[File, File]:
+    """Steps 6–7: motion and distortion correction, and the corrected mean b0 (the
+    input of the final brain mask)."""
+
+    # ── Step 6: Motion and distortion correction ───────────────────────────────
     if rpe_mode == "rpe_none":
         _rpe_kw = {"rpe_none": True}
     elif rpe_mode == "rpe_pair":
@@ -794,11 +753,11 @@ def DwiPreprocessing(
         _rpe_kw = {"rpe_split": True}
 
     _fslpreproc_kw: dict = {
-        "in_file": dwi_degibbs_task.out,
-        "out_file": "DWI_preproc.mif.gz",
+        "in_file": dwi_degibbs,
+        "out_file": intermediate_name("DWI_preproc", intermediate_format),
         **_rpe_kw,
-        "eddy_mask": synthstrip_task.mask_file,
-        "se_epi": se_epi_task_out if rpe_mode in ("rpe_pair", "rpe_split") else None,
+        "eddy_mask": eddy_mask,
+        "se_epi": se_epi if rpe_mode in ("rpe_pair", "rpe_split") else None,
         "align_seepi": rpe_mode in ("rpe_pair", "rpe_split"),
         "eddy_options": eddy_options,
         "config": [],
@@ -810,41 +769,51 @@ def DwiPreprocessing(
 
     dwifslpreproc_task = workflow.add(DwiFslpreproc(**_fslpreproc_kw))
 
-    # ── Step 7: Corrected b0 brain mask ───────────────────────────────────────
-    preproc_b0_task = workflow.add(
-        DwiExtract(
-            in_file=dwifslpreproc_task.out_file,
-            out_file="preproc_bzero.mif.gz",
-            bzero=True,
-            config=[],
-        ),
-        name="DwiExtract_preproc",
-    )
-    preproc_b0_nonneg = workflow.add(
-        MrcalcMax(in_file=preproc_b0_task.out_file, number=0.0, operand="max"),
-        name="MrcalcMax_preproc_b0",
-    )
+    # ── Step 7: Corrected mean b0 (input of the brain mask) ───────────────────
     preproc_meanb0_task = workflow.add(
-        MrMath(
-            in_file=preproc_b0_nonneg.output_image,
+        MeanBzero(
+            in_file=dwifslpreproc_task.out_file,
             out_file="preproc_meanb0.nii.gz",
-            operation="mean",
-            axis=3,
-            config=[],
         ),
-        name="MrMath_preproc_meanb0",
-    )
-    corrected_synthstrip_task = workflow.add(
-        MriSynthstrip(in_file=preproc_meanb0_task.out_file),
-        name="MriSynthstrip_corrected",
+        name="MeanBzero_preproc",
     )
 
+    return dwifslpreproc_task.out_file, preproc_meanb0_task.out
+
+
+@workflow.define(
+    outputs=[
+        "dwi_preprocessed",
+        "dwimask_preprocessed",
+        "response_wm",
+        "response_gm",
+        "response_csf",
+        "execution_log",
+    ]
+)
+def DwiFinaliseStage(
+    dwi_corrected: File,
+    brain_mask: File,
+    grad_warning: str,
+    pe_dir: str = "AP",
+    rpe_mode: str = "rpe_none",
+    readout_time: float | None = None,
+    eddy_options: str = f"' --slm=linear --nthr={get_eddy_nthr()}'",
+    fod_algorithm: str = "msmt_csd",
+    start_time: str = "",
+    cache_root: str = "",
+    intermediate_format: str = DEFAULT_INTERMEDIATE_FORMAT,
+) -> tuple[File, File, File, File, File, str]:
+    """Steps 8–10 (bias field correction, cropping and response functions), and the
+    manifest and execution log. The cropped DWI and mask are the final outputs, so
+    they are gzipped if they were written in an uncompressed intermediate format."""
+
     # ── Step 8: Bias field correction ─────────────────────────────────────────
     dwibiasfieldcorr_task = workflow.add(
         DwiBiascorrect_Ants(
-            in_file=dwifslpreproc_task.out_file,
-            mask=corrected_synthstrip_task.mask_file,
-            bias="biasfield.mif.gz",
+            in_file=dwi_corrected,
+            mask=brain_mask,
+            bias=intermediate_name("biasfield", intermediate_format),
             config=[],
         )
     )
@@ -854,8 +823,8 @@ def DwiPreprocessing(
         MrGrid(
             in_file=dwibiasfieldcorr_task.out_file,
             operation="crop",
-            mask=corrected_synthstrip_task.mask_file,
-            out_file="dwi_processed.mif.gz",
+            mask=brain_mask,
+            out_file=intermediate_name("dwi_processed", intermediate_format),
             uniform=-3,
             config=[],
         ),
@@ -863,10 +832,10 @@ def DwiPreprocessing(
     )
     crop_task_mask = workflow.add(
         MrGrid(
-            in_file=corrected_synthstrip_task.mask_file,
+            in_file=brain_mask,
             operation="crop",
-            mask=corrected_synthstrip_task.mask_file,
-            out_file="dwimask_processed.mif.gz",
+            mask=brain_mask,
+            out_file=intermediate_name("dwimask_processed", intermediate_format),
             interp="nearest",
             uniform=-3,
             config=[],
@@ -879,17 +848,31 @@ def DwiPreprocessing(
         Dwi2Response_Dhollander(
             in_file=crop_task_dwi.out_file,
             mask=crop_task_mask.out_file,
-            voxels="voxels.mif.gz",
+            voxels=intermediate_name("voxels", intermediate_format),
             config=[],
         )
     )
 
+    # ── Final outputs, gzipped ─────────────────────────────────────────────────
+    dwi_preprocessed = final_image(
+        crop_task_dwi.out_file,
+        "dwi_processed",
+        intermediate_format,
+        "CompressImage_dwi",
+    )
+    dwimask_preprocessed = final_image(
+        crop_task_mask.out_file,
+        "dwimask_processed",
+        intermediate_format,
+        "CompressImage_mask",
+    )
+
     # ── Write manifest (paths consumed by tractography_connectomics.py) ───────
     workflow.add(
         WritePreprocessingManifest(
             output_dir=cache_root,
-            dwi_preprocessed=crop_task_dwi.out_file,
-            dwimask_preprocessed=crop_task_mask.out_file,
+            dwi_preprocessed=dwi_preprocessed,
+            dwimask_preprocessed=dwimask_preprocessed,
             response_wm=EstimateResponseFcn_task.out_sfwm,
             response_gm=EstimateResponseFcn_task.out_gm,
             response_csf=EstimateResponseFcn_task.out_csf,
@@ -902,23 +885,25 @@ def DwiPreprocessing(
         WritePreprocessingLog(
             start_time=start_time,
             cache_root=cache_root,
-            dwi_preprocessed=crop_task_dwi.out_file,
-            dwimask_preprocessed=crop_task_mask.out_file,
+            dwi_preprocessed=dwi_preprocessed,
+            dwimask_preprocessed=dwimask_preprocessed,
             response_wm=EstimateResponseFcn_task.out_sfwm,
             response_gm=EstimateResponseFcn_task.out_gm,
             response_csf=EstimateResponseFcn_task.out_csf,
-            grad_warning=grad_check_task.grad_warning,
+            grad_warning=grad_warning,
             pe_dir=pe_dir,
             rpe_mode=rpe_mode,
             eddy_options=eddy_options,
             fod_algorithm=fod_algorithm,
-            dwifslpreproc_options=dwifslpreproc_options,
+            dwifslpreproc_options=dwifslpreproc_label(
+                pe_dir, rpe_mode, readout_time, eddy_options
+            ),
         )
     )
 
     return (
-        crop_task_dwi.out_file,
-        crop_task_mask.out_file,
+        dwi_preprocessed,
+        dwimask_preprocessed,
         EstimateResponseFcn_task.out_sfwm,
         EstimateResponseFcn_task.out_gm,
         EstimateResponseFcn_task.out_csf,
@@ -926,17 +911,272 @@ def DwiPreprocessing(
     )
 
 
+# ── Main workflow ──────────────────────────────────────────────────────────────
+
+
+@workflow.define(
+    outputs=[
+        "dwi_preprocessed",
+        "dwimask_preprocessed",
+        "response_wm",
+        "response_gm",
+        "response_csf",
+        "execution_log",
+    ]
+)
+def DwiPreprocessing(
+    dwi_raw_mif: File,
+    pe_dir: str = "AP",
+    rpe_mode: str = "rpe_none",
+    rpe_file: str | None = None,
+    readout_time: float | None = None,
+    eddy_options: str = f"' --slm=linear --nthr={get_eddy_nthr()}'",
+    fod_algorithm: str = "msmt_csd",
+    start_time: str = "",
+    cache_root: str = "",
+    intermediate_format: str = DEFAULT_INTERMEDIATE_FORMAT,
+) -> tuple[File, File, File, File, File, str]:
+    """Preprocess a DWI series (see the stages for the steps). Intermediate images are
+    written in ``intermediate_format`` ("mif" or "mif.gz", see intermediates.py) and
+    only the final outputs are gzipped."""
+
+    # ── Steps 1–5 ──────────────────────────────────────────────────────────────
+    prepare_task = workflow.add(
+        DwiPrepareStage(
+            dwi_raw_mif=dwi_raw_mif,
+            rpe_mode=rpe_mode,
+            rpe_file=rpe_file,
+            intermediate_format=intermediate_format,
+        )
+    )
+
+    # ── Step 5: Early b0 brain mask (eddy_mask) ───────────────────────────────
+    synthstrip_task = workflow.add(
+        MriSynthstrip(in_file=prepare_task.early_meanb0),
+        name="MriSynthstrip_early",
+    )
+
+    # ── Steps 6–7 ──────────────────────────────────────────────────────────────
+    correct_task = workflow.add(
+        DwiCorrectStage(
+            dwi_degibbs=prepare_task.dwi_degibbs,
+            eddy_mask=synthstrip_task.mask_file,
+            se_epi=prepare_task.se_epi,
+            pe_dir=pe_dir,
+            rpe_mode=rpe_mode,
+            readout_time=readout_time,
+            eddy_options=eddy_options,
+            intermediate_format=intermediate_format,
+        )
+    )
+
+    # ── Step 7: Corrected b0 brain mask ───────────────────────────────────────
+    corrected_synthstrip_task = workflow.add(
+        MriSynthstrip(in_file=correct_task.preproc_meanb0),
+        name="MriSynthstrip_corrected",
+    )
+
+    # ── Steps 8–10, manifest and execution log ────────────────────────────────
+    finalise_task = workflow.add(
+        DwiFinaliseStage(
+            dwi_corrected=correct_task.dwi_corrected,
+            brain_mask=corrected_synthstrip_task.mask_file,
+            grad_warning=prepare_task.grad_warning,
+            pe_dir=pe_dir,
+            rpe_mode=rpe_mode,
+            readout_time=readout_time,
+            eddy_options=eddy_options,
+            fod_algorithm=fod_algorithm,
+            start_time=start_time,
+            cache_root=cache_root,
+            intermediate_format=intermediate_format,
+        )
+    )
+
+    return (
+        finalise_task.dwi_preprocessed,
+        finalise_task.dwimask_preprocessed,
+        finalise_task.response_wm,
+        finalise_task.response_gm,
+        finalise_task.response_csf,
+        finalise_task.execution_log,
+    )
+
+
+# Per-subject inputs of DwiCohortPreprocessing (the keys of resolve_dwi_inputs plus the
+# FOD algorithm and the subject's output directory), and their defaults
+COHORT_SUBJECT_FIELDS = {
+    "dwi_raw_mif": None,
+    "pe_dir": "AP",
+    "rpe_mode": "rpe_none",
+    "rpe_file": None,
+    "readout_time": None,
+    "fod_algorithm": "msmt_csd",
+    "cache_root": "",
+}
+
+
+@workflow.define(
+    outputs=[
+        "dwi_preprocessed",
+        "dwimask_preprocessed",
+        "response_wm",
+        "response_gm",
+        "response_csf",
+        "execution_log",
+    ]
+)
+def DwiCohortPreprocessing(
+    subjects: list[dict],
+    eddy_options: str = f"' --slm=linear --nthr={get_eddy_nthr()}'",
+    start_time: str = "",
+    synthstrip_threads: int | None = None,
+    intermediate_format: str = DEFAULT_INTERMEDIATE_FORMAT,
+) -> tuple[list[File], list[File], list[File], list[File], list[File], list[str]]:
+    """Preprocess a cohort of subjects, computing the brain masks of all their mean b0s
+    in a single SynthStrip process per mask stage (MriSynthstripBatch) instead of
+    starting SynthStrip (and importing PyTorch) twice per subject.
+
+    Each entry of ``subjects`` holds the per-subject inputs of DwiPreprocessing (see
+    COHORT_SUBJECT_FIELDS), and the outputs are lists in the same order. Note that the
+    batched stages are barriers: eddy starts once the early mean b0s of all subjects
+    have been computed and stripped.
+    """
+    unknown = {k for s in subjects for k in s} - set(COHORT_SUBJECT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unrecognised subject inputs {sorted(unknown)}")
+    if any(s.get("dwi_raw_mif") is None for s in subjects):
+        raise ValueError("All subjects must have a 'dwi_raw_mif'")
+    per_subject = {
+        field: [s.get(field, default) for s in subjects]
+        for field, default in COHORT_SUBJECT_FIELDS.items()
+    }
+
+    # ── Steps 1–5, per subject ─────────────────────────────────────────────────
+    # Each stage is split over the zipped per-subject fields and combined over all of
+    # them (combining just one would leave the others in the state, so the outputs
+    # wouldn't be flat lists in the order of ``subjects``)
+    prepare_fields = ("dwi_raw_mif", "rpe_mode", "rpe_file")
+    prepare_task = workflow.add(
+        DwiPrepareStage(intermediate_format=intermediate_format)
+        .split(prepare_fields, **{f: per_subject[f] for f in prepare_fields})
+        .combine(list(prepare_fields)),
+        name="DwiPrepareStage",
+    )
+
+    # ── Step 5: Early b0 brain masks, all subjects in one process ──────────────
+    synthstrip_task = workflow.add(
+        MriSynthstripBatch(
+            in_files=prepare_task.early_meanb0, threads=synthstrip_threads
+        ),
+        name="MriSynthstripBatch_early",
+    )
+
+    # ── Steps 6–7, per subject ─────────────────────────────────────────────────
+    correct_fields = (
+        "dwi_degibbs",
+        "eddy_mask",
+        "se_epi",
+        "pe_dir",
+        "rpe_mode",
+        "readout_time",
+    )
+    correct_task = workflow.add(
+        DwiCorrectStage(
+            eddy_options=eddy_options, intermediate_format=intermediate_format
+        )
+        .split(
+            correct_fields,
+            dwi_degibbs=prepare_task.dwi_degibbs,
+            eddy_mask=synthstrip_task.mask_files,
+            se_epi=prepare_task.se_epi,
+            pe_dir=per_subject["pe_dir"],
+            rpe_mode=per_subject["rpe_mode"],
+            readout_time=per_subject["readout_time"],
+        )
+        .combine(list(correct_fields)),
+        name="DwiCorrectStage",
+    )
+
+    # ── Step 7: Corrected b0 brain masks, all subjects in one process ──────────
+    corrected_synthstrip_task = workflow.add(
+        MriSynthstripBatch(
+            in_files=correct_task.preproc_meanb0, threads=synthstrip_threads
+        ),
+        name="MriSynthstripBatch_corrected",
+    )
+
+    # ── Steps 8–10, manifest and execution log, per subject ───────────────────
+    finalise_fields = (
+        "dwi_corrected",
+        "brain_mask",
+        "grad_warning",
+        "pe_dir",
+        "rpe_mode",
+        "readout_time",
+        "fod_algorithm",
+        "cache_root",
+    )
+    finalise_task = workflow.add(
+        DwiFinaliseStage(
+            eddy_options=eddy_options,
+            start_time=start_time,
+            intermediate_format=intermediate_format,
+        )
+        .split(
+            finalise_fields,
+            dwi_corrected=correct_task.dwi_corrected,
+            brain_mask=corrected_synthstrip_task.mask_files,
+            grad_warning=prepare_task.grad_warning,
+            pe_dir=per_subject["pe_dir"],
+            rpe_mode=per_subject["rpe_mode"],
+            readout_time=per_subject["readout_time"],
+            fod_algorithm=per_subject["fod_algorithm"],
+            cache_root=per_subject["cache_root"],
+        )
+        .combine(list(finalise_fields)),
+        name="DwiFinaliseStage",
+    )
+
+    return (
+        finalise_task.dwi_preprocessed,
+        finalise_task.dwimask_preprocessed,
+        finalise_task.response_wm,
+        finalise_task.response_gm,
+        finalise_task.response_csf,
+        finalise_task.execution_log,
+    )
+
+
 # ── Entry point ────────────────────────────────────────────────────────────────
 
 if __name__ == "__main__":
     import datetime
     import os
+    from australianimagingservice.mri.human.neuro.hashing import (
+        HASH_CACHE_ENV,
+        HASH_CACHE_NAME,
+        enable_hash_cache,
+    )
+    from australianimagingservice.mri.human.neuro.image_header import (
+        HEADER_INDEX_ENV,
+        HEADER_INDEX_NAME,
+        enable_header_index,
+    )
 
     subject_dir = "/Users/adso8337/Desktop/5TTmsmt_testing/data/BATMAN/"
     output_path = "/Users/adso8337/Desktop/5TTmsmt_testing/outputs/preproc/"
 
     nthreads = max(1, (os.cpu_count() or 1) - 2)
 
+    # Keep the digests of the (multi-GB) inputs next to the cache, so that reruns
+    # don't re-read them to compute the checksums
+    if not os.environ.get(HASH_CACHE_ENV):
+        enable_hash_cache(Path(output_path) / HASH_CACHE_NAME)
+    # Reuse the header summaries of the raw DWI series from previous runs
+    if not os.environ.get(HEADER_INDEX_ENV):
+        enable_header_index(Path(output_path) / HEADER_INDEX_NAME)
+
     inputs = resolve_dwi_inputs(subject_dir)
     dwi_path = inputs["dwi_raw_mif"]
 
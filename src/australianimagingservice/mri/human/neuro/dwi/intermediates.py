@@ -0,0 +1,47 @@
+"""Format of the intermediate images of the DWI workflows.
+
+Intermediates are written as uncompressed .mif by default: the 4D DWI stages then
+don't pay for single-threaded gzip on every write and gunzip on every read, and MRtrix
+can memory-map their inputs. Only the declared final outputs of a workflow are
+gzipped (``final_image``), so the outputs are the same .mif.gz files as before. Pass
+``intermediate_format="mif.gz"`` to the workflows to compress the intermediates too
+(e.g. when cache space is short).
+"""
+
+from pathlib import Path
+from fileformats.generic import File
+from pydra.compose import python, workflow
+from australianimagingservice.mri.human.neuro.fileops import compress_file
+
+INTERMEDIATE_FORMATS = ("mif", "mif.gz")
+DEFAULT_INTERMEDIATE_FORMAT = "mif"
+
+
+def intermediate_name(stem: str, intermediate_format: str) -> str:
+    """File name of an intermediate image in the given format, e.g. "DWI_preproc.mif" """
+    if intermediate_format not in INTERMEDIATE_FORMATS:
+        raise ValueError(
+            f"Unrecognised intermediate_format {intermediate_format!r}, choose from "
+            f"{INTERMEDIATE_FORMATS}"
+        )
+    return f"{stem}.{intermediate_format}"
+
+
+@python.define
+def CompressImage(in_file: File, out_file: str, codec: str = "gzip") -> File:
+    """Gzip an image written as an uncompressed .mif into a .mif.gz (MRtrix reads a
+    .mif.gz as the gzipped stream of the whole .mif, so no conversion is needed), in
+    parallel blocks on all available cores. ``codec="zstd"`` archives it with zstd
+    instead, which MRtrix can't read (see fileops.compress_file)."""
+    return File(compress_file(in_file, Path(out_file).absolute(), codec=codec))
+
+
+def final_image(image, stem: str, intermediate_format: str, name: str):
+    """Add a task that gzips an image written in the intermediate format into its
+    final ``<stem>.mif.gz`` output (unless it was written compressed already) to the
+    workflow being constructed, returning the final image"""
+    if intermediate_format == "mif.gz":
+        return image
+    return workflow.add(
+        CompressImage(in_file=image, out_file=f"{stem}.mif.gz"), name=name
+    ).out
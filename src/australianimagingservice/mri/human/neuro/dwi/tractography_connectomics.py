@@ -6,8 +6,6 @@ from pydra.tasks.mrtrix3.v3_1 import (
     TransformConvert,
     MrTransform,
     MrConvert,
-    DwiExtract,
-    MrMath,
     Dwi2Fod,
     MtNormalise,
     TckGen,
@@ -21,7 +19,13 @@ from fileformats.vendor.mrtrix3.medimage import (
     ImageOut,
 )  # noqa: F401
 
-from .dwi_preprocessing import MrcalcMax
+from .bzero import MeanBzero
+from .intermediates import (
+    DEFAULT_INTERMEDIATE_FORMAT,
+    final_image,
+    intermediate_name,
+)
+from .dwi_preprocessing import MrcalcMax, detect_shell_structure
 
 # ── Custom shell task wrappers ─────────────────────────────────────────────────
 
@@ -195,7 +199,7 @@ def WriteTractographyLog(
         "",
         "Steps executed:",
         "  1.  JoinTask / MrConvert — FreeSurfer .mgz → NIfTI",
-        "  2.  DwiExtract / MrcalcMax / MrMath — mean b0 for registration",
+        "  2.  MeanBzero — mean b0 for registration",
         "  3.  MrcalcMax — WM binary mask for EpiReg",
         "  4.  EpiReg — DWI-to-T1 registration",
         "  5.  TransformConvert — FLIRT transform → MRtrix3 format",
@@ -321,7 +325,10 @@ def resolve_tractography_inputs(
 
     dwi_preprocessed = manifest["dwi_preprocessed"]
     dwimask_preprocessed = manifest["dwimask_preprocessed"]
-    fod_algorithm = manifest["fod_algorithm"]
+    # Manifests of older preprocessing runs don't record the FOD algorithm
+    fod_algorithm = manifest.get("fod_algorithm") or detect_shell_structure(
+        dwi_preprocessed
+    )
 
     # ── Response functions ─────────────────────────────────────────────────────
     provided = [response_wm, response_gm, response_csf]
@@ -445,7 +452,13 @@ def Tractography(
     response_gm: File,
     response_csf: File,
     fod_algorithm: str = "msmt_csd",
+    intermediate_format: str = DEFAULT_INTERMEDIATE_FORMAT,
 ) -> tuple[File, File, File, File, File, File, File, File, File, File]:
+    """Register the preprocessed DWI to T1 space, estimate and normalise the FODs and
+    run tractography. The resliced DWI/mask, normalised FODs and TDI maps are written
+    in ``intermediate_format`` ("mif" or "mif.gz", see intermediates.py) and gzipped
+    into the final outputs in parallel blocks, rather than on a single core by the
+    MRtrix commands that write them."""
 
     # ── Step 1: FreeSurfer path construction and .mgz → NIfTI ─────────────────
     join_task = workflow.add(JoinTask(FS_dir=FS_dir))
@@ -460,28 +473,12 @@ def Tractography(
     )
 
     # ── Step 2: Mean b0 for registration ──────────────────────────────────────
-    extract_bzeroes_task = workflow.add(
-        DwiExtract(
-            in_file=dwi_preprocessed,
-            out_file="bzero.mif.gz",
-            bzero=True,
-        )
-    )
-    mrcalc_max = workflow.add(
-        MrcalcMax(
-            in_file=extract_bzeroes_task.out_file,
-            number=0.0,
-            operand="max",
-        ),
-        name="MrcalcMax_b0",
-    )
     meanb0_task = workflow.add(
-        MrMath(
-            in_file=mrcalc_max.output_image,
+        MeanBzero(
+            in_file=dwi_preprocessed,
             out_file="dwi_meanbzero.nii.gz",
-            operation="mean",
-            axis=3,
-        )
+        ),
+        name="MeanBzero",
     )
 
     # ── Step 3: WM binary mask for EpiReg ─────────────────────────────────────
@@ -497,7 +494,7 @@ def Tractography(
     # ── Step 4: DWI → T1 registration ─────────────────────────────────────────
     epi_reg_task = workflow.add(
         EpiReg(
-            epi=meanb0_task.out_file,
+            epi=meanb0_task.out,
             t1_head=nifti_normimg.out_file,
             t1_brain=nifti_t1brain.out_file,
             wmseg=mrcalc_wmbin.output_image,
@@ -509,7 +506,7 @@ def Tractography(
     transformconvert_task = workflow.add(
         TransformConvert(
             input_matrix=epi_reg_task.epi2str_mat,
-            flirt_in=meanb0_task.out_file,
+            flirt_in=meanb0_task.out,
             flirt_ref=nifti_t1brain.out_file,
             operation="flirt_import",
             out_file="epi2struct_mrtrix.txt",
@@ -521,7 +518,7 @@ def Tractography(
         MrTransform(
             in_file=dwi_preprocessed,
             inverse=False,
-            out_file="DWI_T1space.mif.gz",
+            out_file=intermediate_name("DWI_T1space", intermediate_format),
             linear=transformconvert_task.out_file,
             template=fTTvis_image_T1space,
             strides=fTTvis_image_T1space,
@@ -534,7 +531,7 @@ def Tractography(
         MrTransform(
             in_file=dwimask_preprocessed,
             inverse=False,
-            out_file="DWImask_T1space.mif.gz",
+            out_file=intermediate_name("DWImask_T1space", intermediate_format),
             interp="nearest",
             linear=transformconvert_task.out_file,
             template=fTTvis_image_T1space,
@@ -582,9 +579,9 @@ def Tractography(
             fod_gm=gm_fod,
             fod_csf=csf_fod,
             mask=transformDWImask_task.out_file,
-            fod_wm_norm="wmfod_norm.mif.gz",
-            fod_gm_norm="gmfod_norm.mif.gz",
-            fod_csf_norm="csffod_norm.mif.gz",
+            fod_wm_norm=intermediate_name("wmfod_norm", intermediate_format),
+            fod_gm_norm=intermediate_name("gmfod_norm", intermediate_format),
+            fod_csf_norm=intermediate_name("csffod_norm", intermediate_format),
         )
     )
 
@@ -622,7 +619,7 @@ def Tractography(
             tck_weights_in=SIFT2_task.out_weights,
             vox=1,
             template=fTT_image_T1space,
-            out_file="TDI.mif.gz",
+            out_file=intermediate_name("TDI", intermediate_format),
         ),
         name="TckMap_TDI",
     )
@@ -634,22 +631,31 @@ def Tractography(
             vox=1,
             template=fTT_image_T1space,
             dec=True,
-            out_file="DECTDI.mif.gz",
+            out_file=intermediate_name("DECTDI", intermediate_format),
         ),
         name="TckMap_DECTDI",
     )
 
+    # ── Final outputs, gzipped ─────────────────────────────────────────────────
+    finals = [
+        final_image(image, stem, intermediate_format, f"CompressImage_{stem}")
+        for image, stem in [
+            (transformDWI_task.out_file, "DWI_T1space"),
+            (transformDWImask_task.out_file, "DWImask_T1space"),
+            (NormFod_task.fod_wm_norm, "wmfod_norm"),
+            (NormFod_task.fod_gm_norm, "gmfod_norm"),
+            (NormFod_task.fod_csf_norm, "csffod_norm"),
+            (TDImap_task.out_file, "TDI"),
+            (DECTDImap_task.out_file, "DECTDI"),
+        ]
+    ]
+
     return (
-        transformDWI_task.out_file,
-        transformDWImask_task.out_file,
-        NormFod_task.fod_wm_norm,
-        NormFod_task.fod_gm_norm,
-        NormFod_task.fod_csf_norm,
+        *finals[:5],
         tckgen_task.tracks,
         SIFT2_task.out_mu,
         SIFT2_task.out_weights,
-        TDImap_task.out_file,
-        DECTDImap_task.out_file,
+        *finals[5:],
     )
 
 
@@ -735,11 +741,26 @@ def Connectomics(
 
 if __name__ == "__main__":
     import datetime
+    import os
+    from australianimagingservice.mri.human.neuro.hashing import (
+        HASH_CACHE_ENV,
+        HASH_CACHE_NAME,
+        enable_hash_cache,
+    )
+    from australianimagingservice.mri.human.neuro.image_header import (
+        HEADER_INDEX_ENV,
+        HEADER_INDEX_NAME,
+        enable_header_index,
+    )
 
     preprocessed_dir = "/Users/adso8337/Desktop/5TTmsmt_testing/outputs/BATMAN_preproc/"
     t1_dir = "/Users/adso8337/Desktop/5TTmsmt_testing/outputs/T1testing/final_outputs/"
     output_path = "/Users/adso8337/Desktop/5TTmsmt_testing/outputs/BATMAN_tractography/"
 
+    # Reuse the header summaries of the inputs from previous runs
+    if not os.environ.get(HEADER_INDEX_ENV):
+        enable_header_index(Path(output_path) / HEADER_INDEX_NAME)
+
     inputs = resolve_tractography_inputs(
         preprocessed_dir=preprocessed_dir,
         t1_dir=t1_dir,
@@ -752,6 +773,11 @@ if __name__ == "__main__":
     )
 
     parcellations = inputs.pop("_parcellations")
+
+    # Keep the digests of the (multi-GB) inputs and tractograms next to the cache, so
+    # that reruns don't re-read them to compute the checksums
+    if not os.environ.get(HASH_CACHE_ENV):
+        enable_hash_cache(Path(output_path) / HASH_CACHE_NAME)
     start_time = datetime.datetime.now().isoformat(timespec="seconds")
 
     # ── Run tractography once ──────────────────────────────────────────────────
@@ -0,0 +1,305 @@
+"""Pydra environment that keeps one long-lived container per worker process and runs
+each task in it with ``docker exec``, instead of starting a fresh container (with its
+own mount setup) for every task as ``pydra.environments.docker.Docker`` does.
+
+The container is started lazily by the first task that needs it, with the host
+directories that task needs (plus any ``mount_roots``) mounted under ``root``. A later
+task that needs a directory that isn't mounted gets a new container with the union of
+the mounts, and the old one is removed once the tasks running in it have finished.
+
+Containers are removed when the worker process exits. As pydra's process-pool workers
+exit via ``os._exit``, which skips ``atexit`` handlers, each container is paired with
+a small watchdog process that holds the read end of a pipe from the worker and removes
+the container when the pipe is closed, i.e. however the worker exits.
+
+The "local" runtime is a stand-in for Docker that realises the mounts as symbolic
+links under a temporary directory and runs the commands on the host, so that the
+environment (path mapping, mount coverage, container reuse) can be exercised on
+machines without Docker.
+"""
+
+import abc
+import atexit
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import typing as ty
+from pathlib import Path
+import attrs
+from pydra.environments import base
+
+if ty.TYPE_CHECKING:
+    from pydra.compose import shell
+    from pydra.engine.job import Job
+
+logger = logging.getLogger("australianimagingservice.mri.human.neuro.environments")
+
+# Environment variable that selects the runtime when it isn't given explicitly
+CONTAINER_RUNTIME_ENV = "AIS_CONTAINER_RUNTIME"
+
+Mounts = dict[str, str]  # host path -> mode ("ro" or "rw")
+
+
+class ContainerRuntime(abc.ABC):
+    """Starts, runs commands in and stops long-lived containers"""
+
+    @abc.abstractmethod
+    def start(self, image: str, mounts: Mounts, root: str, xargs: list[str]) -> str:
+        """Start a container with the host paths mounted under ``root``, returning
+        its handle"""
+
+    @abc.abstractmethod
+    def exec(self, handle: str, cmd: list[str], workdir: str) -> tuple[int, str, str]:
+        """Run a command in the container, returning its (return code, stdout,
+        stderr)"""
+
+    @abc.abstractmethod
+    def stop_command(self, handle: str) -> list[str]:
+        """The host command that stops and removes the container (which is also run
+        by its watchdog, so must not depend on the state of this process)"""
+
+    def stop(self, handle: str) -> None:
+        subprocess.run(self.stop_command(handle), capture_output=True)
+
+    def root(self, handle: ty.Optional[str], root: str) -> str:
+        """The prefix that host paths are mounted under in the container"""
+        return root
+
+
+def _strip_entrypoint(xargs: list[str]) -> list[str]:
+    """Remove any --entrypoint from the docker run arguments, as the container's
+    entrypoint has to keep it alive between tasks"""
+    stripped, skip = [], False
+    for arg in xargs:
+        if skip:
+            skip = False
+        elif arg == "--entrypoint":
+            skip = True
+        elif not arg.startswith("--entrypoint="):
+            stripped.append(arg)
+    return stripped
+
+
+class DockerRuntime(ContainerRuntime):
+    def start(self, image: str, mounts: Mounts, root: str, xargs: list[str]) -> str:
+        cmd = ["docker", "run", "--detach", "--rm", "--init"]
+        cmd += _strip_entrypoint(xargs)
+        for host, mode in sorted(mounts.items()):
+            cmd += ["-v", f"{host}:{root}{host}:{mode}"]
+        cmd += ["--entrypoint", "sleep", image, "infinity"]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode:
+            raise RuntimeError(f"Could not start container {image}: {result.stderr}")
+        return result.stdout.strip()
+
+    def exec(self, handle: str, cmd: list[str], workdir: str) -> tuple[int, str, str]:
+        return base.execute(["docker", "exec", "-w", workdir, handle, *cmd])
+
+    def stop_command(self, handle: str) -> list[str]:
+        return ["docker", "rm", "--force", handle]
+
+
+class LocalRuntime(ContainerRuntime):
+    """Stand-in for Docker: each "container" is a temporary directory in which the
+    mounts are symbolic links to the host paths, and commands are run on the host"""
+
+    def start(self, image: str, mounts: Mounts, root: str, xargs: list[str]) -> str:
+        handle = tempfile.mkdtemp(prefix="ais-container-")
+        # Shorter paths first, so that nested mounts are covered by their parents
+        for host in sorted(mounts, key=len):
+            link = Path(f"{handle}{root}{host}")
+            if os.path.lexists(link) or any(
+                p.is_symlink() for p in link.parents if str(p).startswith(handle)
+            ):
+                continue
+            link.parent.mkdir(parents=True, exist_ok=True)
+            link.symlink_to(host)
+        return handle
+
+    def exec(self, handle: str, cmd: list[str], workdir: str) -> tuple[int, str, str]:
+        return base.execute(cmd, cwd=workdir)
+
+    def stop_command(self, handle: str) -> list[str]:
+        return ["rm", "-rf", handle]
+
+    def root(self, handle: ty.Optional[str], root: str) -> str:
+        return f"{handle}{root}"
+
+
+RUNTIMES: dict[str, ContainerRuntime] = {
+    "docker": DockerRuntime(),
+    "local": LocalRuntime(),
+}
+
+
+# Waits for the pipe from the worker to be closed, then runs the stop command
+_WATCHDOG = (
+    "import subprocess, sys; sys.stdin.buffer.read(); "
+    "subprocess.run(sys.argv[1:], capture_output=True)"
+)
+
+
+def _start_watchdog(command: list[str]) -> subprocess.Popen:
+    """Start a process that runs ``command`` once this process exits (or closes the
+    watchdog's stdin). It is in its own session so that it outlives signals sent to the
+    worker's process group"""
+    return subprocess.Popen(
+        [sys.executable, "-c", _WATCHDOG, *command],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+@attrs.define
+class _Container:
+    runtime: ContainerRuntime
+    handle: str
+    mounts: Mounts
+    watchdog: ty.Optional[subprocess.Popen] = None
+    active: int = 0
+    retired: bool = False
+
+    def stop(self) -> None:
+        self.runtime.stop(self.handle)
+        if self.watchdog is not None:
+            # The container is already gone, so the watchdog has nothing left to do
+            self.watchdog.kill()
+            self.watchdog.wait()
+
+    def covers(self, required: Mounts) -> bool:
+        """Whether the container's mounts include all the required paths/modes"""
+        for path, mode in required.items():
+            mounted = [
+                m_mode
+                for m, m_mode in self.mounts.items()
+                if path == m or path.startswith(m.rstrip("/") + "/")
+            ]
+            if not any(mode == "ro" or m_mode == "rw" for m_mode in mounted):
+                return False
+        return True
+
+
+# Running containers of this process, keyed by (pid, runtime, image, xargs). Module
+# state rather than attributes of the environment, as environments are copied and
+# pickled along with the tasks they run
+_CONTAINERS: dict[tuple, _Container] = {}
+_LOCK = threading.Lock()
+
+
+def _release(container: _Container) -> None:
+    with _LOCK:
+        container.active -= 1
+        stop = container.retired and container.active == 0
+    if stop:
+        container.stop()
+
+
+@atexit.register
+def _stop_all() -> None:
+    """Stop the containers of this process when it exits normally (e.g. the submitter
+    process, when tasks are run by the debug worker). Those of pool workers, which
+    skip atexit handlers, are stopped by their watchdogs"""
+    with _LOCK:
+        containers = [c for k, c in _CONTAINERS.items() if k[0] == os.getpid()]
+        _CONTAINERS.clear()
+    for container in containers:
+        container.stop()
+
+
+@attrs.define
+class PersistentContainer(base.Container):
+    """Run shell tasks in a long-lived container per worker process (see module
+    docstring)
+
+    Parameters
+    ----------
+    image : str
+        Name of the container image
+    tag : str
+        Tag of the container image
+    root : str
+        Base path for mounting host directories into the container
+    xargs : list[str]
+        Extra arguments passed to ``docker run`` when the container is started (an
+        --entrypoint is ignored, as the container has to be kept alive)
+    runtime : str, optional
+        "docker" or "local" (the stand-in), by default $AIS_CONTAINER_RUNTIME or
+        "docker"
+    mount_roots : list[str]
+        Host directories to mount (read-write) when the container is started, so that
+        tasks whose files are within them don't need a new container
+    """
+
+    _plugin_name: ty.ClassVar[str] = "persistent-container"
+
+    runtime: ty.Optional[str] = None
+    mount_roots: list[str] = attrs.field(factory=list)
+
+    def _runtime(self) -> tuple[str, ContainerRuntime]:
+        name = self.runtime or os.environ.get(CONTAINER_RUNTIME_ENV, "docker")
+        try:
+            return name, RUNTIMES[name]
+        except KeyError:
+            raise ValueError(
+                f"Unrecognised container runtime '{name}', choose from {list(RUNTIMES)}"
+            ) from None
+
+    def _acquire(self, required: Mounts) -> _Container:
+        name, runtime = self._runtime()
+        image = f"{self.image}:{self.tag}"
+        key = (os.getpid(), name, image, tuple(self.xargs))
+        with _LOCK:
+            container = _CONTAINERS.get(key)
+            if container is not None and container.covers(required):
+                container.active += 1
+                return container
+            mounts = {str(Path(r).absolute()): "rw" for r in self.mount_roots}
+            if container is not None:
+                logger.info("Restarting %s container to add mounts %s", image, required)
+                mounts.update(container.mounts)
+                container.retired = True
+                stop_old = container.active == 0
+            for path, mode in required.items():
+                if mounts.get(path) != "rw":
+                    mounts[path] = mode
+            handle = runtime.start(image, mounts, self.root, self.xargs)
+            watchdog = _start_watchdog(runtime.stop_command(handle))
+            new = _CONTAINERS[key] = _Container(
+                runtime, handle, mounts, watchdog, active=1
+            )
+        if container is not None and stop_old:
+            container.stop()
+        logger.debug("Started %s container %s", image, handle)
+        return new
+
+    def execute(self, job: "Job[shell.Task]") -> dict[str, ty.Any]:
+        _, runtime = self._runtime()
+        bindings, _ = self.get_bindings(job=job, root=self.root)
+        required = {
+            str(Path(host).absolute()): mode for host, (_, mode) in bindings.items()
+        }
+        container = self._acquire(required)
+        try:
+            # The paths in the command are mapped to where the runtime mounts them
+            env_root = runtime.root(container.handle, self.root)
+            _, arg_values = self.get_bindings(job=job, root=env_root)
+            job.cache_dir.mkdir(exist_ok=True)
+            values = runtime.exec(
+                container.handle,
+                job.task._command_args(values=arg_values),
+                f"{env_root}{job.cache_dir}",
+            )
+        finally:
+            _release(container)
+        output = dict(zip(["return_code", "stdout", "stderr"], values))
+        if output["return_code"]:
+            if output["stderr"]:
+                raise RuntimeError(output["stdout"] + "\n" + output["stderr"])
+            else:
+                raise RuntimeError(output["stdout"])
+        return output
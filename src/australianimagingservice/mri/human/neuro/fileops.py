@@ -0,0 +1,239 @@
+"""Helpers for placing pipeline outputs into their final locations without copying
+data where the filesystem allows it"""
+
+import errno
+import logging
+import os
+import shutil
+import struct
+import typing as ty
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger("australianimagingservice.mri.human.neuro.fileops")
+
+# ioctl request that asks the filesystem to share the source's extents with the
+# destination (copy-on-write clone), supported by btrfs, XFS, bcachefs, etc...
+FICLONE = 0x40049409
+
+# Environment variable that sets the number of threads used to compress files
+COMPRESS_THREADS_ENV = "AIS_COMPRESS_THREADS"
+# Size of the blocks that are compressed in parallel, and of the end of the previous
+# block that each one is primed with (the deflate window)
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+COMPRESS_DICT_SIZE = 32 * 1024
+
+
+def _reflink(src: Path, dest: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # e.g. Windows
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        dest.unlink(missing_ok=True)
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def place_file(
+    src: ty.Union[str, Path], dest: ty.Union[str, Path], link: bool = True
+) -> str:
+    """Place a file at ``dest`` as cheaply as the filesystem allows: a hard link, then
+    a reflink (copy-on-write clone), falling back to a regular copy. An existing
+    destination is replaced unless it is already the same file. Pass ``link=False``
+    where the source and destination must not share an inode (e.g. if either may be
+    rewritten in place).
+
+    Returns
+    -------
+    method : str
+        how the file was placed, one of "existing", "hardlink", "reflink" or "copy"
+    """
+    src, dest = Path(src), Path(dest)
+    if dest.exists():
+        if os.path.samefile(src, dest):
+            return "existing"
+        dest.unlink()
+    if link:
+        try:
+            os.link(src, dest)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    if _reflink(src, dest):
+        return "reflink"
+    shutil.copy2(src, dest)
+    return "copy"
+
+
+def place_tree(
+    src: ty.Union[str, Path], dest: ty.Union[str, Path], link: bool = True
+) -> None:
+    """Mirror a directory tree at ``dest``, placing each file with ``place_file`` and
+    removing any files/directories left in ``dest`` that are not in ``src`` (e.g. from
+    a previous run), so unchanged files are not rewritten"""
+    src, dest = Path(src), Path(dest)
+    expected = set()
+    for root, dirs, files in os.walk(src):
+        rel = Path(root).relative_to(src)
+        (dest / rel).mkdir(parents=True, exist_ok=True)
+        expected.add(rel)
+        # os.walk doesn't follow links to directories, so recreate them as links
+        linked_dirs = [d for d in dirs if (Path(root) / d).is_symlink()]
+        for fname in files + linked_dirs:
+            src_file = Path(root) / fname
+            if src_file.is_symlink():
+                dest_file = dest / rel / fname
+                if dest_file.is_symlink() or dest_file.exists():
+                    dest_file.unlink()
+                os.symlink(os.readlink(src_file), dest_file)
+            else:
+                place_file(src_file, dest / rel / fname, link=link)
+            expected.add(rel / fname)
+    for root, _, files in os.walk(dest, topdown=False):
+        rel = Path(root).relative_to(dest)
+        for fname in files:
+            if rel / fname not in expected:
+                (Path(root) / fname).unlink()
+        if rel not in expected:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def _compression_threads(threads: ty.Optional[int]) -> int:
+    if threads:
+        return max(1, threads)
+    env = os.environ.get(COMPRESS_THREADS_ENV)
+    if env:
+        return max(1, int(env))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # e.g. macOS
+        return os.cpu_count() or 1
+
+
+def _deflate_block(
+    block: bytes, dictionary: bytes, last: bool, compresslevel: int
+) -> bytes:
+    """Raw-deflate a block of a stream, primed with the end of the previous block (as
+    pigz does, so that matches across block boundaries aren't lost) and ending on a
+    byte boundary so that the compressed blocks can be concatenated"""
+    kwargs = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs
+    )
+    data = compressor.compress(block)
+    return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_file(
+    src: ty.Union[str, Path],
+    dest: ty.Union[str, Path],
+    compresslevel: int = 6,
+    threads: ty.Optional[int] = None,
+) -> Path:
+    """Gzip a file into ``dest`` atomically (e.g. a .mif into a .mif.gz, which MRtrix
+    reads as the gzipped stream of the whole file).
+
+    The file is compressed in blocks on ``threads`` threads (zlib releases the GIL), by
+    default all available cores or $AIS_COMPRESS_THREADS. As with pigz, the blocks are
+    deflated independently and joined into a single deflate stream, so the output is
+    a standard gzip file that gunzip, nibabel and MRtrix read as usual.
+    """
+    src, dest = Path(src), Path(dest)
+    threads = _compression_threads(threads)
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+    crc, size = 0, 0
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as f, ThreadPoolExecutor(
+            threads
+        ) as pool:
+            mtime = int(os.stat(src).st_mtime) & 0xFFFFFFFF
+            # gzip header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+            f.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", mtime) + b"\x00\xff")
+            pending: deque = deque()
+            dictionary = b""
+            block = fsrc.read(COMPRESS_BLOCK_SIZE)
+            while True:
+                next_block = fsrc.read(COMPRESS_BLOCK_SIZE)
+                last = not next_block
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                pending.append(
+                    pool.submit(_deflate_block, block, dictionary, last, compresslevel)
+                )
+                dictionary = block[-COMPRESS_DICT_SIZE:]
+                # Bound the memory held in blocks waiting to be written
+                while len(pending) > 2 * threads or (last and pending):
+                    f.write(pending.popleft().result())
+                if last:
+                    break
+                block = next_block
+            f.write(struct.pack("<II", crc, size & 0xFFFFFFFF))
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return dest
+
+
+def zstd_file(
+    src: ty.Union[str, Path],
+    dest: ty.Union[str, Path],
+    level: int = 3,
+    threads: ty.Optional[int] = None,
+) -> Path:
+    """Compress a file with zstd into ``dest`` atomically, on ``threads`` threads.
+
+    Zstd is faster than gzip and compresses better, but MRtrix can't read it, so it
+    is only for archiving internal files (e.g. intermediates kept for provenance), not
+    for deliverables. Requires the optional ``zstandard`` package.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression requires the 'zstandard' package (pip install "
+            "australianimagingservice[zstd])"
+        ) from None
+    src, dest = Path(src), Path(dest)
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+    compressor = zstandard.ZstdCompressor(
+        level=level, threads=_compression_threads(threads), write_checksum=True
+    )
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as f:
+            compressor.copy_stream(fsrc, f, size=os.stat(src).st_size)
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return dest
+
+
+COMPRESSION_CODECS = {"gzip": (gzip_file, ".gz"), "zstd": (zstd_file, ".zst")}
+
+
+def compress_file(
+    src: ty.Union[str, Path],
+    dest: ty.Union[str, Path, None] = None,
+    codec: str = "gzip",
+    threads: ty.Optional[int] = None,
+) -> Path:
+    """Compress a file with ``codec`` ("gzip" or "zstd") into ``dest``, by default the
+    source path with the codec's extension appended"""
+    try:
+        compress, ext = COMPRESSION_CODECS[codec]
+    except KeyError:
+        raise ValueError(
+            f"Unrecognised codec '{codec}', choose from {list(COMPRESSION_CODECS)}"
+        ) from None
+    if dest is None:
+        dest = f"{src}{ext}"
+    return compress(src, dest, threads=threads)
@@ -0,0 +1,292 @@
+"""Cached content hashes for the pydra checksums of large inputs.
+
+Pydra hashes a Directory by reading every file in it. The FastSurfer subjects directory
+holds thousands of files and is an input to ~100 nodes of AllParcellations, so it was
+re-read to compute the checksum of each of them. Importing this module registers a
+serializer for Directory that hashes a *fingerprint* of the tree instead, computed from
+a manifest of (relpath, size, mtime_ns, digest) entries. The manifest is recorded the
+first time the directory is hashed (i.e. when its producing task has finished) and
+reused by later hash calls, which only need to stat the tree to check it hasn't
+changed. Files that have changed are rehashed and the manifest updated. Manifests are
+kept in the file-hash cache below (or in memory if it isn't enabled), never in the
+hashed directory itself, which is often the input of a running task.
+
+Files are hashed by the digests of their contents, which can also be kept in a
+process-independent SQLite cache keyed on (device, inode, size, mtime_ns), so that
+reruns of the entry points don't read tens of GB of unchanged inputs (raw DWI,
+registered images, tractograms) just to recompute their checksums. The cache is opt-in:
+call ``enable_hash_cache`` (as the entry points do, next to their cache root) or set
+$AIS_HASH_CACHE to the path of the database.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import typing as ty
+from pathlib import Path
+from fileformats.core import FileSet
+from fileformats.generic import Directory
+from pydra.utils.hash import Cache, CacheKey, bytes_repr, register_serializer
+
+logger = logging.getLogger("australianimagingservice.mri.human.neuro.hashing")
+
+# Bumped whenever the way digests or fingerprints are computed changes
+MANIFEST_VERSION = 2
+
+# Environment variable holding the path of the file-hash cache, which enables it (and
+# is inherited by worker processes)
+HASH_CACHE_ENV = "AIS_HASH_CACHE"
+# Name of the file-hash cache database when it is placed next to a cache root
+HASH_CACHE_NAME = "file_hashes.sqlite"
+
+_CHUNK_SIZE = 8 * 1024 * 1024
+
+# relpath -> (size, mtime_ns, digest or None)
+Entries = dict[str, tuple[int, int, ty.Optional[str]]]
+
+
+def _read_digest(path: ty.Union[str, Path]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileHashCache:
+    """SQLite database of file digests keyed on (device, inode, size, mtime_ns), shared
+    by all the processes (and threads) that hash files under a cache root. Keying on
+    the inode rather than the path means hard links and renamed files are recognised
+    too. The manifests of fingerprinted directories are kept in it as well, keyed on
+    the directory's real path."""
+
+    def __init__(self, path: ty.Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, "
+            "PRIMARY KEY (dev, ino))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifests (root TEXT PRIMARY KEY, manifest TEXT)"
+        )
+
+    def digest(self, path: ty.Union[str, Path]) -> str:
+        """Digest of the file, read from the database if the file is unchanged"""
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, digest FROM digests WHERE dev=? AND ino=?", key
+            ).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        digest = _read_digest(path)
+        # Don't record files modified while they were being read
+        if os.stat(path).st_mtime_ns == stat.st_mtime_ns:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                    (*key, stat.st_size, stat.st_mtime_ns, digest),
+                )
+        return digest
+
+    def manifest(self, root: str) -> ty.Optional[str]:
+        """The manifest recorded for a directory, if any"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT manifest FROM manifests WHERE root=?", (root,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_manifest(self, root: str, manifest: str) -> None:
+        """Record (or replace) the manifest of a directory"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO manifests VALUES (?, ?)", (root, manifest)
+            )
+
+
+_HASH_CACHE: ty.Optional[tuple[int, str, FileHashCache]] = None
+_HASH_CACHE_LOCK = threading.Lock()
+
+
+def enable_hash_cache(path: ty.Union[str, Path]) -> None:
+    """Keep file digests in the SQLite database at ``path`` (in this process and the
+    worker processes it starts)"""
+    os.environ[HASH_CACHE_ENV] = str(Path(path).absolute())
+
+
+def hash_cache() -> ty.Optional[FileHashCache]:
+    """The file-hash cache of this process if it is enabled (connections aren't shared
+    with forked workers, so each process opens its own)"""
+    global _HASH_CACHE
+    path = os.environ.get(HASH_CACHE_ENV)
+    if not path:
+        return None
+    with _HASH_CACHE_LOCK:
+        if _HASH_CACHE is None or _HASH_CACHE[:2] != (os.getpid(), path):
+            try:
+                _HASH_CACHE = (os.getpid(), path, FileHashCache(path))
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Could not open file-hash cache '%s': %s", path, e)
+                return None
+        return _HASH_CACHE[2]
+
+
+def file_digest(path: ty.Union[str, Path]) -> str:
+    """Hex digest of the contents of a file, from the file-hash cache if enabled"""
+    cache = hash_cache()
+    if cache is not None:
+        try:
+            return cache.digest(path)
+        except sqlite3.Error as e:
+            logger.warning("File-hash cache lookup failed for '%s': %s", path, e)
+    return _read_digest(path)
+
+
+def _scan(root: Path) -> tuple[Entries, dict[str, str]]:
+    """Stat every file in the tree (without reading them), returning the (size,
+    mtime_ns) of each regular file and the targets of the symbolic links"""
+    files: Entries = {}
+    links: dict[str, str] = {}
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(root / rel_dir) as it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if entry.is_symlink():
+                    # Links are hashed by their target (the target's contents are
+                    # covered by its own entry when it is within the tree)
+                    links[rel] = os.readlink(entry.path)
+                elif entry.is_dir():
+                    stack.append(rel)
+                else:
+                    stat = entry.stat()
+                    files[rel] = (stat.st_size, stat.st_mtime_ns, None)
+    return files, links
+
+
+# Manifests of this process, used when the file-hash cache isn't enabled
+_MANIFESTS: dict[str, str] = {}
+_MANIFESTS_LOCK = threading.Lock()
+
+
+def _read_manifest(root: Path) -> Entries:
+    key = str(root.resolve())
+    cache = hash_cache()
+    text = None
+    if cache is not None:
+        try:
+            text = cache.manifest(key)
+        except sqlite3.Error as e:
+            logger.warning("Could not read manifest of '%s': %s", root, e)
+    else:
+        with _MANIFESTS_LOCK:
+            text = _MANIFESTS.get(key)
+    if text is None:
+        return {}
+    try:
+        manifest = json.loads(text)
+    except ValueError:
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return {rel: tuple(e) for rel, e in manifest["files"].items()}
+
+
+def _write_manifest(root: Path, files: Entries, links: dict[str, str], fp: str) -> None:
+    """Record the manifest of a directory in the file-hash cache (or in memory)"""
+    key = str(root.resolve())
+    text = json.dumps(
+        {"version": MANIFEST_VERSION, "fingerprint": fp, "files": files, "links": links}
+    )
+    cache = hash_cache()
+    if cache is not None:
+        try:
+            cache.set_manifest(key, text)
+        except sqlite3.Error as e:
+            logger.warning("Could not record manifest of '%s': %s", root, e)
+    else:
+        with _MANIFESTS_LOCK:
+            _MANIFESTS[key] = text
+
+
+def directory_fingerprint(path: ty.Union[str, Path]) -> str:
+    """Fingerprint of the contents of a directory tree (relative paths, file contents
+    and link targets), reusing the digests in its manifest for files whose size and
+    mtime haven't changed since it was written"""
+    root = Path(path)
+    files, links = _scan(root)
+    cached = _read_manifest(root)
+    stale = 0
+    for rel, (size, mtime_ns, _) in files.items():
+        prev = cached.get(rel)
+        if prev is not None and prev[0] == size and prev[1] == mtime_ns:
+            files[rel] = prev
+        else:
+            files[rel] = (size, mtime_ns, file_digest(root / rel))
+            stale += 1
+    digest = hashlib.blake2b(digest_size=16)
+    for rel in sorted(files):
+        digest.update(f"f:{rel}\0{files[rel][2]}\n".encode())
+    for rel in sorted(links):
+        digest.update(f"l:{rel}\0{links[rel]}\n".encode())
+    fp = digest.hexdigest()
+    # Rewrite the manifest whenever it is out of date (including files that have gone)
+    if stale or len(cached) != len(files):
+        logger.debug("Rehashed %d of %d files in '%s'", stale, len(files), root)
+        _write_manifest(root, files, links, fp)
+    return fp
+
+
+@register_serializer(Directory)
+def bytes_repr_directory(directory: Directory, cache: Cache) -> ty.Iterator[bytes]:
+    cls = type(directory)
+    yield f"{cls.__module__}.{cls.__name__}:".encode()
+    yield directory_fingerprint(directory.fspath).encode()
+
+
+_bytes_repr_fileset = bytes_repr.dispatch(FileSet)
+
+
+def _relative_keys(fspaths: list[Path]) -> list[str]:
+    """Keys of the files of a fileset relative to their common directory and stem (as
+    in FileSet.byte_chunks), so that the hash doesn't depend on where the files are"""
+    common = (
+        Path(os.path.commonpath(fspaths)) if len(fspaths) > 1 else fspaths[0].parent
+    )
+    if all(p.parent == common for p in fspaths):
+        stem = os.path.commonprefix([p.name for p in fspaths]).rstrip(".")
+        return [p.name[len(stem) :] or "." for p in fspaths]
+    return [str(p.relative_to(common)) for p in fspaths]
+
+
+@register_serializer(FileSet)
+def bytes_repr_file_fileset(
+    fileset: FileSet, cache: Cache
+) -> ty.Iterator[ty.Union[CacheKey, bytes]]:
+    fspaths = sorted(fileset.fspaths)
+    if not fspaths or not all(p.is_file() for p in fspaths):
+        yield from _bytes_repr_fileset(fileset, cache)
+        return
+    if hash_cache() is None:
+        # Use pydra's (path, mtime) keyed cache of hashes when there's no file-hash
+        # cache, which gives the same hash, as it only changes how it is looked up
+        mtimes = tuple(p.lstat().st_mtime_ns for p in fspaths)
+        yield CacheKey((*(repr(p) for p in fspaths), *mtimes))  # type: ignore[arg-type]
+    cls = type(fileset)
+    yield f"{cls.__module__}.{cls.__name__}:".encode()
+    for key, path in zip(_relative_keys(fspaths), fspaths):
+        yield (",'" + key + "'=").encode()
+        yield file_digest(path).encode()
@@ -0,0 +1,393 @@
+"""In-process reader for the headers of MRtrix (.mif/.mif.gz) and NIfTI (.nii/.nii.gz)
+images and their diffusion/phase-encoding schemes, so that input discovery can probe
+raw data without launching ``mrinfo`` for every question about every candidate file.
+
+Only the header is read (for gzipped images, only as much of the stream as holds it).
+The diffusion scheme is the embedded ``dw_scheme`` of a MIF, or the FSL ``.bval`` and
+``.bvec`` files next to a NIfTI (as passed to ``-fslgrad``). The phase-encoding scheme
+is the embedded ``pe_scheme``/``PhaseEncodingDirection`` of a MIF, or the
+``PhaseEncodingDirection`` of the JSON sidecar of a NIfTI.
+
+Shells are clustered as MRtrix does (``DWI::Shells``), so ``shell_bvalues`` gives the
+same shells as ``mrinfo -shell_bvalues``.
+
+Input discovery asks the same questions of the same raw images on every rerun, so the
+answers (``HeaderSummary``) can be kept in an SQLite index keyed on the path, size and
+mtime of each image (and of its sidecars). As with the file-hash cache, the index is
+opt-in: call ``enable_header_index`` (as the entry points do, next to their outputs) or
+set $AIS_HEADER_INDEX to the path of the database.
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import typing as ty
+from dataclasses import asdict, dataclass
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from australianimagingservice.mri.human.neuro.mif import read_mif_header
+
+logger = logging.getLogger("australianimagingservice.mri.human.neuro.image_header")
+
+# b-values up to this are treated as b=0 (MRtrix's BZeroThreshold default)
+BZERO_THRESHOLD = 10.0
+# Maximum difference between neighbouring b-values of the same shell
+SHELL_EPSILON = 80.0
+# Minimum number of volumes within SHELL_EPSILON of a b-value for it to seed a shell
+SHELL_MIN_LINKAGE = 3
+
+# Phase-encoding axis codes (as in BIDS sidecars) and the corresponding directions
+PE_AXES = {"i": 0, "j": 1, "k": 2}
+
+# Environment variable holding the path of the header index, which enables it (and is
+# inherited by worker processes)
+HEADER_INDEX_ENV = "AIS_HEADER_INDEX"
+# Name of the header index database when it is placed next to the outputs
+HEADER_INDEX_NAME = "image_headers.sqlite"
+# Bumped whenever the contents of HeaderSummary or the way they are derived change
+HEADER_INDEX_VERSION = 1
+
+
+@dataclass
+class ImageHeader:
+    """Geometry and diffusion/phase-encoding metadata of an image"""
+
+    path: Path
+    dims: tuple[int, ...]
+    vox: tuple[float, ...]
+    dw_scheme: ty.Optional[np.ndarray] = None  # N x 4 rows of (x, y, z, b)
+    pe_scheme: ty.Optional[np.ndarray] = None  # N x 3(+1) rows of (i, j, k[, t])
+    phase_encoding_direction: ty.Optional[str] = None
+
+    @property
+    def nvols(self) -> int:
+        """Number of volumes (1 for 3D images)"""
+        return self.dims[3] if len(self.dims) >= 4 else 1
+
+
+def _strip_image_ext(path: Path) -> str:
+    return re.sub(r"\.(nii|mif)(\.gz)?$", "", str(path))
+
+
+def _parse_rows(text: str) -> np.ndarray:
+    """Parse a newline-separated table of comma-separated numbers (as MRtrix writes
+    dw_scheme/pe_scheme into MIF headers)"""
+    return np.array(
+        [[float(v) for v in line.split(",")] for line in text.splitlines() if line],
+        dtype=float,
+    )
+
+
+def pe_scheme_from_direction(
+    direction: str, nvols: int, readout_time: ty.Optional[float] = None
+) -> np.ndarray:
+    """Expand a phase-encoding direction code (e.g. "j-") into a per-volume scheme"""
+    axis = PE_AXES[direction[0]]
+    row = [0.0, 0.0, 0.0]
+    row[axis] = -1.0 if direction.endswith("-") else 1.0
+    if readout_time is not None:
+        row.append(float(readout_time))
+    return np.tile(row, (nvols, 1))
+
+
+def _read_mif(path: Path) -> ImageHeader:
+    keyval = read_mif_header(path)
+    dims = tuple(int(d) for d in keyval["dim"].split(","))
+    header = ImageHeader(
+        path=path,
+        dims=dims,
+        vox=tuple(float(v) for v in keyval["vox"].split(",")),
+    )
+    if "dw_scheme" in keyval:
+        header.dw_scheme = _parse_rows(keyval["dw_scheme"])
+    direction = keyval.get("PhaseEncodingDirection")
+    if direction:
+        header.phase_encoding_direction = direction
+    if "pe_scheme" in keyval:
+        header.pe_scheme = _parse_rows(keyval["pe_scheme"])
+    elif direction in ("i", "i-", "j", "j-", "k", "k-"):
+        readout = keyval.get("TotalReadoutTime")
+        header.pe_scheme = pe_scheme_from_direction(
+            direction, header.nvols, float(readout) if readout else None
+        )
+    return header
+
+
+def _read_nifti(path: Path) -> ImageHeader:
+    nii_header = nib.load(str(path)).header
+    header = ImageHeader(
+        path=path,
+        dims=tuple(int(d) for d in nii_header.get_data_shape()),
+        vox=tuple(float(v) for v in nii_header.get_zooms()),
+    )
+    base = _strip_image_ext(path)
+    bval, bvec = Path(base + ".bval"), Path(base + ".bvec")
+    if bval.exists() and bvec.exists():
+        try:
+            bvals = np.loadtxt(bval, ndmin=1)
+            bvecs = np.loadtxt(bvec, ndmin=2)
+            if bvecs.shape[0] != 3 and bvecs.shape[1] == 3:
+                bvecs = bvecs.T
+            if bvecs.shape != (3, bvals.size):
+                raise ValueError(
+                    f"{bvec} {bvecs.shape} does not match {bval} ({bvals.size} values)"
+                )
+        except ValueError as e:
+            # As without -fslgrad, the image is still readable without its gradients
+            logger.warning("Ignoring the gradient table of %s: %s", path, e)
+        else:
+            header.dw_scheme = np.column_stack([bvecs.T, bvals])
+    sidecar = Path(base + ".json")
+    if sidecar.exists():
+        try:
+            with open(sidecar) as f:
+                metadata = json.load(f)
+        except ValueError:
+            metadata = {}
+        direction = str(metadata.get("PhaseEncodingDirection", "")).strip()
+        if direction:
+            header.phase_encoding_direction = direction
+        if direction in ("i", "i-", "j", "j-", "k", "k-"):
+            header.pe_scheme = pe_scheme_from_direction(
+                direction, header.nvols, metadata.get("TotalReadoutTime")
+            )
+    return header
+
+
+def read_image_header(path: ty.Union[str, Path]) -> ImageHeader:
+    """Read the header of a MIF, gzipped MIF or NIfTI image (not its voxel data),
+    along with its diffusion and phase-encoding schemes"""
+    path = Path(path)
+    if path.name.endswith((".mif", ".mif.gz")):
+        return _read_mif(path)
+    if path.name.endswith((".nii", ".nii.gz")):
+        return _read_nifti(path)
+    raise ValueError(f"Unrecognised image format '{path.name}'")
+
+
+def scaled_bvalues(dw_scheme: np.ndarray) -> np.ndarray:
+    """The b-values of a diffusion scheme, scaled by the squared norms of the gradient
+    directions when they aren't unit vectors (MRtrix's default b-value scaling)"""
+    bvalues = dw_scheme[:, 3].astype(float)
+    norms = np.linalg.norm(dw_scheme[:, :3], axis=1)
+    weighted = (bvalues > BZERO_THRESHOLD) & (norms > 0)
+    if weighted.any() and np.abs(norms[weighted] - 1.0).max() > 0.01:
+        bvalues = bvalues.copy()
+        bvalues[weighted] *= norms[weighted] ** 2
+    return bvalues
+
+
+def cluster_shells(bvalues: ty.Sequence[float]) -> list[list[int]]:
+    """Group volumes into shells by density-based clustering of their b-values, as
+    MRtrix does, returning the indices of the volumes of each shell in order of
+    increasing mean b-value. Volumes that can't be assigned to a shell are left out.
+
+    Raises
+    ------
+    ValueError
+        if the b-values don't form a shelled scheme
+    """
+    bvalues = np.asarray(bvalues, dtype=float)
+    clusters = np.zeros(bvalues.size, dtype=int)
+    visited = np.zeros(bvalues.size, dtype=bool)
+
+    def neighbours(b: float) -> list[int]:
+        return list(np.flatnonzero(np.abs(bvalues - b) < SHELL_EPSILON))
+
+    num_clusters = 0
+    for i, b in enumerate(bvalues):
+        if visited[i]:
+            continue
+        visited[i] = True
+        region = neighbours(b)
+        if b > BZERO_THRESHOLD and len(region) < SHELL_MIN_LINKAGE:
+            continue  # outlier, left in cluster 0
+        num_clusters += 1
+        clusters[i] = num_clusters
+        j = 0
+        while j < len(region):  # the region grows as it is expanded
+            n = region[j]
+            if not visited[n]:
+                visited[n] = True
+                expansion = neighbours(bvalues[n])
+                if len(expansion) >= SHELL_MIN_LINKAGE:
+                    region.extend(expansion)
+            if clusters[n] == 0:
+                clusters[n] = num_clusters
+            j += 1
+    if num_clusters < 1 or num_clusters > np.sqrt(bvalues.size):
+        raise ValueError("Gradient encoding matrix does not represent a HARDI sequence")
+    shells = [list(np.flatnonzero(clusters == c)) for c in range(1, num_clusters + 1)]
+    return sorted(shells, key=lambda volumes: bvalues[volumes].mean())
+
+
+def shell_bvalues(dw_scheme: np.ndarray) -> list[float]:
+    """Mean b-value of each shell of a diffusion scheme (cf. ``mrinfo -shell_bvalues``)"""
+    bvalues = scaled_bvalues(dw_scheme)
+    return [float(bvalues[volumes].mean()) for volumes in cluster_shells(bvalues)]
+
+
+def bzero_volumes(dw_scheme: np.ndarray) -> list[int]:
+    """Indices of the b=0 volumes of a diffusion scheme, i.e. of its lowest shell if
+    that is a b=0 shell (cf. ``dwiextract -bzero``)"""
+    bvalues = scaled_bvalues(dw_scheme)
+    shells = cluster_shells(bvalues)
+    if not shells or bvalues[shells[0]].mean() > BZERO_THRESHOLD:
+        return []
+    return [int(i) for i in shells[0]]
+
+
+def pe_directions(pe_scheme: np.ndarray) -> list[tuple[int, int, int]]:
+    """Phase-encoding direction of each volume of a scheme as a rounded axis vector"""
+    return [tuple(int(round(v)) for v in row[:3]) for row in pe_scheme]
+
+
+@dataclass
+class HeaderSummary:
+    """What input discovery needs to know about an image, as kept in the header index"""
+
+    dims: list[int]
+    vox: list[float]
+    # Mean b-value of each shell, None if there is no (shelled) gradient table
+    shell_bvalues: ty.Optional[list[float]]
+    # Phase-encoding directions of the volumes and how many volumes have each, in
+    # order of first appearance, None if there is no phase-encoding scheme
+    pe_counts: ty.Optional[list[tuple[tuple[int, int, int], int]]]
+    # PhaseEncodingDirection of the JSON sidecar of a NIfTI
+    sidecar_pe_direction: ty.Optional[str]
+
+    @property
+    def nvols(self) -> int:
+        """Number of volumes (1 for 3D images)"""
+        return self.dims[3] if len(self.dims) >= 4 else 1
+
+    @classmethod
+    def from_json(cls, text: str) -> "HeaderSummary":
+        summary = cls(**json.loads(text))
+        if summary.pe_counts is not None:
+            summary.pe_counts = [(tuple(v), n) for v, n in summary.pe_counts]
+        return summary
+
+
+def summarise_header(path: ty.Union[str, Path]) -> HeaderSummary:
+    """Read the header of an image and summarise it for input discovery"""
+    header = read_image_header(path)
+    bvalues = None
+    if header.dw_scheme is not None:
+        try:
+            bvalues = shell_bvalues(header.dw_scheme)
+        except ValueError:
+            pass  # not a shelled scheme
+    pe_counts = None
+    if header.pe_scheme is not None:
+        counts: dict[tuple[int, int, int], int] = {}
+        for vec in pe_directions(header.pe_scheme):
+            counts[vec] = counts.get(vec, 0) + 1
+        pe_counts = list(counts.items())
+    return HeaderSummary(
+        dims=list(header.dims),
+        vox=list(header.vox),
+        shell_bvalues=bvalues,
+        pe_counts=pe_counts,
+        sidecar_pe_direction=(
+            header.phase_encoding_direction
+            if header.path.name.endswith((".nii", ".nii.gz"))
+            else None
+        ),
+    )
+
+
+def _sidecar_signature(path: Path) -> str:
+    """(size, mtime_ns) of the sidecars an image's summary depends on"""
+    base = _strip_image_ext(path)
+    signature = []
+    for ext in (".bval", ".bvec", ".json"):
+        try:
+            stat = os.stat(base + ext)
+        except OSError:
+            signature.append("-")
+        else:
+            signature.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    return ",".join(signature)
+
+
+class HeaderIndex:
+    """SQLite database of header summaries keyed on the (absolute) path, size and
+    mtime_ns of each image, shared by all the processes that discover inputs"""
+
+    def __init__(self, path: ty.Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sidecars TEXT, "
+            "version INTEGER, summary TEXT)"
+        )
+
+    def summary(self, path: ty.Union[str, Path]) -> HeaderSummary:
+        """Summary of the image's header, read from the database if the image and its
+        sidecars are unchanged"""
+        path = Path(path).absolute()
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns, _sidecar_signature(path))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, sidecars, version, summary FROM headers "
+                "WHERE path=?",
+                (str(path),),
+            ).fetchone()
+        if row is not None and row[:4] == (*key, HEADER_INDEX_VERSION):
+            return HeaderSummary.from_json(row[4])
+        summary = summarise_header(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                (str(path), *key, HEADER_INDEX_VERSION, json.dumps(asdict(summary))),
+            )
+        return summary
+
+
+_HEADER_INDEX: ty.Optional[tuple[int, str, HeaderIndex]] = None
+_HEADER_INDEX_LOCK = threading.Lock()
+
+
+def enable_header_index(path: ty.Union[str, Path]) -> None:
+    """Keep header summaries in the SQLite database at ``path`` (in this process and
+    the worker processes it starts)"""
+    os.environ[HEADER_INDEX_ENV] = str(Path(path).absolute())
+
+
+def header_index() -> ty.Optional[HeaderIndex]:
+    """The header index of this process if it is enabled"""
+    global _HEADER_INDEX
+    path = os.environ.get(HEADER_INDEX_ENV)
+    if not path:
+        return None
+    with _HEADER_INDEX_LOCK:
+        if _HEADER_INDEX is None or _HEADER_INDEX[:2] != (os.getpid(), path):
+            try:
+                _HEADER_INDEX = (os.getpid(), path, HeaderIndex(path))
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Could not open header index '%s': %s", path, e)
+                return None
+        return _HEADER_INDEX[2]
+
+
+def image_summary(path: ty.Union[str, Path]) -> HeaderSummary:
+    """Summary of the header of an image, from the header index if enabled"""
+    index = header_index()
+    if index is not None:
+        try:
+            return index.summary(path)
+        except sqlite3.Error as e:
+            logger.warning("Header index lookup failed for '%s': %s", path, e)
+    return summarise_header(path)
@@ -0,0 +1,286 @@
+"""Minimal native writer for the MRtrix image format (.mif/.mif.gz), so that tasks that
+produce label images in Python can write their final outputs directly instead of
+shelling out to mrconvert"""
+
+import gzip
+import os
+import typing as ty
+from pathlib import Path
+import numpy as np
+from nibabel.orientations import io_orientation, inv_ornt_aff
+
+MIF_DATATYPES = {
+    np.dtype("int8"): "Int8",
+    np.dtype("uint8"): "UInt8",
+    np.dtype("<i2"): "Int16LE",
+    np.dtype("<u2"): "UInt16LE",
+    np.dtype("<i4"): "Int32LE",
+    np.dtype("<u4"): "UInt32LE",
+    np.dtype("<i8"): "Int64LE",
+    np.dtype("<u8"): "UInt64LE",
+    np.dtype("<f4"): "Float32LE",
+    np.dtype("<f8"): "Float64LE",
+}
+
+# MRtrix aligns the start of the image data after the header
+MIF_DATA_ALIGNMENT = 16
+
+
+def _format_number(value: float) -> str:
+    return np.format_float_positional(float(value), trim="-", precision=10)
+
+
+def mif_header(
+    data: np.ndarray, affine: np.ndarray, keyval: ty.Optional[dict[str, str]] = None
+) -> tuple[bytes, str]:
+    """Build the header of a MIF image whose voxel data is ``data`` stored in its
+    on-disk (i.e. NIfTI-style) order, with ``affine`` mapping its voxel indices to
+    scanner coordinates.
+
+    As MRtrix does when it opens a NIfTI, the image axes are realigned to be as close
+    as possible to RAS and the on-disk order is described by the layout (strides), so
+    the written image is indistinguishable from one converted by MRtrix.
+
+    Returns
+    -------
+    header : bytes
+        the header, padded so that the image data can be written straight after it
+    layout : str
+        the layout that was written into the header
+    """
+    dtype = data.dtype.newbyteorder("<") if data.dtype.itemsize > 1 else data.dtype
+    try:
+        datatype = MIF_DATATYPES[dtype]
+    except KeyError:
+        raise ValueError(f"Cannot write data of type {data.dtype} to MIF")
+    shape = data.shape
+    ornt = io_orientation(affine)
+    image_affine = affine @ inv_ornt_aff(ornt, shape[:3])
+    # Axes beyond the spatial ones (e.g. volumes) are stored as is
+    dims = [0] * len(shape)
+    layout = [""] * len(shape)
+    for file_axis, (image_axis, flip) in enumerate(ornt):
+        dims[int(image_axis)] = shape[file_axis]
+        layout[int(image_axis)] = ("-" if flip < 0 else "+") + str(file_axis)
+    for axis in range(3, len(shape)):
+        dims[axis] = shape[axis]
+        layout[axis] = f"+{axis}"
+    vox = np.sqrt((image_affine[:3, :3] ** 2).sum(axis=0))
+    rotation = image_affine[:3, :3] / vox
+    lines = [
+        "mrtrix image",
+        "dim: " + ",".join(str(d) for d in dims),
+        "vox: " + ",".join(_format_number(v) for v in [*vox, *[1] * (len(shape) - 3)]),
+        "layout: " + ",".join(layout),
+        "datatype: " + datatype,
+    ]
+    for row in range(3):
+        values = [*rotation[row], image_affine[row, 3]]
+        lines.append("transform: " + ",".join(_format_number(v) for v in values))
+    for key, value in (keyval or {}).items():
+        # Multi-line values (e.g. dw_scheme rows) are written as repeated keys
+        lines.extend(f"{key}: {line}" for line in str(value).split("\n"))
+    text = "\n".join(lines) + "\nfile: . "
+    # The offset is written into the header, so allow for the digits it adds
+    offset = len(text) + len("\nEND\n") + 8
+    offset += -offset % MIF_DATA_ALIGNMENT
+    text += str(offset) + "\nEND\n"
+    header = text.encode("ascii")
+    header += b"\0" * (offset - len(header))
+    return header, ",".join(layout)
+
+
+def save_mif(
+    path: ty.Union[str, Path],
+    data: np.ndarray,
+    affine: np.ndarray,
+    keyval: ty.Optional[dict[str, str]] = None,
+    compresslevel: int = 6,
+) -> Path:
+    """Write a MIF (or gzipped MIF if the path ends in '.gz') image atomically
+
+    Parameters
+    ----------
+    path : str or Path
+        the path to write the image to
+    data : np.ndarray
+        the voxel data, in on-disk order (as returned by nibabel)
+    affine : np.ndarray
+        the voxel -> scanner affine of the data
+    keyval : dict[str, str], optional
+        additional key-value pairs to write into the header
+    compresslevel : int
+        the gzip compression level used for '.mif.gz' files
+    """
+    path = Path(path)
+    header, _ = mif_header(data, affine, keyval)
+    dtype = data.dtype.newbyteorder("<") if data.dtype.itemsize > 1 else data.dtype
+    payload = np.asarray(data, dtype=dtype).tobytes(order="F")
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    if path.name.endswith(".gz"):
+        with gzip.open(tmp_path, "wb", compresslevel=compresslevel) as f:
+            f.write(header)
+            f.write(payload)
+    else:
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(payload)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _open_maybe_gzipped(path: Path) -> ty.BinaryIO:
+    return gzip.open(path, "rb") if path.name.endswith(".gz") else open(path, "rb")
+
+
+def read_mif_header(path: ty.Union[str, Path]) -> dict[str, ty.Any]:
+    """Read the key-value header of a MIF (or gzipped MIF) image, without reading its
+    voxel data. The three transform rows are returned as a list."""
+    path = Path(path)
+    header: dict[str, ty.Any] = {}
+    with _open_maybe_gzipped(path) as f:
+        magic = f.readline().decode("ascii", errors="replace").strip()
+        if magic != "mrtrix image":
+            raise ValueError(f"{path} is not a MIF image (magic line {magic!r})")
+        for raw in f:
+            line = raw.decode("utf-8", errors="replace").rstrip("\n")
+            if line == "END":
+                break
+            key, sep, value = line.partition(":")
+            if not sep:
+                continue
+            key, value = key.strip(), value.strip()
+            if key == "transform":
+                header.setdefault(key, []).append(value)
+            elif key in header:
+                # MRtrix joins the values of repeated keys (e.g. comments) by newlines
+                header[key] += "\n" + value
+            else:
+                header[key] = value
+        else:
+            raise ValueError(f"{path} has no END line in its MIF header")
+    return header
+
+
+def _parse_layout(layout: str) -> list[tuple[int, bool]]:
+    """Parse a MIF layout into (stride rank, flipped) pairs for each image axis"""
+    return [(int(s.lstrip("+-")), s.startswith("-")) for s in layout.split(",")]
+
+
+def _storage(
+    header: dict[str, ty.Any], path: Path
+) -> tuple[list[int], list[tuple[int, bool]], np.dtype, int, np.ndarray]:
+    """Dimensions, layout, datatype, data offset and (image-order) affine of a MIF"""
+    dims = [int(d) for d in header["dim"].split(",")]
+    vox = [float(v) for v in header["vox"].split(",")]
+    layout = _parse_layout(header["layout"])
+    dtype = _mif_dtype(header["datatype"])
+    file_name, _, offset = header["file"].partition(" ")
+    if file_name != ".":
+        raise ValueError(f"Separate data files are not supported ({path})")
+    transform = np.eye(4)
+    transform[:3] = [[float(v) for v in t.split(",")] for t in header["transform"]]
+    image_affine = transform.copy()
+    image_affine[:3, :3] = transform[:3, :3] * vox[:3]
+    return dims, layout, dtype, int(offset), image_affine
+
+
+def storage_axes(header: dict[str, ty.Any]) -> list[int]:
+    """The image axes of a MIF in the order they are stored (fastest varying first)"""
+    layout = _parse_layout(header["layout"])
+    return sorted(range(len(layout)), key=lambda a: layout[a][0])
+
+
+def storage_affine(header: dict[str, ty.Any]) -> np.ndarray:
+    """The voxel -> scanner affine of the spatial axes of a MIF in the order (and
+    direction) they are stored, i.e. of the data returned by ``load_mif``"""
+    dims, layout, _, _, image_affine = _storage(header, Path(""))
+    spatial = sorted(range(3), key=lambda a: layout[a][0])
+    # Map storage voxel indices onto image voxel indices
+    storage_to_image = np.zeros((4, 4))
+    storage_to_image[3, 3] = 1
+    for storage_axis, image_axis in enumerate(spatial):
+        if layout[image_axis][1]:
+            storage_to_image[image_axis, storage_axis] = -1
+            storage_to_image[image_axis, 3] = dims[image_axis] - 1
+        else:
+            storage_to_image[image_axis, storage_axis] = 1
+    return image_affine @ storage_to_image
+
+
+def load_mif(path: ty.Union[str, Path]) -> tuple[np.ndarray, np.ndarray]:
+    """Load the voxel data of a MIF (or gzipped MIF) image in its on-disk order, along
+    with the voxel -> scanner affine of that order, i.e. the counterpart of
+    ``save_mif`` (saving the returned data and affine reproduces the image's layout)
+
+    Only images stored in the same file as the header (i.e. "file: . <offset>") are
+    supported.
+    """
+    path = Path(path)
+    header = read_mif_header(path)
+    dims, layout, dtype, offset, _ = _storage(header, path)
+
+    with _open_maybe_gzipped(path) as f:
+        f.seek(offset)
+        buffer = f.read(int(np.prod(dims)) * dtype.itemsize)
+    # Storage order is by increasing stride rank; the spatial axes are kept first so
+    # that the returned array follows the NIfTI convention
+    spatial = sorted(range(3), key=lambda a: layout[a][0])
+    others = sorted(range(3, len(dims)), key=lambda a: layout[a][0])
+    axes = storage_axes(header)
+    data = np.frombuffer(buffer, dtype=dtype).reshape(
+        [dims[a] for a in axes], order="F"
+    )
+    data = data.transpose([axes.index(a) for a in spatial + others])
+    return data, storage_affine(header)
+
+
+def iter_mif_slabs(
+    path: ty.Union[str, Path], only: ty.Optional[ty.Collection[int]] = None
+) -> ty.Iterator[tuple[int, np.ndarray]]:
+    """Read the voxel data of a MIF (or gzipped MIF) one slab at a time, i.e. one
+    index of its slowest-varying storage axis (a volume for volume-contiguous DWI, or
+    a slice with all its volumes otherwise), so that memory use is bounded by a slab
+
+    Parameters
+    ----------
+    path : str or Path
+        the image to read
+    only : Collection[int], optional
+        the indices along the slowest axis to read (the others are skipped)
+
+    Yields
+    ------
+    index : int
+        the index of the slab along the slowest storage axis
+    slab : np.ndarray
+        the slab, with the remaining axes in storage order (``storage_axes`` without
+        the last)
+    """
+    path = Path(path)
+    header = read_mif_header(path)
+    dims, _, dtype, offset, _ = _storage(header, path)
+    axes = storage_axes(header)
+    shape = [dims[a] for a in axes[:-1]]
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    with _open_maybe_gzipped(path) as f:
+        f.seek(offset)
+        for index in range(dims[axes[-1]]):
+            if only is not None and index not in only:
+                f.seek(nbytes, os.SEEK_CUR)
+                continue
+            buffer = f.read(nbytes)
+            if len(buffer) != nbytes:
+                raise ValueError(f"{path} is truncated")
+            yield index, np.frombuffer(buffer, dtype=dtype).reshape(shape, order="F")
+
+
+def _mif_dtype(datatype: str) -> np.dtype:
+    for dtype, name in MIF_DATATYPES.items():
+        if name == datatype:
+            return dtype
+    if datatype.endswith("BE"):
+        return _mif_dtype(datatype[:-2] + "LE").newbyteorder(">")
+    if datatype == "Bit":
+        raise ValueError("Bit-packed MIF images are not supported")
+    raise ValueError(f"Unrecognised MIF datatype {datatype!r}")
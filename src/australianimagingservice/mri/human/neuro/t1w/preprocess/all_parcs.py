@@ -1,44 +1,66 @@
+import os
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from fileformats.generic import File, Directory
 from fileformats.medimage import NiftiGz
 from fileformats.vendor.mrtrix3.medimage.image import ImageFormat as Mif, ImageFormatGz
 from pydra.compose import workflow, python
+from australianimagingservice.mri.human.neuro.cache_gc import (
+    DEFAULT_MIN_AGE,
+    collect_garbage,
+    task_dirs,
+)
+from australianimagingservice.mri.human.neuro.fileops import (
+    gzip_file,
+    place_file,
+    place_tree,
+)
+from australianimagingservice.mri.human.neuro.hashing import (
+    HASH_CACHE_ENV,
+    HASH_CACHE_NAME,
+    enable_hash_cache,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer import (
+    FastsurferStage,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.first import (
+    FirstSegmentation,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fivett import (
+    FivettStage,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.surface import (
+    SurfaceCorrespondence,
+    RibbonProjection,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.registry import (
+    PARCELLATIONS,
+    get_parcellation,
+    select_parcellations,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.stats import (
+    REGION_STATS_NAME,
+    write_region_stats,
+)
 from australianimagingservice.mri.human.neuro.t1w.preprocess.single_parc import (
     SingleParcellation,
 )
 
-parcellation_list = [
-    "aparca2009s",
-    "aparc",
-    "desikan",
-    "destrieux",
-    "economo",
-    "glasser360",
-    "hcpmmp1",
-    "schaefer100",
-    "schaefer1000",
-    "schaefer200",
-    "schaefer300",
-    "schaefer400",
-    "schaefer500",
-    "schaefer600",
-    "schaefer700",
-    "schaefer800",
-    "schaefer900",
-    "vosdewael100",
-    "vosdewael200",
-    "vosdewael300",
-    "vosdewael400",
-    "Yeo17",
-    "Yeo7",
-]
+parcellation_list = list(PARCELLATIONS)
+
+# Parcellations whose sub-cortical grey matter is replaced with FIRST's segmentation
+sgm_parcellations = [p for p, e in PARCELLATIONS.items() if e.replaces_sgm]
 
 # ---------------------------------- #
 #  FinalizeOutputs input type map    #
 # ---------------------------------- #
-_finalize_inputs: dict = {p: Mif | ImageFormatGz for p in parcellation_list}
+# Parcellations that weren't selected are left unset
+_finalize_inputs: dict = {
+    p: python.arg(type=Mif | ImageFormatGz | None, default=None)
+    for p in parcellation_list
+}
 _finalize_inputs.update(
     {
         "out_dir": Path | None,
@@ -59,25 +81,37 @@ def _lut_src(
     parcellation: str, resources_dir: Path, mrtrix_lut_dir: Path
 ) -> Path | None:
     """Return the MRtrix3 LUT file path for a given parcellation."""
-    neuro = resources_dir / "neuro-parcellations"
-    if (
-        "schaefer" in parcellation
-        or "aparc" in parcellation
-        or "vosdewael" in parcellation
-        or parcellation in ("economo", "glasser360")
-    ):
-        return neuro / f"{parcellation}_reordered_LUT.txt"
-    elif parcellation == "desikan":
-        return mrtrix_lut_dir / "fs_default.txt"
-    elif parcellation == "destrieux":
-        return mrtrix_lut_dir / "fs_a2009s.txt"
-    elif parcellation == "hcpmmp1":
-        return neuro / "hcpmmp1_ordered.txt"
-    elif parcellation == "Yeo7":
-        return neuro / "Yeo2011_7N_split.txt"
-    elif parcellation == "Yeo17":
-        return neuro / "Yeo2011_17N_split.txt"
-    return None
+    entry = PARCELLATIONS.get(parcellation)
+    if entry is None:
+        return None
+    root, relpath = entry.mrtrix_lut
+    roots = {"resources": resources_dir, "mrtrix_lut_dir": mrtrix_lut_dir}
+    return roots[root] / relpath
+
+
+# Upper bound on the number of conversions/copies FinalizeOutputs runs concurrently
+FINALIZE_MAX_WORKERS = 8
+
+
+def _finalize_image(src: Path, dest: Path, threads: int | None = None) -> None:
+    """Place an image at a .mif.gz destination, only converting it if necessary"""
+    if src.name.endswith(".mif.gz"):
+        place_file(src, dest)
+    elif src.name.endswith(".mif"):
+        # A .mif.gz is just the gzipped .mif, so there is no need to go via mrconvert
+        gzip_file(src, dest, threads=threads)
+    else:
+        # Convert to an uncompressed .mif and gzip it in parallel, rather than
+        # letting mrconvert gzip it on a single core
+        tmp = dest.with_name(f".{dest.name[: -len('.gz')]}.{os.getpid()}.tmp.mif")
+        try:
+            subprocess.run(
+                ["mrconvert", str(src), str(tmp), "-quiet", "-force"],
+                check=True,
+            )
+            gzip_file(tmp, dest, threads=threads)
+        finally:
+            tmp.unlink(missing_ok=True)
 
 
 @python.define(inputs=_finalize_inputs, outputs=["out_dir"])
@@ -94,7 +128,9 @@ def FinalizeOutputs(
     mrtrix_lut_dir: "Directory | None" = None,
     **parcs: "Mif | ImageFormatGz",
 ) -> "Directory":
-    """Collect all pipeline outputs into a structured output directory."""
+    """Collect all pipeline outputs into a structured output directory, along with a
+    table of the voxel count, volume and mean norm.mgz intensity of every region of
+    every atlas (region_stats.csv)."""
     if out_dir is None:
         out_dir = Path("./final_outputs").absolute()
     out_dir = Path(out_dir)
@@ -107,12 +143,14 @@ def FinalizeOutputs(
     for d in (atlases_dir, ftt_dir, lut_dir):
         d.mkdir(parents=True, exist_ok=True)
 
+    jobs = []
+
+    parcs = {n: p for n, p in parcs.items() if p is not None}
+
     # Parcellations → Atlases/Atlas_{name}.mif.gz
     for name, parc in parcs.items():
-        dest = atlases_dir / f"Atlas_{name}.mif.gz"
-        subprocess.run(
-            ["mrconvert", str(parc), str(dest), "-quiet", "-force"],
-            check=True,
+        jobs.append(
+            (_finalize_image, Path(str(parc)), atlases_dir / f"Atlas_{name}.mif.gz")
         )
 
     # 5TT and visualisation images → 5TTimages/
@@ -126,11 +164,7 @@ def FinalizeOutputs(
     }
     for name, img in ftt_images.items():
         if img is not None:
-            dest = ftt_dir / f"{name}.mif.gz"
-            subprocess.run(
-                ["mrconvert", str(img), str(dest), "-quiet", "-force"],
-                check=True,
-            )
+            jobs.append((_finalize_image, Path(str(img)), ftt_dir / f"{name}.mif.gz"))
 
     # LUT files → LUT/{parcellation}_LUT.txt
     resources_path = Path(str(resources_dir))
@@ -142,13 +176,56 @@ def FinalizeOutputs(
     for name in parcs:
         src = _lut_src(name, resources_path, mrtrix_lut_path)
         if src is not None and src.exists():
-            shutil.copy(src, lut_dir / f"{name}_LUT.txt")
+            # Copied rather than linked so the outputs don't alias the resources
+            jobs.append((shutil.copy, src, lut_dir / f"{name}_LUT.txt"))
 
-    # FreeSurfer outputs → FS_outputs/
+    # FreeSurfer outputs → FS_outputs/ (files from a previous run that are unchanged
+    # are left in place rather than deleted and copied again)
     if fastsurfer_dir is not None:
-        if fs_dest.exists():
-            shutil.rmtree(fs_dest)
-        shutil.copytree(str(fastsurfer_dir), str(fs_dest))
+        jobs.append((place_tree, Path(str(fastsurfer_dir)), fs_dest))
+
+    cpus = os.cpu_count() or 1
+    max_workers = max(1, min(FINALIZE_MAX_WORKERS, cpus, len(jobs)))
+    # Share the cores between the images that are being compressed concurrently
+    threads = max(1, cpus // max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            (
+                pool.submit(func, src, dest, threads=threads)
+                if func is _finalize_image
+                else pool.submit(func, src, dest)
+            )
+            for func, src, dest in jobs
+        ]
+        # Region table of all atlases → region_stats.csv (next to LUT/), computed
+        # in-process from the (uncompressed) parcellations while they are placed
+        if parcs:
+            intensity_image = None
+            if fastsurfer_dir is not None:
+                mri_dir = Path(str(fastsurfer_dir)) / "mri"
+                # orig.mgz when FastSurfer was run without recon-surf (seg_only)
+                intensity_image = next(
+                    (
+                        mri_dir / n
+                        for n in ("norm.mgz", "orig.mgz")
+                        if (mri_dir / n).exists()
+                    ),
+                    None,
+                )
+            futures.append(
+                pool.submit(
+                    write_region_stats,
+                    {name: Path(str(parc)) for name, parc in parcs.items()},
+                    {
+                        name: _lut_src(name, resources_path, mrtrix_lut_path)
+                        for name in parcs
+                    },
+                    intensity_image,
+                    out_dir / REGION_STATS_NAME,
+                )
+            )
+        for future in futures:
+            future.result()
 
     return Directory(out_dir)
 
@@ -167,18 +244,95 @@ def AllParcellations(
     fastsurfer_batch: int = 16,
     labelsgmfirst_executable: str = "labelsgmfix",
     fastsurfer_nthreads: int = 24,
+    parcellations: list[str] | None = None,
+    fastsurfer_store: Path | None = None,
+    seg_only: bool = False,
 ) -> Directory:
+    """Generate the selected parcellations (all of those in the registry by default),
+    along with the 5TT images, for a single T1-weighted image.
+
+    With ``seg_only``, FastSurfer is run without recon-surf (minutes rather than hours)
+    and only the atlases and 5TT algorithms that don't need its surfaces are generated,
+    i.e. desikan (from FastSurferCNN's DKT labels) and the freesurfer 5TT image.
+    """
+
+    selected = [
+        get_parcellation(p) for p in select_parcellations(parcellations, seg_only)
+    ]
+    templates = sorted({e.template for e in selected if e.is_surface})
+
+    # FastSurfer is hoisted out of the per-parcellation branches so that it is run
+    # exactly once per subject, regardless of how many atlases are generated from it
+    fastsurfer = workflow.add(
+        FastsurferStage(
+            t1w=t1w,
+            fs_license=fs_license,
+            subjects_dir=subjects_dir,
+            in_fastsurfer_container=in_fastsurfer_container,
+            fastsurfer_batch=fastsurfer_batch,
+            fastsurfer_nthreads=fastsurfer_nthreads,
+            fastsurfer_store=fastsurfer_store,
+            seg_only=seg_only,
+        )
+    )
+
+    # The 5TT images only depend on the FastSurfer outputs, so generate them once per
+    # subject rather than within each parcellation branch
+    fivett = workflow.add(
+        FivettStage(
+            fastsurfer_dir=fastsurfer.subjects_dir_output,
+            norm_img=fastsurfer.norm_img,
+            aparcaseg_img=fastsurfer.aparcaseg_img,
+            seg_only=seg_only,
+        )
+    )
+
+    # The subject <-> fsaverage vertex correspondence and the ribbon voxel -> vertex
+    # projection are shared by every surface-based atlas, so build them once and let
+    # each branch map its annotations onto the subject (and into the volume) with them
+    if templates:
+        surface_correspondence = workflow.add(
+            SurfaceCorrespondence(
+                fastsurfer_dir=fastsurfer.subjects_dir_output,
+                freesurfer_home=freesurfer_home,
+                templates=tuple(templates),
+            )
+        )
+        ribbon_projection = workflow.add(
+            RibbonProjection(fastsurfer_dir=fastsurfer.subjects_dir_output)
+        )
+
+    # FIRST is likewise run once and its segmentation shared by every parcellation that
+    # has its sub-cortical grey matter replaced
+    if any(e.replaces_sgm for e in selected):
+        first = workflow.add(
+            FirstSegmentation(
+                fastsurfer_dir=fastsurfer.subjects_dir_output,
+                # without recon-surf there is no skull-stripped norm.mgz
+                premasked=not seg_only,
+                sgm_amyg_hipp=True,
+                t1_image="orig.mgz" if seg_only else "norm.mgz",
+            )
+        )
 
     finalize = workflow.add(
         FinalizeOutputs(
             out_dir=output_dir,
             resources_dir=resources_dir,
             mrtrix_lut_dir=mrtrix_lut_dir,
+            fastsurfer_dir=fastsurfer.subjects_dir_output,
+            ftt_fsl=fivett.ftt_image_fsl,
+            vis_fsl=fivett.vis_image_fsl,
+            ftt_freesurfer=fivett.ftt_image_freesurfer,
+            vis_freesurfer=fivett.vis_image_freesurfer,
+            ftt_hsvs=fivett.ftt_image_hsvs,
+            vis_hsvs=fivett.vis_image_hsvs,
         )
     )
 
     parcs = {}
-    for parcellation in parcellation_list:
+    for entry in selected:
+        parcellation = entry.name
         parcs[parcellation] = workflow.add(
             SingleParcellation(
                 t1w=t1w,
@@ -193,33 +347,56 @@ def AllParcellations(
                 fastsurfer_nthreads=fastsurfer_nthreads,
                 subjects_dir=subjects_dir,
                 labelsgmfirst_executable=labelsgmfirst_executable,
+                fastsurfer_dir=fastsurfer.subjects_dir_output,
+                generate_5tt=False,
+                first_sgm_image=first.sgm_image if entry.replaces_sgm else None,
+                seg_only=seg_only,
+                surface_correspondence=(
+                    surface_correspondence.correspondence if entry.is_surface else None
+                ),
+                ribbon_projection=(
+                    ribbon_projection.out_file if entry.is_surface else None
+                ),
             ),  # pyright: ignore[reportArgumentType]
             name=parcellation,
         )
         setattr(finalize.inputs, parcellation, parcs[parcellation].parc_image)
 
-    # Wire 5TT and FreeSurfer outputs into finalize (all parcellations share the same
-    # FastSurfer run, so any parcellation's outputs would give the same values here)
-    finalize.inputs.ftt_fsl = parcs["desikan"].ftt_image_fsl
-    finalize.inputs.vis_fsl = parcs["desikan"].vis_image_fsl
-    finalize.inputs.ftt_freesurfer = parcs["desikan"].ftt_image_freesurfer
-    finalize.inputs.vis_freesurfer = parcs["desikan"].vis_image_freesurfer
-    finalize.inputs.ftt_hsvs = parcs["desikan"].ftt_image_hsvs
-    finalize.inputs.vis_hsvs = parcs["desikan"].vis_image_hsvs
-    finalize.inputs.fastsurfer_dir = parcs["desikan"].fastsurfer_output
-
     return finalize.out_dir
 
 
 if __name__ == "__main__":
-    import glob
     import sys
-    import os
+
+    # Pull out options that take a value (--option value or --option=value)
+    _argv = sys.argv[1:]
+    _options: dict[str, str] = {}
+    for _opt in (
+        "--parcellations",
+        "--nthreads",
+        "--fastsurfer_store",
+        "--cache_budget",
+    ):
+        for i, a in enumerate(_argv):
+            if a == _opt and i + 1 < len(_argv):
+                _options[_opt] = _argv[i + 1]
+                del _argv[i : i + 2]
+                break
+            if a.startswith(_opt + "="):
+                _options[_opt] = a.split("=", 1)[1]
+                del _argv[i]
+                break
 
     # Separate flags (--flag) from positional arguments
-    _flags = {a for a in sys.argv[1:] if a.startswith("-")}
-    _pos = [sys.argv[0]] + [a for a in sys.argv[1:] if not a.startswith("-")]
+    _flags = {a for a in _argv if a.startswith("-")}
+    _pos = [sys.argv[0]] + [a for a in _argv if not a.startswith("-")]
     no_cleanup = "--no_cleanup" in _flags or "-no_cleanup" in _flags
+    seg_only = "--seg_only" in _flags
+    parcellations = (
+        [p.strip() for p in _options["--parcellations"].split(",") if p.strip()]
+        if "--parcellations" in _options
+        else None
+    )
 
     def get_arg(idx: int, env: str | None = None, default: str | None = None) -> str:
         if len(_pos) > idx and _pos[idx]:
@@ -236,7 +413,10 @@ if __name__ == "__main__":
             "Usage: python all_parcs.py <t1w.nii.gz> "
             "[subjects_dir] [freesurfer_home] [mrtrix_lut_dir] "
             "[cache_dir] [fs_license] [fastsurfer_python] "
-            "[resources_dir] [output_dir] [--no_cleanup]"
+            "[resources_dir] [output_dir] [--no_cleanup] "
+            "[--parcellations <name>,<name>,...] [--nthreads <n>] "
+            "[--fastsurfer_store <dir>] [--seg_only] [--cache_budget <size>]\n\n"
+            "Available parcellations: " + ", ".join(parcellation_list)
         )
         sys.exit(1)
 
@@ -259,12 +439,22 @@ if __name__ == "__main__":
         n_threads = len(os.sched_getaffinity(0))
     except AttributeError:
         n_threads = os.cpu_count() or 1
+    # An explicit thread count (e.g. from batch.py, which runs several subjects side
+    # by side) also caps the threads FastSurfer is given
+    fastsurfer_nthreads = 24
+    if "--nthreads" in _options:
+        n_threads = fastsurfer_nthreads = int(_options["--nthreads"])
     os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(n_threads)
     print(
         f"Detected {n_threads} usable CPU threads — "
         f"ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS set to {n_threads}"
     )
 
+    # Keep the digests of the inputs next to the cache (unless $AIS_HASH_CACHE points
+    # elsewhere), so that reruns don't re-read them to compute the checksums
+    if not os.environ.get(HASH_CACHE_ENV):
+        enable_hash_cache(cache_dir / HASH_CACHE_NAME)
+
     wf = AllParcellations(
         t1w=t1w,
         subjects_dir=subjects_dir,
@@ -274,24 +464,40 @@ if __name__ == "__main__":
         resources_dir=resources_dir,
         fastsurfer_python=fastsurfer_python,
         output_dir=output_dir,
+        fastsurfer_nthreads=fastsurfer_nthreads,
+        parcellations=parcellations,
+        fastsurfer_store=(
+            Path(_options["--fastsurfer_store"])
+            if "--fastsurfer_store" in _options
+            else None
+        ),
+        seg_only=seg_only,
     )
 
+    # Task directories already in the cache root belong to earlier (or concurrent)
+    # runs, so only the ones this run creates are cleaned up unconditionally
+    existing = {p.name for p in task_dirs(cache_dir)}
     result = wf(cache_root=cache_dir, rerun=False)
     final_dir = Path(str(result.out_dir))
     print(f"Workflow finished. Final outputs at: {final_dir}")
 
     if not no_cleanup:
+        # Evict the intermediate task directories least recently used first, down to
+        # the budget (nothing by default), keeping the expensive FastSurfer stages (and
+        # the subjects directory they wrote) so that later runs can reuse them. The
+        # cache root may be shared, so directories of other runs are only evicted if
+        # they haven't been used recently (they may still be in progress)
         print("Cleaning up intermediate pydra cache directories...")
-        for pattern in ["shell-*", "python-*", "workflow-*"]:
-            for d in glob.glob(str(cache_dir / pattern)):
-                d_path = Path(d)
-                # Never delete the final output directory or anything inside it
-                if not (d_path == final_dir or final_dir.is_relative_to(d_path)):
-                    shutil.rmtree(d_path, ignore_errors=True)
-        # Remove subjects_dir if it lives inside cache_dir (FS outputs already copied)
-        subjects_path = Path(subjects_dir)
-        if subjects_path.is_relative_to(cache_dir):
-            shutil.rmtree(subjects_path, ignore_errors=True)
-        print("Cleanup complete.")
+        report = collect_garbage(
+            cache_dir,
+            _options.get("--cache_budget", "0"),
+            min_age=DEFAULT_MIN_AGE,
+            protect=[final_dir],
+            owned=[p for p in task_dirs(cache_dir) if p.name not in existing],
+        )
+        print(
+            f"Cleanup complete: removed {len(report.evicted)} directories "
+            f"({report.freed / 1024**3:.1f} GB)."
+        )
     else:
         print("Skipping cleanup (--no_cleanup flag set).")
@@ -0,0 +1,447 @@
+"""Multi-subject driver for AllParcellations.
+
+Runs the ``all_parcs.py`` entry point for many T1-weighted images side by side, sizing
+the number of concurrent subjects from the CPUs this process may run on and a RAM
+budget, and splitting the CPUs between the concurrent subjects (i.e. between their
+FastSurfer instances). Each subject runs in its own process with its own log, so a
+failed (or out-of-memory killed) subject is reported without stopping the batch.
+
+Usage:
+
+    python -m australianimagingservice.mri.human.neuro.t1w.preprocess.batch \\
+        <t1w.nii.gz|glob|subjects.csv> [...] --work-dir <dir> --output-dir <dir> \\
+        [--freesurfer-home <dir>] [--mrtrix-lut-dir <dir>] [--fs-license <file>] \\
+        [--resources-dir <dir>] [--parcellations <name>,<name>,...] \\
+        [--mem-per-subject <GB>] [--mem-budget <GB>] [--min-threads <n>] \\
+        [--max-subjects <n>] [--fastsurfer-store <dir>] [--seg-only] [--no_cleanup]
+
+A CSV must have a "t1w" column and may have a "subject_id" column; otherwise the
+subject ID is taken from the file name of the T1w image.
+"""
+
+import argparse
+import csv
+import glob
+import logging
+import os
+import subprocess
+import sys
+import time
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from .registry import select_parcellations
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.batch"
+)
+
+# Peak resident memory of a single AllParcellations run (dominated by FastSurfer's
+# CPU inference and recon-surf), used to size the pool when no budget is given
+DEFAULT_MEM_PER_SUBJECT_GB = 16.0
+# Fewer threads than this per subject makes FastSurfer slower overall than running
+# the subjects one after another
+DEFAULT_MIN_THREADS = 4
+# Fraction of the physical memory the batch may use by default
+DEFAULT_MEM_FRACTION = 0.9
+
+NIFTI_EXTS = (".nii.gz", ".nii")
+
+
+@dataclass
+class SubjectJob:
+    """A single subject of the batch"""
+
+    subject_id: str
+    t1w: Path
+
+
+@dataclass
+class SubjectResult:
+    """The outcome of a subject's run"""
+
+    subject_id: str
+    t1w: Path
+    status: str  # "success" or "failed"
+    returncode: ty.Optional[int]
+    duration: float
+    output_dir: Path
+    log_file: Path
+    error: str = ""
+
+
+def _subject_id(t1w: Path) -> str:
+    name = t1w.name
+    for ext in NIFTI_EXTS:
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return t1w.stem
+
+
+def collect_jobs(specs: ty.Iterable[str]) -> list[SubjectJob]:
+    """Expand T1w paths, glob patterns and CSV files into the subjects of the batch
+
+    Raises
+    ------
+    ValueError
+        if a pattern/CSV doesn't match any images or two subjects share an ID
+    """
+    jobs: list[SubjectJob] = []
+    for spec in specs:
+        if spec.endswith(".csv"):
+            with open(spec, newline="") as f:
+                rows = list(csv.DictReader(f))
+            if rows and "t1w" not in rows[0]:
+                raise ValueError(f"Subjects CSV '{spec}' has no 't1w' column")
+            for row in rows:
+                t1w = Path(row["t1w"]).expanduser()
+                if not t1w.is_absolute():
+                    t1w = Path(spec).parent / t1w
+                jobs.append(SubjectJob(row.get("subject_id") or _subject_id(t1w), t1w))
+        elif glob.has_magic(spec):
+            matches = sorted(glob.glob(os.path.expanduser(spec)))
+            if not matches:
+                raise ValueError(f"'{spec}' did not match any images")
+            jobs.extend(SubjectJob(_subject_id(Path(m)), Path(m)) for m in matches)
+        else:
+            jobs.append(SubjectJob(_subject_id(Path(spec)), Path(spec).expanduser()))
+    seen: dict[str, Path] = {}
+    for job in jobs:
+        if job.subject_id in seen:
+            raise ValueError(
+                f"Subject ID '{job.subject_id}' is shared by {seen[job.subject_id]} "
+                f"and {job.t1w}, please provide a CSV with unique subject IDs"
+            )
+        seen[job.subject_id] = job.t1w
+    return jobs
+
+
+def available_cpus() -> int:
+    """Number of CPUs this process is allowed to run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def physical_memory_gb() -> ty.Optional[float]:
+    """Total physical memory of the host, if it can be determined"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def plan_pool(
+    n_subjects: int,
+    n_cpus: int,
+    mem_budget_gb: ty.Optional[float],
+    mem_per_subject_gb: float = DEFAULT_MEM_PER_SUBJECT_GB,
+    min_threads: int = DEFAULT_MIN_THREADS,
+    max_subjects: ty.Optional[int] = None,
+) -> tuple[int, int]:
+    """Choose how many subjects to run concurrently and how many threads each gets
+
+    Returns
+    -------
+    n_workers : int
+        the number of subjects to run side by side (at least 1)
+    threads_per_subject : int
+        the number of threads given to each subject (at least 1)
+    """
+    limits = [n_subjects, n_cpus // max(min_threads, 1)]
+    if mem_budget_gb is not None:
+        limits.append(int(mem_budget_gb // mem_per_subject_gb))
+    if max_subjects:
+        limits.append(max_subjects)
+    n_workers = max(1, min(limits))
+    return n_workers, max(1, n_cpus // n_workers)
+
+
+def run_subject(
+    job: SubjectJob,
+    n_threads: int,
+    work_dir: Path,
+    output_dir: Path,
+    all_parcs_args: ty.Sequence[str],
+    extra_flags: ty.Sequence[str] = (),
+) -> SubjectResult:
+    """Run AllParcellations on one subject in its own process, capturing its output in
+    <work_dir>/<subject_id>/all_parcs.log"""
+    subject_work = work_dir / job.subject_id
+    subject_work.mkdir(parents=True, exist_ok=True)
+    subject_out = output_dir / job.subject_id
+    log_file = subject_work / "all_parcs.log"
+    freesurfer_home, mrtrix_lut_dir, fs_license, resources_dir = all_parcs_args
+    cmd = [
+        sys.executable,
+        "-m",
+        "australianimagingservice.mri.human.neuro.t1w.preprocess.all_parcs",
+        str(job.t1w),
+        str(subject_work / "subjects"),
+        freesurfer_home,
+        mrtrix_lut_dir,
+        str(subject_work / "cache"),
+        fs_license,
+        "--nthreads",
+        str(n_threads),
+        *extra_flags,
+    ]
+    # The resources and output directories are passed through the environment, which
+    # all_parcs falls back to, so that fastsurfer_python is left at its default
+    env = dict(os.environ)
+    env.update(
+        RESOURCES_DIR=resources_dir,
+        OUTPUT_DIR=str(subject_out),
+        OMP_NUM_THREADS=str(n_threads),
+        ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(n_threads),
+        MRTRIX_NTHREADS=str(n_threads),
+    )
+    start = time.monotonic()
+    if not job.t1w.exists():
+        return SubjectResult(
+            job.subject_id,
+            job.t1w,
+            "failed",
+            None,
+            0.0,
+            subject_out,
+            log_file,
+            error=f"T1w image '{job.t1w}' does not exist",
+        )
+    logger.info("Starting %s with %d threads", job.subject_id, n_threads)
+    try:
+        with open(log_file, "w") as log:
+            returncode = subprocess.run(
+                cmd, stdout=log, stderr=subprocess.STDOUT, env=env
+            ).returncode
+    except OSError as e:
+        return SubjectResult(
+            job.subject_id,
+            job.t1w,
+            "failed",
+            None,
+            time.monotonic() - start,
+            subject_out,
+            log_file,
+            error=str(e),
+        )
+    duration = time.monotonic() - start
+    if returncode != 0:
+        # A negative return code means the process was killed (e.g. -9 by the OOM killer)
+        return SubjectResult(
+            job.subject_id,
+            job.t1w,
+            "failed",
+            returncode,
+            duration,
+            subject_out,
+            log_file,
+            error=f"exited with code {returncode}, see {log_file}",
+        )
+    return SubjectResult(
+        job.subject_id, job.t1w, "success", returncode, duration, subject_out, log_file
+    )
+
+
+def write_report(results: ty.Sequence[SubjectResult], report_file: Path) -> None:
+    """Write the per-subject outcomes of the batch to a CSV file"""
+    with open(report_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "subject_id",
+                "t1w",
+                "status",
+                "returncode",
+                "duration_s",
+                "output_dir",
+                "log_file",
+                "error",
+            ]
+        )
+        for r in results:
+            writer.writerow(
+                [
+                    r.subject_id,
+                    r.t1w,
+                    r.status,
+                    "" if r.returncode is None else r.returncode,
+                    f"{r.duration:.0f}",
+                    r.output_dir,
+                    r.log_file,
+                    r.error,
+                ]
+            )
+
+
+def run_batch(
+    jobs: ty.Sequence[SubjectJob],
+    work_dir: Path,
+    output_dir: Path,
+    all_parcs_args: ty.Sequence[str],
+    n_workers: int,
+    threads_per_subject: int,
+    extra_flags: ty.Sequence[str] = (),
+) -> list[SubjectResult]:
+    """Run the subjects of a batch ``n_workers`` at a time, returning their outcomes in
+    the order of ``jobs``. A failure is recorded and the batch carries on."""
+    results: dict[str, SubjectResult] = {}
+    # The subjects run in child processes, so threads are enough to supervise them
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {
+            pool.submit(
+                run_subject,
+                job,
+                threads_per_subject,
+                work_dir,
+                output_dir,
+                all_parcs_args,
+                extra_flags,
+            ): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:  # keep going whatever happened to this subject
+                result = SubjectResult(
+                    job.subject_id,
+                    job.t1w,
+                    "failed",
+                    None,
+                    0.0,
+                    output_dir / job.subject_id,
+                    work_dir / job.subject_id,
+                    error=repr(e),
+                )
+            results[job.subject_id] = result
+            logger.info(
+                "%s %s after %.0fs%s",
+                result.subject_id,
+                result.status,
+                result.duration,
+                f" ({result.error})" if result.error else "",
+            )
+    return [results[job.subject_id] for job in jobs]
+
+
+def main(argv: ty.Optional[ty.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Run AllParcellations on a batch of T1-weighted images"
+    )
+    parser.add_argument(
+        "t1w", nargs="+", help="T1w images, glob patterns or CSV files of subjects"
+    )
+    parser.add_argument("--work-dir", type=Path, required=True)
+    parser.add_argument("--output-dir", type=Path, required=True)
+    parser.add_argument(
+        "--freesurfer-home", default=os.environ.get("FREESURFER_HOME", "")
+    )
+    parser.add_argument(
+        "--mrtrix-lut-dir",
+        default=os.environ.get(
+            "MRTRIX_LUT_DIR", "/usr/local/mrtrix3/share/mrtrix3/labelconvert"
+        ),
+    )
+    parser.add_argument("--fs-license", default=os.environ.get("FS_LICENSE", ""))
+    parser.add_argument(
+        "--resources-dir",
+        default=os.environ.get(
+            "RESOURCES_DIR", str(Path(__file__).parents[7] / "resources")
+        ),
+    )
+    parser.add_argument("--parcellations", default=None)
+    parser.add_argument(
+        "--fastsurfer-store",
+        default=None,
+        help="shared store of FastSurfer outputs to reuse across subjects/runs",
+    )
+    parser.add_argument(
+        "--mem-per-subject",
+        type=float,
+        default=DEFAULT_MEM_PER_SUBJECT_GB,
+        help="peak memory of one subject's run (GB)",
+    )
+    parser.add_argument(
+        "--mem-budget",
+        type=float,
+        default=None,
+        help=f"memory the batch may use (GB), {DEFAULT_MEM_FRACTION:.0%} of RAM by default",
+    )
+    parser.add_argument("--min-threads", type=int, default=DEFAULT_MIN_THREADS)
+    parser.add_argument("--max-subjects", type=int, default=None)
+    parser.add_argument(
+        "--seg-only",
+        action="store_true",
+        help="run FastSurfer without recon-surf and only generate volumetric atlases",
+    )
+    parser.add_argument("--no_cleanup", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if not args.freesurfer_home:
+        parser.error("--freesurfer-home (or $FREESURFER_HOME) is required")
+    fs_license = args.fs_license or str(Path(args.freesurfer_home) / "license.txt")
+    extra_flags = ["--no_cleanup"] if args.no_cleanup else []
+    if args.seg_only:
+        extra_flags.append("--seg_only")
+    if args.parcellations:
+        names = [p.strip() for p in args.parcellations.split(",") if p.strip()]
+        select_parcellations(names, args.seg_only)  # fail fast on unknown names
+        extra_flags += ["--parcellations", ",".join(names)]
+    if args.fastsurfer_store:
+        extra_flags += [
+            "--fastsurfer_store",
+            str(Path(args.fastsurfer_store).absolute()),
+        ]
+
+    jobs = collect_jobs(args.t1w)
+    mem_budget = args.mem_budget
+    if mem_budget is None:
+        total = physical_memory_gb()
+        mem_budget = total * DEFAULT_MEM_FRACTION if total else None
+    n_cpus = available_cpus()
+    n_workers, n_threads = plan_pool(
+        len(jobs),
+        n_cpus,
+        mem_budget,
+        args.mem_per_subject,
+        args.min_threads,
+        args.max_subjects,
+    )
+    logger.info(
+        "Running %d subjects, %d at a time with %d threads each (%d CPUs, %s GB budget)",
+        len(jobs),
+        n_workers,
+        n_threads,
+        n_cpus,
+        f"{mem_budget:.0f}" if mem_budget else "unknown",
+    )
+
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    results = run_batch(
+        jobs,
+        args.work_dir.absolute(),
+        args.output_dir.absolute(),
+        [args.freesurfer_home, args.mrtrix_lut_dir, fs_license, args.resources_dir],
+        n_workers,
+        n_threads,
+        extra_flags,
+    )
+    report_file = args.output_dir / "batch_report.csv"
+    write_report(results, report_file)
+
+    failed = [r for r in results if r.status != "success"]
+    print(f"\n{len(results) - len(failed)}/{len(results)} subjects succeeded")
+    for r in failed:
+        print(f"  FAILED {r.subject_id}: {r.error}")
+    print(f"Report written to {report_file}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
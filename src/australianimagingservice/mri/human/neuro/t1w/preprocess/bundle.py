@@ -0,0 +1,298 @@
+"""Packed, indexed bundle of the parcellation resources (annotation label arrays and
+colour tables, lookup tables and compiled lookup arrays), so that the native
+parcellation tasks can start from memory-mapped arrays instead of opening and parsing
+dozens of small text/annotation files for every subject.
+
+The bundle is a single file laid out as
+
+    magic (8 bytes) | index length (8 bytes, little-endian) | JSON index | arrays
+
+where every array starts on a BUNDLE_ALIGNMENT boundary and the JSON index maps the
+key of each array to its offset, dtype and shape. Keys are the paths of the source
+files relative to the resources directory, with a suffix for each array, e.g.
+
+    mica-mni-parcellations/lh.aparc_mics.annot:labels
+    neuro-parcellations/fs_default.txt:indices
+    <lut_in>|<lut_out>:mapping
+
+Build it with
+
+    python -m australianimagingservice.mri.human.neuro.t1w.preprocess.bundle <resources_dir>
+"""
+
+import functools
+import json
+import logging
+import os
+import sys
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel.freesurfer.io as fsio
+from australianimagingservice.mri.human.neuro.hashing import file_digest
+from .registry import PARCELLATIONS, ParcellationEntry
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.bundle"
+)
+
+BUNDLE_MAGIC = b"AISBNDL1"
+BUNDLE_ALIGNMENT = 64
+# Name of the bundle within the resources directory
+BUNDLE_NAME = "resources.bundle"
+# Lookup-table files that are packed (in addition to those referenced by the registry)
+LUT_PATTERNS = (
+    "neuro-parcellations/*.txt",
+    "*/lut/*.csv",
+    "yeo2011-parcellations/*LUT.txt",
+)
+
+
+def bundle_path(resources_dir: ty.Union[str, Path]) -> Path:
+    """Default location of the bundle within a resources directory"""
+    return Path(resources_dir) / BUNDLE_NAME
+
+
+def find_bundle(resources_dir: ty.Union[str, Path, None]) -> ty.Optional[Path]:
+    """Return the bundle of a resources directory if one has been built"""
+    if resources_dir is None:
+        return None
+    path = bundle_path(resources_dir)
+    return path if path.exists() else None
+
+
+def _names_array(names: ty.Iterable[str]) -> np.ndarray:
+    return np.frombuffer("\n".join(names).encode("utf-8"), dtype=np.uint8)
+
+
+def _registry_files(
+    resources_dir: Path, entries: ty.Iterable[ParcellationEntry]
+) -> tuple[list[str], list[str], list[tuple[str, str]]]:
+    """The annotation and LUT files of the registry entries that live in the
+    resources directory, and the (lut_in, lut_out) pairs that can be precompiled"""
+    annots, luts, pairs = [], [], []
+    for entry in entries:
+        if entry.source_annot and entry.source_annot[0] == "resources":
+            annots.extend(entry.source_annot[1].format(hemi=h) for h in ("lh", "rh"))
+        in_res = [
+            p[1] for p in (entry.parc_lut, entry.mrtrix_lut) if p[0] == "resources"
+        ]
+        luts.extend(in_res)
+        if len(in_res) == 2:
+            pairs.append(tuple(in_res))
+    return annots, luts, pairs
+
+
+def build_bundle(
+    resources_dir: ty.Union[str, Path],
+    out_file: ty.Union[str, Path, None] = None,
+) -> Path:
+    """Pack the annotations and lookup tables in a resources directory into a single
+    indexed bundle (written atomically)
+
+    Parameters
+    ----------
+    resources_dir : str or Path
+        the resources directory of the package
+    out_file : str or Path, optional
+        where to write the bundle, by default BUNDLE_NAME in the resources directory
+
+    Returns
+    -------
+    out_file : Path
+        the path of the written bundle
+    """
+    # The native tasks import the loader, so the parsers are imported here
+    from .labels import lut_mapping, parse_lut
+
+    resources_dir = Path(resources_dir)
+    out_file = Path(out_file) if out_file else bundle_path(resources_dir)
+    annots, luts, pairs = _registry_files(resources_dir, PARCELLATIONS.values())
+    for pattern in LUT_PATTERNS:
+        luts.extend(
+            str(p.relative_to(resources_dir)) for p in resources_dir.glob(pattern)
+        )
+    annots.extend(
+        str(p.relative_to(resources_dir)) for p in resources_dir.glob("*/*.annot")
+    )
+
+    arrays: dict[str, np.ndarray] = {}
+    for rel in sorted(set(annots)):
+        if not (resources_dir / rel).exists():
+            logger.warning("Skipping missing annotation '%s'", rel)
+            continue
+        labels, ctab, names = fsio.read_annot(str(resources_dir / rel))
+        arrays[f"{rel}:labels"] = labels.astype(np.int32)
+        arrays[f"{rel}:ctab"] = ctab.astype(np.int32)
+        arrays[f"{rel}:names"] = _names_array(
+            n.decode() if isinstance(n, bytes) else n for n in names
+        )
+    for rel in sorted(set(luts)):
+        if not (resources_dir / rel).exists():
+            logger.warning("Skipping missing lookup table '%s'", rel)
+            continue
+        lut = parse_lut(resources_dir / rel)
+        arrays[f"{rel}:indices"] = np.array([i for i, _ in lut], dtype=np.int64)
+        arrays[f"{rel}:names"] = _names_array(n for _, n in lut)
+    for lut_in, lut_out in sorted(set(pairs)):
+        if f"{lut_in}:indices" in arrays and f"{lut_out}:indices" in arrays:
+            arrays[f"{lut_in}|{lut_out}:mapping"] = lut_mapping(
+                resources_dir / lut_in, resources_dir / lut_out
+            )
+
+    # The content digest of each packed file, so that stale entries are never served
+    # (whatever the mtimes the resources were installed/checked out with)
+    sources = {}
+    for key in arrays:
+        rel = key.rpartition(":")[0]
+        for src in rel.split("|"):
+            sources[src] = file_digest(resources_dir / src)
+
+    # Lay the arrays out after the index, which has to be sized first
+    index: dict[str, ty.Any] = {
+        "sources": sources,
+        "arrays": {
+            k: {"dtype": a.dtype.str, "shape": list(a.shape), "offset": 0}
+            for k, a in arrays.items()
+        },
+    }
+    header_len = len(BUNDLE_MAGIC) + 8 + len(json.dumps(index)) + 32 * len(arrays)
+    offset = header_len + (-header_len % BUNDLE_ALIGNMENT)
+    for key, array in arrays.items():
+        index["arrays"][key]["offset"] = offset
+        offset += array.nbytes
+        offset += -offset % BUNDLE_ALIGNMENT
+    index_bytes = json.dumps(index).encode("utf-8")
+    if len(BUNDLE_MAGIC) + 8 + len(index_bytes) > header_len:
+        raise RuntimeError("Bundle index overflowed its reserved space")
+
+    tmp_path = out_file.with_name(f".{out_file.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(len(index_bytes).to_bytes(8, "little"))
+        f.write(index_bytes)
+        for key, array in arrays.items():
+            f.seek(index["arrays"][key]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, out_file)
+    logger.info("Packed %d arrays into '%s'", len(arrays), out_file)
+    return out_file
+
+
+class ResourceBundle:
+    """Read-only view of a bundle built by ``build_bundle``. The file is memory-mapped
+    once and every array is served as a zero-copy view into the mapping.
+
+    Lookups take the absolute paths that the tasks are given and return None if the
+    file is not in the bundle (e.g. LUTs in the MRtrix/FreeSurfer directories), so
+    that callers can fall back to reading the file itself.
+    """
+
+    def __init__(self, path: ty.Union[str, Path]):
+        self.path = Path(path)
+        self.root = self.path.parent.resolve()
+        self._mmap = np.memmap(self.path, dtype=np.uint8, mode="r")
+        if bytes(self._mmap[: len(BUNDLE_MAGIC)]) != BUNDLE_MAGIC:
+            raise ValueError(f"{self.path} is not a resources bundle")
+        start = len(BUNDLE_MAGIC) + 8
+        index_len = int.from_bytes(
+            bytes(self._mmap[len(BUNDLE_MAGIC) : start]), "little"
+        )
+        index = json.loads(bytes(self._mmap[start : start + index_len]))
+        self.sources = index["sources"]
+        self.index = index["arrays"]
+        # (size, mtime_ns) of the files whose digests have been checked against sources
+        self._verified: dict[str, tuple[int, int]] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def array(self, key: str) -> np.ndarray:
+        """Zero-copy (read-only) view of an array in the bundle"""
+        spec = self.index[key]
+        return np.ndarray(
+            shape=tuple(spec["shape"]),
+            dtype=np.dtype(spec["dtype"]),
+            buffer=self._mmap,
+            offset=spec["offset"],
+        )
+
+    def _names(self, key: str) -> list[str]:
+        names = bytes(self.array(key)).decode("utf-8")
+        return names.split("\n") if names else []
+
+    def key_for(self, path: ty.Union[str, Path]) -> ty.Optional[str]:
+        """The key prefix of a file in the resources directory, or None if it is not
+        in the bundle or its contents have changed since the bundle was built (each
+        file is only rehashed when its size or mtime changes)"""
+        try:
+            key = Path(path).resolve().relative_to(self.root).as_posix()
+            stat = os.stat(path)
+        except (ValueError, OSError):
+            return None
+        if key not in self.sources:
+            return None
+        if self._verified.get(key) != (stat.st_size, stat.st_mtime_ns):
+            if file_digest(path) != self.sources[key]:
+                return None
+            self._verified[key] = (stat.st_size, stat.st_mtime_ns)
+        return key
+
+    def annotation(
+        self, path: ty.Union[str, Path]
+    ) -> ty.Optional[tuple[np.ndarray, np.ndarray, list[str]]]:
+        """The (labels, ctab, names) of an annotation, as returned by
+        nibabel.freesurfer.io.read_annot"""
+        key = self.key_for(path)
+        if key is None or f"{key}:labels" not in self:
+            return None
+        return (
+            self.array(f"{key}:labels"),
+            self.array(f"{key}:ctab"),
+            self._names(f"{key}:names"),
+        )
+
+    def lut(self, path: ty.Union[str, Path]) -> ty.Optional[list[tuple[int, str]]]:
+        """The (index, name) entries of a lookup table, as returned by ``parse_lut``"""
+        key = self.key_for(path)
+        if key is None or f"{key}:indices" not in self:
+            return None
+        indices = self.array(f"{key}:indices").tolist()
+        return list(zip(indices, self._names(f"{key}:names")))
+
+    def lut_mapping(
+        self, lut_in: ty.Union[str, Path], lut_out: ty.Union[str, Path]
+    ) -> ty.Optional[np.ndarray]:
+        """The dense lookup array of a (lut_in, lut_out) pair, as returned by
+        ``lut_mapping``"""
+        key_in, key_out = self.key_for(lut_in), self.key_for(lut_out)
+        key = f"{key_in}|{key_out}:mapping"
+        if key_in is None or key_out is None or key not in self:
+            return None
+        return self.array(key)
+
+
+@functools.lru_cache(maxsize=4)
+def _open_bundle(path: str, mtime_ns: int) -> ResourceBundle:
+    return ResourceBundle(path)
+
+
+def open_bundle(path: ty.Union[str, Path, None]) -> ty.Optional[ResourceBundle]:
+    """Open (once per process) the bundle at ``path``, returning None if no path is
+    given or the bundle can't be read"""
+    if not path:
+        return None
+    try:
+        return _open_bundle(str(path), Path(path).stat().st_mtime_ns)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not open resources bundle '%s': %s", path, e)
+        return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print(f"Usage: python -m {__spec__.name} <resources_dir> [out_file]")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    build_bundle(*sys.argv[1:])
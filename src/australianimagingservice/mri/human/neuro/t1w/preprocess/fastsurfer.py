@@ -0,0 +1,282 @@
+import logging
+from pathlib import Path
+from fileformats.generic import Directory, File
+from fileformats.medimage import NiftiGz, MghGz
+from pydra.compose import shell, workflow
+from pydra.engine.lazy import LazyField
+from pydra.environments.native import Native
+from australianimagingservice.mri.human.neuro.environments import PersistentContainer
+
+# Registers the manifest-based hashing of the subjects directory passed downstream
+from australianimagingservice.mri.human.neuro import hashing  # noqa: F401
+from .fastsurfer_store import (
+    FASTSURFER_SUBJECT_ID,
+    MaterialiseFastsurfer,
+    PublishFastsurfer,
+    default_store,
+    installed_fastsurfer_version,
+    lookup,
+    store_key,
+    t1_content_hash,
+)
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer"
+)
+
+FASTSURFER_IMAGE = "deepmi/fastsurfer"
+FASTSURFER_TAG = "cpu-v2.4.2"
+
+
+def _subject_dir(subjects_dir: Path, subject_id: str) -> Path:
+    return Path(subjects_dir) / subject_id
+
+
+def _seg_img(subjects_dir: Path, subject_id: str) -> Path:
+    return (
+        _subject_dir(subjects_dir, subject_id) / "mri" / "aparc.DKTatlas+aseg.deep.mgz"
+    )
+
+
+def _orig_img(subjects_dir: Path, subject_id: str) -> Path:
+    return _subject_dir(subjects_dir, subject_id) / "mri" / "orig.mgz"
+
+
+def _norm_img(subjects_dir: Path, subject_id: str) -> Path:
+    return _subject_dir(subjects_dir, subject_id) / "mri" / "norm.mgz"
+
+
+def _aparcaseg_img(subjects_dir: Path, subject_id: str) -> Path:
+    return _subject_dir(subjects_dir, subject_id) / "mri" / "aparc+aseg.mgz"
+
+
+@shell.define
+class FastsurferSeg(shell.Task["FastsurferSeg.Outputs"]):
+    """The segmentation half of FastSurfer (``run_fastsurfer.sh --seg_only``): conform
+    the T1 and segment it with FastSurferCNN"""
+
+    executable = "run_fastsurfer.sh"
+
+    subjects_dir: Path = shell.arg(
+        argstr="--sd {subjects_dir}", help="Subjects directory"
+    )
+    subject_id: str = shell.arg(argstr="--sid {subject_id}", help="Subject ID")
+    T1_files: File = shell.arg(argstr="--t1 {T1_files}", help="T1 full head input")
+    fs_license: File = shell.arg(
+        argstr="--fs_license {fs_license}", help="Path to FreeSurfer license key file"
+    )
+    batch: int = shell.arg(
+        argstr="--batch {batch}", help="Batch size for inference", default=16
+    )
+    threads: int = shell.arg(
+        argstr="--threads {threads}", help="Set openMP and ITK threads to", default=4
+    )
+    py: str = shell.arg(argstr="--py {py}", help="Python to use", default="python3")
+    allow_root: bool = shell.arg(
+        argstr="--allow_root", help="allow running as root user", default=False
+    )
+    seg_only: bool = shell.arg(
+        argstr="--seg_only", help="only run FastSurferCNN", default=True
+    )
+
+    class Outputs(shell.Outputs):
+        subjects_dir_output: Directory = shell.out(
+            help="path to subject FS outputs", callable=_subject_dir
+        )
+        seg_img: MghGz = shell.out(
+            help="aparc.DKTatlas+aseg.deep segmentation", callable=_seg_img
+        )
+        orig_img: MghGz = shell.out(help="conformed T1 image", callable=_orig_img)
+
+
+@shell.define
+class FastsurferSurf(shell.Task["FastsurferSurf.Outputs"]):
+    """The surface half of FastSurfer (``run_fastsurfer.sh --surf_only``): recon-surf,
+    run on the segmentation FastsurferSeg left in the subject directory"""
+
+    executable = "run_fastsurfer.sh"
+
+    subjects_dir: Path = shell.arg(
+        argstr="--sd {subjects_dir}", help="Subjects directory"
+    )
+    subject_id: str = shell.arg(argstr="--sid {subject_id}", help="Subject ID")
+    seg_img: MghGz = shell.arg(
+        argstr=None,
+        help=(
+            "the segmentation from FastsurferSeg (only used to chain the stages and "
+            "key the cache; recon-surf finds it in the subject directory)"
+        ),
+    )
+    fs_license: File = shell.arg(
+        argstr="--fs_license {fs_license}", help="Path to FreeSurfer license key file"
+    )
+    fsaparc: bool = shell.arg(
+        argstr="--fsaparc",
+        help="Use FS aparc segmentations in addition to DL prediction",
+        default=False,
+    )
+    parallel: bool = shell.arg(
+        argstr="--parallel", help="Run both hemispheres in parallel", default=True
+    )
+    threads: int = shell.arg(
+        argstr="--threads {threads}", help="Set openMP and ITK threads to", default=4
+    )
+    py: str = shell.arg(argstr="--py {py}", help="Python to use", default="python3")
+    allow_root: bool = shell.arg(
+        argstr="--allow_root", help="allow running as root user", default=False
+    )
+    surf_only: bool = shell.arg(
+        argstr="--surf_only", help="only run recon-surf", default=True
+    )
+
+    class Outputs(shell.Outputs):
+        subjects_dir_output: Directory = shell.out(
+            help="path to subject FS outputs", callable=_subject_dir
+        )
+        norm_img: MghGz = shell.out(help="norm image", callable=_norm_img)
+        aparcaseg_img: MghGz = shell.out(
+            help="aparc+aseg image", callable=_aparcaseg_img
+        )
+
+
+@workflow.define(outputs=["subjects_dir_output", "norm_img", "aparcaseg_img"])
+def FastsurferStage(
+    t1w: NiftiGz,
+    fs_license: File,
+    subjects_dir: Path,
+    in_fastsurfer_container: bool = False,
+    fastsurfer_batch: int = 16,
+    fastsurfer_nthreads: int = 24,
+    fastsurfer_store: Path | None = None,
+    seg_only: bool = False,
+) -> tuple[Directory, MghGz, MghGz]:
+    """Run FastSurfer (segmentation + recon-surf) on a single T1-weighted image.
+
+    The segmentation (FastsurferSeg) and recon-surf (FastsurferSurf) are run as two
+    chained tasks, each cached on its own, so a failed or reconfigured recon-surf
+    doesn't redo the segmentation.
+
+    With ``seg_only``, recon-surf is skipped and the outputs are those of the
+    segmentation: the conformed T1 (orig.mgz) in place of norm.mgz and FastSurferCNN's
+    aparc.DKTatlas+aseg.deep.mgz in place of aparc+aseg.mgz.
+
+    This is the per-subject stage shared by all parcellations, so that workflows that
+    generate several atlases (e.g. AllParcellations) run it exactly once and fan its
+    outputs out to the atlas-specific branches.
+
+    If a FastSurfer store is given (or $AIS_FASTSURFER_STORE is set), it is checked
+    for outputs of the same T1 data, FastSurfer version and options before FastSurfer
+    is run, which are then copied (or reflinked) into the subjects directory instead.
+    Fresh outputs are published to the store. See fastsurfer_store.py.
+    """
+
+    store = fastsurfer_store if fastsurfer_store is not None else default_store()
+    key = None
+    # Outputs are only shared between runs of the same FastSurfer version, so the
+    # store is skipped if the version of the installation in use can't be determined
+    if store is not None and in_fastsurfer_container:
+        version = installed_fastsurfer_version()
+        if version is None:
+            store = None
+    else:
+        version = f"{FASTSURFER_IMAGE}:{FASTSURFER_TAG}"
+    # The T1 can only be hashed here if it is known when the workflow is constructed
+    if store is not None and not isinstance(t1w, LazyField):
+        options = {"fastsurfer": version, "fsaparc": True, "seg_only": seg_only}
+        key = store_key(t1_content_hash(t1w), **options)
+        cached = lookup(store, key)
+        if cached is not None:
+            logger.info("Reusing FastSurfer outputs for '%s' from store (%s)", t1w, key)
+            materialise = workflow.add(
+                MaterialiseFastsurfer(
+                    store_dir=str(cached), subjects_dir=subjects_dir, seg_only=seg_only
+                )
+            )
+            return (
+                materialise.subjects_dir_output,
+                materialise.norm_img,
+                materialise.aparcaseg_img,
+            )
+
+    if in_fastsurfer_container:
+        fs_environment = Native()
+        logger.info("Using FastSurfer executable in container")
+    else:
+        # Both FastSurfer stages (and the stages of other subjects run by the same
+        # worker) are run in one long-lived container
+        fs_environment = PersistentContainer(
+            image=FASTSURFER_IMAGE,
+            tag=FASTSURFER_TAG,
+            xargs=[
+                "--user",
+                "1000:1000",
+                "--entrypoint",
+                "/bin/bash",
+            ],
+        )
+        logger.info("Using FastSurfer in persistent Docker container")
+
+    fastsurfer_seg = workflow.add(
+        FastsurferSeg(
+            T1_files=t1w,
+            fs_license=fs_license,
+            subject_id=FASTSURFER_SUBJECT_ID,
+            batch=fastsurfer_batch,
+            threads=fastsurfer_nthreads,
+            subjects_dir=subjects_dir,
+            allow_root=True,
+        ),
+        environment=fs_environment,
+    )
+    if seg_only:
+        stages = [fastsurfer_seg]
+        outputs = [fastsurfer_seg.orig_img, fastsurfer_seg.seg_img]
+    else:
+        fastsurfer = workflow.add(
+            FastsurferSurf(
+                seg_img=fastsurfer_seg.seg_img,
+                fs_license=fs_license,
+                subject_id=FASTSURFER_SUBJECT_ID,
+                fsaparc=True,
+                parallel=True,
+                threads=fastsurfer_nthreads,
+                subjects_dir=subjects_dir,
+                allow_root=True,
+            ),
+            environment=fs_environment,
+        )
+
+        stages = [fastsurfer_seg, fastsurfer]
+        outputs = [fastsurfer.norm_img, fastsurfer.aparcaseg_img]
+
+    logger.info("Fastsurfer executable is '%s'", fastsurfer_seg.inputs.executable)
+
+    for stage in stages:
+        stage.inputs.py = "/venv/bin/python"
+        if in_fastsurfer_container:
+            stage.inputs.executable = "/fastsurfer/run_fastsurfer.sh"
+
+    subjects_dir_output = stages[-1].subjects_dir_output
+    if key is not None:
+        publish = workflow.add(
+            PublishFastsurfer(
+                subjects_dir_output=subjects_dir_output,
+                store=store,
+                key=key,
+                meta={"t1w": str(t1w), **options},
+            )
+        )
+        subjects_dir_output = publish.subjects_dir_output
+
+    return (subjects_dir_output, *outputs)
+
+
+def fastsurfer_images(
+    fastsurfer_dir: Directory, seg_only: bool = False
+) -> tuple[Path, Path]:
+    """Return the paths to the norm and aparc+aseg images within an existing FastSurfer
+    subject directory (i.e. the equivalent of FastsurferStage's image outputs)"""
+    mri_dir = Path(fastsurfer_dir) / "mri"
+    if seg_only:
+        return mri_dir / "orig.mgz", mri_dir / "aparc.DKTatlas+aseg.deep.mgz"
+    return mri_dir / "norm.mgz", mri_dir / "aparc+aseg.mgz"
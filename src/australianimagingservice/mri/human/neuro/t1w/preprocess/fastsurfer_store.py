@@ -0,0 +1,185 @@
+"""Content-addressed store of FastSurfer outputs shared between runs.
+
+The pydra cache only saves FastSurfer from rerunning within the same cache root, so the
+same T1 reprocessed under a new cache root (a new atlas, a new pipeline version, the
+same session in two projects...) would otherwise redo FastSurfer from scratch. Subject
+directories are instead published into an (opt-in) store, keyed by the hash of the
+T1's voxel data and geometry plus the FastSurfer version and the options that change
+its outputs, and materialised from it by reflink (copy-on-write clone) where the
+filesystem supports it, or by copy.
+
+Store layout::
+
+    <store>/<key[:2]>/<key>/FS_outputs/...   the published subject directory
+    <store>/<key[:2]>/<key>/meta.json        what the key was computed from
+
+Entries are never hard-linked in or out of the store, as a task rewriting a file in
+place (e.g. an annotation written with "wb") would then silently corrupt the entry for
+every later run.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from fileformats.generic import Directory
+from fileformats.medimage import MghGz
+from pydra.compose import python
+from australianimagingservice.mri.human.neuro.fileops import place_tree
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer_store"
+)
+
+# Environment variable that enables the store when no path is passed explicitly
+FASTSURFER_STORE_ENV = "AIS_FASTSURFER_STORE"
+# Bumped whenever the layout of the store or the way keys are computed changes
+FASTSURFER_STORE_VERSION = 2
+# Name FastSurfer gives the subject directory within subjects_dir
+FASTSURFER_SUBJECT_ID = "FS_outputs"
+# Where FastSurfer is installed in its container
+FASTSURFER_HOME = Path("/fastsurfer")
+
+_HASH_CHUNK_SLICES = 16
+
+
+def default_store() -> ty.Optional[Path]:
+    """The store configured by $AIS_FASTSURFER_STORE, if any"""
+    path = os.environ.get(FASTSURFER_STORE_ENV)
+    return Path(path) if path else None
+
+
+def t1_content_hash(t1w: ty.Union[str, Path]) -> str:
+    """Hash the voxel data and geometry of a T1 image, so that the same acquisition is
+    recognised whatever its file name or non-geometric header fields"""
+    img = nib.load(str(t1w))
+    digest = hashlib.sha256()
+    digest.update(np.asarray(img.shape, dtype="<i8").tobytes())
+    digest.update(np.round(img.affine, 6).astype("<f8").tobytes())
+    digest.update(img.get_data_dtype().str.encode())
+    dataobj = img.dataobj
+    # Hash a slab at a time rather than loading the (possibly compressed) image at once
+    step = max(1, img.shape[-1] // _HASH_CHUNK_SLICES) if img.ndim else 1
+    for start in range(0, img.shape[-1] if img.ndim else 1, step):
+        slab = np.asanyarray(dataobj[..., start : start + step])
+        slab = np.ascontiguousarray(slab, dtype=slab.dtype.newbyteorder("<"))
+        digest.update(slab.tobytes())
+    return digest.hexdigest()
+
+
+def installed_fastsurfer_version(
+    fastsurfer_home: ty.Union[str, Path] = FASTSURFER_HOME,
+) -> ty.Optional[str]:
+    """The version reported by the FastSurfer installation that is run natively (i.e.
+    when running within the FastSurfer container), or None if it can't be determined"""
+    try:
+        result = subprocess.run(
+            [str(Path(fastsurfer_home) / "run_fastsurfer.sh"), "--version"],
+            capture_output=True,
+            text=True,
+            timeout=120,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Could not determine the FastSurfer version: %s", e)
+        return None
+    return result.stdout.strip() or None
+
+
+def store_key(t1_hash: str, **options: ty.Any) -> str:
+    """Key of a FastSurfer run in the store: the T1 hash plus the FastSurfer version and
+    the options that change its outputs"""
+    payload = json.dumps(
+        {"version": FASTSURFER_STORE_VERSION, "t1": t1_hash, **options}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def store_entry(store: ty.Union[str, Path], key: str) -> Path:
+    """Directory of an entry in the store (which may not exist yet)"""
+    return Path(store) / key[:2] / key
+
+
+def lookup(store: ty.Union[str, Path, None], key: str) -> ty.Optional[Path]:
+    """Return the published subject directory for ``key`` if it is in the store"""
+    if store is None:
+        return None
+    entry = store_entry(store, key)
+    # meta.json is written last, so its presence marks a complete entry
+    if (entry / "meta.json").exists() and (entry / FASTSURFER_SUBJECT_ID).is_dir():
+        return entry / FASTSURFER_SUBJECT_ID
+    return None
+
+
+def publish(
+    store: ty.Union[str, Path],
+    key: str,
+    subject_dir: ty.Union[str, Path],
+    meta: ty.Optional[dict[str, ty.Any]] = None,
+) -> Path:
+    """Publish a FastSurfer subject directory into the store by reflink or copy.
+    Concurrent publications of the same key are safe: the entry is staged and renamed
+    into place, and the first one wins."""
+    entry = store_entry(store, key)
+    if lookup(store, key):
+        return entry / FASTSURFER_SUBJECT_ID
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    staging = entry.with_name(f".{key}.{os.getpid()}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    place_tree(subject_dir, staging / FASTSURFER_SUBJECT_ID, link=False)
+    with open(staging / "meta.json", "w") as f:
+        json.dump({"key": key, **(meta or {})}, f, indent=2)
+    try:
+        os.rename(staging, entry)
+        logger.info(
+            "Published FastSurfer outputs '%s' to store as %s", subject_dir, key
+        )
+    except OSError:
+        # Someone else published the same key in the meantime
+        shutil.rmtree(staging, ignore_errors=True)
+    return entry / FASTSURFER_SUBJECT_ID
+
+
+@python.define(outputs=["subjects_dir_output", "norm_img", "aparcaseg_img"])
+def MaterialiseFastsurfer(
+    store_dir: str,
+    subjects_dir: Path,
+    seg_only: bool = False,
+) -> tuple[Directory, MghGz, MghGz]:
+    """Materialise FastSurfer outputs from the store into the subjects directory by
+    reflink or copy, in place of running FastSurfer (the store entry is passed as a
+    string, as its key already identifies its contents and hashing it would cost a
+    full read)"""
+    subject_dir = Path(subjects_dir) / FASTSURFER_SUBJECT_ID
+    place_tree(store_dir, subject_dir, link=False)
+    mri_dir = subject_dir / "mri"
+    if seg_only:
+        return (
+            subject_dir,
+            mri_dir / "orig.mgz",
+            mri_dir / "aparc.DKTatlas+aseg.deep.mgz",
+        )
+    return subject_dir, mri_dir / "norm.mgz", mri_dir / "aparc+aseg.mgz"
+
+
+@python.define(outputs=["subjects_dir_output"])
+def PublishFastsurfer(
+    subjects_dir_output: Directory,
+    store: Path,
+    key: str,
+    meta: dict | None = None,
+) -> Directory:
+    """Publish freshly generated FastSurfer outputs to the store, passing the subject
+    directory through so that downstream tasks run after it has been published"""
+    try:
+        publish(store, key, subjects_dir_output, meta)
+    except OSError as e:
+        # The store is only an optimisation, so never fail the run because of it
+        logger.warning("Could not publish FastSurfer outputs to '%s': %s", store, e)
+    return subjects_dir_output
@@ -0,0 +1,190 @@
+import logging
+import subprocess
+import tempfile
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from fileformats.generic import Directory, File
+from fileformats.medimage import NiftiGz
+from fileformats.vendor.mrtrix3.medimage import ImageFormatGz
+from pydra.compose import python
+from australianimagingservice.mri.human.neuro.mif import load_mif, save_mif
+from .bundle import ResourceBundle, open_bundle
+from .labels import lut_indices
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.first"
+)
+
+# FIRST structures that labelsgmfirst replaces, and the names they are matched on in
+# the parcellation's lookup table (the thalamus was renamed in FreeSurfer 7)
+SGM_STRUCTURES = {
+    "L_Accu": ("Left-Accumbens-area",),
+    "R_Accu": ("Right-Accumbens-area",),
+    "L_Caud": ("Left-Caudate",),
+    "R_Caud": ("Right-Caudate",),
+    "L_Pall": ("Left-Pallidum",),
+    "R_Pall": ("Right-Pallidum",),
+    "L_Puta": ("Left-Putamen",),
+    "R_Puta": ("Right-Putamen",),
+    "L_Thal": ("Left-Thalamus-Proper", "Left-Thalamus"),
+    "R_Thal": ("Right-Thalamus-Proper", "Right-Thalamus"),
+}
+AMYG_HIPP_STRUCTURES = {
+    "L_Amyg": ("Left-Amygdala",),
+    "R_Amyg": ("Right-Amygdala",),
+    "L_Hipp": ("Left-Hippocampus",),
+    "R_Hipp": ("Right-Hippocampus",),
+}
+
+
+def sgm_structures(sgm_amyg_hipp: bool) -> dict[str, tuple[str, ...]]:
+    """The FIRST structures to segment, in the order of their codes in the cached
+    segmentation (i.e. the first structure is 1, the second 2, ...)"""
+    structures = dict(SGM_STRUCTURES)
+    if sgm_amyg_hipp:
+        structures.update(AMYG_HIPP_STRUCTURES)
+    return structures
+
+
+def _run(cmd: list[str], cwd: Path) -> None:
+    logger.debug("Running %s", " ".join(cmd))
+    subprocess.run(cmd, cwd=cwd, check=True)
+
+
+def run_first(
+    t1: ty.Union[str, Path],
+    out_file: ty.Union[str, Path],
+    premasked: bool = True,
+    sgm_amyg_hipp: bool = True,
+) -> Path:
+    """Segment the sub-cortical grey matter structures with FIRST and voxelise their
+    meshes onto the T1 grid, as labelsgmfirst does, storing them in a single label
+    image (structure codes as per ``sgm_structures``).
+
+    As in labelsgmfirst, each mesh is voxelised to partial volume fractions and
+    thresholded at 0.5, and voxels claimed by more than one structure are left
+    unlabelled.
+    """
+    structures = list(sgm_structures(sgm_amyg_hipp))
+    with tempfile.TemporaryDirectory(prefix="first-") as tmp:
+        work = Path(tmp)
+        _run(["mrconvert", str(t1), "T1.nii", "-strides", "-1,+2,+3", "-quiet"], work)
+        cmd = ["run_first_all", "-m", "none", "-s", ",".join(structures)]
+        cmd += ["-i", "T1.nii", "-o", "first"]
+        if premasked:
+            cmd.append("-b")
+        _run(cmd, work)
+        t1_img = nib.load(str(work / "T1.nii"))
+        labels = np.zeros(t1_img.shape[:3], dtype=np.int16)
+        counts = np.zeros(t1_img.shape[:3], dtype=np.int16)
+        for code, struct in enumerate(structures, start=1):
+            vtk = f"first-{struct}_first.vtk"
+            _run(
+                [
+                    "meshconvert",
+                    vtk,
+                    f"{struct}_real.vtk",
+                    "-transform",
+                    "first2real",
+                    "T1.nii",
+                    "-quiet",
+                ],
+                work,
+            )
+            _run(
+                [
+                    "mesh2voxel",
+                    f"{struct}_real.vtk",
+                    "T1.nii",
+                    f"{struct}.nii",
+                    "-quiet",
+                ],
+                work,
+            )
+            mask = np.asanyarray(nib.load(str(work / f"{struct}.nii")).dataobj) > 0.5
+            labels[mask] = code
+            counts += mask
+        labels[counts > 1] = 0
+    nib.save(nib.Nifti1Image(labels, t1_img.affine), str(out_file))
+    return Path(out_file)
+
+
+def replace_sgm(
+    parc: np.ndarray,
+    sgm: np.ndarray,
+    lut_file: ty.Union[str, Path],
+    sgm_amyg_hipp: bool,
+    bundle: ty.Optional[ResourceBundle] = None,
+) -> np.ndarray:
+    """Replace the sub-cortical grey matter structures of a parcellation with those of
+    a cached FIRST segmentation (the per-atlas part of labelsgmfirst): the indices of
+    the FIRST structures in the parcellation's LUT are stripped from the parcellation
+    and the FIRST delineations are inserted in their place"""
+    indices = lut_indices(lut_file, bundle)
+    code_to_index = np.zeros(len(sgm_structures(sgm_amyg_hipp)) + 1, dtype=np.uint32)
+    for code, names in enumerate(sgm_structures(sgm_amyg_hipp).values(), start=1):
+        code_to_index[code] = next((indices[n] for n in names if n in indices), 0)
+    parc = np.asarray(parc, dtype=np.uint32)
+    sgm_labels = np.take(code_to_index, sgm)
+    stripped = np.where(np.isin(parc, code_to_index[code_to_index > 0]), 0, parc)
+    return np.where(sgm_labels > 0, sgm_labels, stripped).astype(np.uint32)
+
+
+@python.define(outputs=["sgm_image"])
+def FirstSegmentation(
+    fastsurfer_dir: Directory,
+    premasked: bool = True,
+    sgm_amyg_hipp: bool = True,
+    t1_image: str = "norm.mgz",
+    out_file: str = "first_sgm.nii.gz",
+) -> NiftiGz:
+    """Run FIRST on the FastSurfer norm.mgz (or another T1 in the mri/ directory, e.g.
+    orig.mgz when recon-surf hasn't been run) and voxelise its sub-cortical
+    segmentation, so that it can be shared by every parcellation that needs its SGM
+    structures replaced. Workflows add it once per subject (see AllParcellations) and
+    pydra's cache takes care of not rerunning it."""
+    t1 = Path(fastsurfer_dir) / "mri" / t1_image
+    return run_first(
+        t1,
+        Path(out_file).absolute(),
+        premasked=premasked,
+        sgm_amyg_hipp=sgm_amyg_hipp,
+    )
+
+
+@python.define(outputs=["out_file"])
+def SgmReplace(
+    parc: File,
+    sgm_image: NiftiGz,
+    lut: File,
+    sgm_amyg_hipp: bool = True,
+    out_file: str = "parc_sgm.mif.gz",
+    resource_bundle: str | None = None,
+) -> ImageFormatGz:
+    """Replace the sub-cortical grey matter of a parcellation with the cached FIRST
+    segmentation (replaces labelsgmfirst, which reruns FIRST on every call)"""
+    if str(parc).endswith((".mif", ".mif.gz")):
+        parc_data, affine = load_mif(parc)
+    else:
+        parc_img = nib.load(str(parc))
+        parc_data, affine = np.asanyarray(parc_img.dataobj), parc_img.affine
+    sgm_img = nib.load(str(sgm_image))
+    sgm = np.asanyarray(sgm_img.dataobj)
+    # The FIRST segmentation is on the T1 grid, which the parcellation shares but may
+    # store in a different axis order
+    ornt = nib.orientations.ornt_transform(
+        nib.orientations.io_orientation(sgm_img.affine),
+        nib.orientations.io_orientation(affine),
+    )
+    sgm = nib.orientations.apply_orientation(sgm, ornt)
+    if sgm.shape != parc_data.shape[:3]:
+        raise ValueError(
+            f"FIRST segmentation {sgm_image} {sgm.shape} does not match the grid of "
+            f"parcellation {parc} {parc_data.shape}"
+        )
+    result = replace_sgm(
+        parc_data, sgm, lut, sgm_amyg_hipp, open_bundle(resource_bundle)
+    )
+    return save_mif(Path(out_file).absolute(), result, affine)
@@ -0,0 +1,153 @@
+from fileformats.generic import Directory
+from fileformats.medimage import MghGz
+from fileformats.vendor.mrtrix3.medimage import ImageFormat as Mif
+from pydra.compose import workflow
+from pydra.tasks.mrtrix3.v3_1 import (
+    Fivett2Vis,
+    FivettGen_Hsvs,
+    FivettGen_Freesurfer,
+    FivettGen_Fsl,
+)
+
+# The 5TT algorithms, and those that only need FastSurfer's segmentation (hsvs needs
+# the surfaces and fsl the skull-stripped norm.mgz, which are made by recon-surf)
+FIVETT_ALGORITHMS = ("hsvs", "freesurfer", "fsl")
+SEG_ONLY_FIVETT_ALGORITHMS = ("freesurfer",)
+
+
+def select_fivett_algorithms(
+    algorithms: tuple[str, ...] | None = None, seg_only: bool = False
+) -> tuple[str, ...]:
+    """Validate a selection of 5TT algorithms, returning all of those available if
+    none are selected. With ``seg_only``, only the algorithms that can be run on
+    FastSurfer's segmentation alone are allowed (and selected by default)."""
+    if algorithms is None:
+        return SEG_ONLY_FIVETT_ALGORITHMS if seg_only else FIVETT_ALGORITHMS
+    algorithms = tuple(dict.fromkeys(algorithms))
+    unknown = set(algorithms) - set(FIVETT_ALGORITHMS)
+    if unknown:
+        raise ValueError(
+            f"Unrecognised 5TT algorithm(s) {sorted(unknown)}, "
+            f"choose from {FIVETT_ALGORITHMS}"
+        )
+    unavailable = [a for a in algorithms if a not in SEG_ONLY_FIVETT_ALGORITHMS]
+    if seg_only and unavailable:
+        raise ValueError(
+            f"5TT algorithm(s) {unavailable} need FastSurfer's surface reconstruction, "
+            "so can't be run in segmentation-only mode. Please choose from: "
+            f"{SEG_ONLY_FIVETT_ALGORITHMS}"
+        )
+    return algorithms
+
+
+@workflow.define(
+    outputs=[
+        "vis_image_fsl",
+        "ftt_image_fsl",
+        "vis_image_freesurfer",
+        "ftt_image_freesurfer",
+        "vis_image_hsvs",
+        "ftt_image_hsvs",
+    ]
+)
+def FivettStage(
+    fastsurfer_dir: Directory,
+    norm_img: MghGz,
+    aparcaseg_img: MghGz,
+    algorithms: tuple[str, ...] | None = None,
+    seg_only: bool = False,
+) -> tuple[Mif | None, Mif | None, Mif | None, Mif | None, Mif | None, Mif | None]:
+    """Generate the HSVS, FreeSurfer and FSL five-tissue-type (5TT) images, and their
+    visualisations, from the FastSurfer outputs of a single subject.
+
+    The 5TT images only depend on the FastSurfer outputs (not on the parcellation), so
+    this stage is run once per subject and shared by all parcellations. Only the
+    requested ``algorithms`` are run (all of those available by default); the outputs
+    of the others are None. With ``seg_only`` (FastSurfer without recon-surf), only
+    the freesurfer algorithm is available (see ``select_fivett_algorithms``).
+    """
+    algorithms = select_fivett_algorithms(algorithms, seg_only)
+
+    fTTgen_task_hsvs_out = fTTvis_task_hsvs_out = None
+    fTTgen_task_freesurfer_out = fTTvis_task_freesurfer_out = None
+    fTTgen_task_fsl_out = fTTvis_task_fsl_out = None
+
+    if "hsvs" in algorithms:
+        # Five tissue-type task HSVS
+        fTTgen_task_hsvs = workflow.add(
+            FivettGen_Hsvs(
+                in_file=fastsurfer_dir,
+                nocrop=True,
+                sgm_amyg_hipp=True,
+                nocleanup=True,
+                white_stem=True,
+                config=None,
+            )
+        )
+
+        # Five tissue-type visualisation task HSVS
+        fTTvis_task_hsvs = workflow.add(
+            Fivett2Vis(
+                in_file=fTTgen_task_hsvs.out_file,
+                config=None,
+            ),
+            name="fTTvis_task_hsvs",
+        )
+        fTTgen_task_hsvs_out = fTTgen_task_hsvs.out_file
+        fTTvis_task_hsvs_out = fTTvis_task_hsvs.out_file
+
+    if "freesurfer" in algorithms:
+        # Five tissue-type task FreeSurfer
+        fTTgen_task_freesurfer = workflow.add(
+            FivettGen_Freesurfer(
+                in_file=aparcaseg_img,
+                nocrop=True,
+                sgm_amyg_hipp=True,
+                nocleanup=True,
+                config=None,
+            )
+        )
+
+        # Five tissue-type visualisation task FreeSurfer
+        fTTvis_task_freesurfer = workflow.add(
+            Fivett2Vis(
+                in_file=fTTgen_task_freesurfer.out_file,
+                config=None,
+            ),
+            name="fTTvis_task_freesurfer",
+        )
+        fTTgen_task_freesurfer_out = fTTgen_task_freesurfer.out_file
+        fTTvis_task_freesurfer_out = fTTvis_task_freesurfer.out_file
+
+    if "fsl" in algorithms:
+        # Five tissue-type task fsl
+        fTTgen_task_fsl = workflow.add(
+            FivettGen_Fsl(
+                in_file=norm_img,
+                nocrop=True,
+                sgm_amyg_hipp=True,
+                nocleanup=True,
+                premasked=True,
+                config=None,
+            )
+        )
+
+        # Five tissue-type visualisation task FSL
+        fTTvis_task_fsl = workflow.add(
+            Fivett2Vis(
+                in_file=fTTgen_task_fsl.out_file,
+                config=None,
+            ),
+            name="fTTvis_task_fsl",
+        )
+        fTTgen_task_fsl_out = fTTgen_task_fsl.out_file
+        fTTvis_task_fsl_out = fTTvis_task_fsl.out_file
+
+    return (
+        fTTvis_task_fsl_out,
+        fTTgen_task_fsl_out,
+        fTTvis_task_freesurfer_out,
+        fTTgen_task_freesurfer_out,
+        fTTvis_task_hsvs_out,
+        fTTgen_task_hsvs_out,
+    )
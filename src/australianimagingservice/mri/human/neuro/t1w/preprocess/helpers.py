@@ -3,6 +3,7 @@ import typing as ty
 from fileformats.generic import Directory, File
 from pathlib import Path
 from pydra.compose import python, shell
+from .registry import get_parcellation
 
 
 @python.define(
@@ -19,8 +20,6 @@ from pydra.compose import python, shell
         "node_image": str,
         "normimg_path": str,
         "final_parc_image": str,
-        "l2v_temp": str,
-        "l2v_regheader": str,
     }
 )  # type: ignore[misc]
 def JoinTaskCatalogue(
@@ -29,234 +28,61 @@ def JoinTaskCatalogue(
     freesurfer_home: Directory,
     mrtrix_lut_dir: Directory,
     resources_dir: Path,
-) -> ty.Tuple[str, str, str, str, str, str, str, str, str, str, str, str, str, str]:
+    seg_only: bool = False,
+) -> ty.Tuple[str, str, str, str, str, str, str, str, str, str, str, str]:
+    entry = get_parcellation(parcellation)
+    roots = {
+        "resources": resources_dir,
+        "freesurfer_home": freesurfer_home,
+        "mrtrix_lut_dir": mrtrix_lut_dir,
+        "subject": FS_dir,
+    }
     node_image = parcellation + "_nodes.mif"
     final_parc_image = os.path.join(f"Atlas_{parcellation}.mif.gz")
     normimg_path = os.path.join(FS_dir, "mri", "norm.mgz")
 
-    mica_annots = os.path.join(resources_dir, "mica-mni-parcellations")
-    mica_luts = os.path.join(resources_dir, "mica-mni-parcellations", "lut")
-    neuro_luts = os.path.join(resources_dir, "neuro-parcellations")
-
-    if (
-        "schaefer" in parcellation
-        or "aparc" in parcellation
-        or "vosdewael" in parcellation
-        or parcellation == "economo"
-        or parcellation == "glasser360"
-    ):
-        fsavg_dir = os.path.join(freesurfer_home, "subjects", "fsaverage5")
-        parc_lut_file = os.path.join(mica_luts, f"lut_{parcellation}_mics.csv")
-        mrtrix_lut_file = os.path.join(neuro_luts, f"{parcellation}_reordered_LUT.txt")
+    parc_lut_file = entry.resolve(entry.parc_lut, roots)
+    mrtrix_lut_file = entry.resolve(entry.mrtrix_lut, roots)
 
+    if entry.is_surface:
+        fsavg_dir = os.path.join(freesurfer_home, "subjects", entry.template)
         output_parcellation_filename = os.path.join(
             FS_dir, "mri", f"{parcellation}.nii.gz"
         )
-        lh_annotation = os.path.join(FS_dir, "label", f"lh.{parcellation}_mics.annot")
-        rh_annotation = os.path.join(FS_dir, "label", f"rh.{parcellation}_mics.annot")
-        source_annotation_file_lh = os.path.join(
-            mica_annots, f"lh.{parcellation}_mics.annot"
-        )
-        source_annotation_file_rh = os.path.join(
-            mica_annots, f"rh.{parcellation}_mics.annot"
+        annot_short = entry.annot_short
+        # Written by ResampleAnnotation to its own directory
+        lh_annotation, rh_annotation = (
+            f"{hemi}.{annot_short}.annot" for hemi in ("lh", "rh")
         )
-        annot_short = f"{parcellation}_mics"
-        l2v_temp = os.path.join(FS_dir, "mri", "T1.mgz")
-        l2v_regheader = os.path.join(FS_dir, "mri", "aseg.mgz")
-
-        return (
-            fsavg_dir,
-            parc_lut_file,
-            mrtrix_lut_file,
-            output_parcellation_filename,
-            lh_annotation,
-            rh_annotation,
-            source_annotation_file_lh,
-            source_annotation_file_rh,
-            annot_short,
-            node_image,
-            normimg_path,
-            final_parc_image,
-            l2v_temp,
-            l2v_regheader,
-        )
-
-    elif parcellation == "desikan":
-        fsavg_dir = ""
-        parc_lut_file = os.path.join(freesurfer_home, "FreeSurferColorLUT.txt")
-        mrtrix_lut_file = os.path.join(mrtrix_lut_dir, "fs_default.txt")
-        output_parcellation_filename = os.path.join(FS_dir, "mri", "aparc+aseg.mgz")
-        lh_annotation = ""
-        rh_annotation = ""
-        source_annotation_file_lh = ""
-        source_annotation_file_rh = ""
-        annot_short = ""
-        l2v_temp = ""
-        l2v_regheader = ""
-
-        return (
-            fsavg_dir,
-            parc_lut_file,
-            mrtrix_lut_file,
-            output_parcellation_filename,
-            lh_annotation,
-            rh_annotation,
-            source_annotation_file_lh,
-            source_annotation_file_rh,
-            annot_short,
-            node_image,
-            normimg_path,
-            final_parc_image,
-            l2v_temp,
-            l2v_regheader,
+        source_annotation_file_lh, source_annotation_file_rh = (
+            entry.resolve(entry.source_annot, roots).format(hemi=hemi)
+            for hemi in ("lh", "rh")
         )
-
-    elif parcellation == "destrieux":
+    else:
         fsavg_dir = ""
-        parc_lut_file = os.path.join(freesurfer_home, "FreeSurferColorLUT.txt")
-        mrtrix_lut_file = os.path.join(mrtrix_lut_dir, "fs_a2009s.txt")
-        output_parcellation_filename = os.path.join(
-            FS_dir, "mri", "aparc.a2009s+aseg.mgz"
+        output_parcellation_filename = entry.resolve(
+            entry.seg_only_volume if seg_only else entry.volume, roots
         )
         lh_annotation = ""
         rh_annotation = ""
         source_annotation_file_lh = ""
         source_annotation_file_rh = ""
         annot_short = ""
-        l2v_temp = ""
-        l2v_regheader = ""
-
-        return (
-            fsavg_dir,
-            parc_lut_file,
-            mrtrix_lut_file,
-            output_parcellation_filename,
-            lh_annotation,
-            rh_annotation,
-            source_annotation_file_lh,
-            source_annotation_file_rh,
-            annot_short,
-            node_image,
-            normimg_path,
-            final_parc_image,
-            l2v_temp,
-            l2v_regheader,
-        )
-
-    elif parcellation == "hcpmmp1":
-        fsavg_dir = os.path.join(freesurfer_home, "subjects", "fsaverage")
-        parc_lut_file = os.path.join(neuro_luts, "hcpmmp1_original.txt")
-        mrtrix_lut_file = os.path.join(neuro_luts, "hcpmmp1_ordered.txt")
-        output_parcellation_filename = os.path.join(
-            FS_dir, "mri", f"{parcellation}.nii.gz"
-        )
-        lh_annotation = os.path.join(FS_dir, "label", "lh.HCPMMP1.annot")
-        rh_annotation = os.path.join(FS_dir, "label", "rh.HCPMMP1.annot")
-        source_annotation_file_lh = os.path.join(
-            resources_dir, "hcpmmp1-parcellations", "lh.HCPMMP1.annot"
-        )
-        source_annotation_file_rh = os.path.join(
-            resources_dir, "hcpmmp1-parcellations", "rh.HCPMMP1.annot"
-        )
-        annot_short = "HCPMMP1"
-        l2v_temp = ""
-        l2v_regheader = ""
-
-        return (
-            fsavg_dir,
-            parc_lut_file,
-            mrtrix_lut_file,
-            output_parcellation_filename,
-            lh_annotation,
-            rh_annotation,
-            source_annotation_file_lh,
-            source_annotation_file_rh,
-            annot_short,
-            node_image,
-            normimg_path,
-            final_parc_image,
-            l2v_temp,
-            l2v_regheader,
-        )
-
-    elif parcellation == "Yeo7":
-        yeo_dir = os.path.join(resources_dir, "yeo2011-parcellations")
-        fsavg_dir = os.path.join(freesurfer_home, "subjects", "fsaverage5")
-        parc_lut_file = os.path.join(yeo_dir, "Yeo2011_7networks_Split_Components_LUT.txt")
-        mrtrix_lut_file = os.path.join(neuro_luts, "Yeo2011_7N_split.txt")
-        output_parcellation_filename = os.path.join(
-            FS_dir, "mri", f"{parcellation}.nii.gz"
-        )
-        lh_annotation = os.path.join(FS_dir, "label", "lh.Yeo7.annot")
-        rh_annotation = os.path.join(FS_dir, "label", "rh.Yeo7.annot")
-        source_annotation_file_lh = os.path.join(
-            yeo_dir, "lh.Yeo2011_7Networks_N1000.split_components.annot"
-        )
-        source_annotation_file_rh = os.path.join(
-            yeo_dir, "rh.Yeo2011_7Networks_N1000.split_components.annot"
-        )
-        annot_short = "Yeo7"
-        l2v_temp = ""
-        l2v_regheader = ""
-
-        return (
-            fsavg_dir,
-            parc_lut_file,
-            mrtrix_lut_file,
-            output_parcellation_filename,
-            lh_annotation,
-            rh_annotation,
-            source_annotation_file_lh,
-            source_annotation_file_rh,
-            annot_short,
-            node_image,
-            normimg_path,
-            final_parc_image,
-            l2v_temp,
-            l2v_regheader,
-        )
 
-    elif parcellation == "Yeo17":
-        yeo_dir = os.path.join(resources_dir, "yeo2011-parcellations")
-        fsavg_dir = os.path.join(freesurfer_home, "subjects", "fsaverage5")
-        parc_lut_file = os.path.join(yeo_dir, "Yeo2011_17networks_Split_Components_LUT.txt")
-        mrtrix_lut_file = os.path.join(neuro_luts, "Yeo2011_17N_split.txt")
-        output_parcellation_filename = os.path.join(
-            FS_dir, "mri", f"{parcellation}.nii.gz"
-        )
-        lh_annotation = os.path.join(FS_dir, "label", "lh.Yeo17.annot")
-        rh_annotation = os.path.join(FS_dir, "label", "rh.Yeo17.annot")
-        source_annotation_file_lh = os.path.join(
-            yeo_dir, "lh.Yeo2011_17Networks_N1000.split_components.annot"
-        )
-        source_annotation_file_rh = os.path.join(
-            yeo_dir, "rh.Yeo2011_17Networks_N1000.split_components.annot"
-        )
-        annot_short = "Yeo17"
-        l2v_temp = ""
-        l2v_regheader = ""
-
-        return (
-            fsavg_dir,
-            parc_lut_file,
-            mrtrix_lut_file,
-            output_parcellation_filename,
-            lh_annotation,
-            rh_annotation,
-            source_annotation_file_lh,
-            source_annotation_file_rh,
-            annot_short,
-            node_image,
-            normimg_path,
-            final_parc_image,
-            l2v_temp,
-            l2v_regheader,
-        )
-    else:
-        raise ValueError(
-            f"Parcellation {parcellation} not recognised. Please choose from: "
-            "'aparc', 'schaefer', 'vosdewael', 'economo', 'glasser360'"
-        )
+    return (
+        fsavg_dir,
+        parc_lut_file,
+        mrtrix_lut_file,
+        output_parcellation_filename,
+        lh_annotation,
+        rh_annotation,
+        source_annotation_file_lh,
+        source_annotation_file_rh,
+        annot_short,
+        node_image,
+        normimg_path,
+        final_parc_image,
+    )
 
 
 # ######################
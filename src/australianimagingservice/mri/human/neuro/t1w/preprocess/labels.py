@@ -0,0 +1,238 @@
+import functools
+import hashlib
+import logging
+import os
+import shlex
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from nibabel.orientations import (
+    axcodes2ornt,
+    apply_orientation,
+    inv_ornt_aff,
+    io_orientation,
+    ornt_transform,
+)
+from fileformats.generic import File
+from fileformats.vendor.mrtrix3.medimage import ImageFormat as Mif, ImageFormatGz
+from pydra.compose import python
+from australianimagingservice.mri.human.neuro.mif import save_mif
+from .bundle import ResourceBundle, open_bundle
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.labels"
+)
+
+# The orientation that fslreorient2std reorients images to (i.e. that of the MNI152)
+STD_AXCODES = ("L", "A", "S")
+
+# Bumped whenever the way lookup arrays are compiled changes, to invalidate the cache
+LUT_CACHE_VERSION = 2
+
+# Where compiled (lut_in, lut_out) lookup arrays are persisted between runs
+_XDG_CACHE_HOME = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser()
+LUT_CACHE_DIR = Path(
+    os.environ.get(
+        "AIS_LUT_CACHE_DIR", _XDG_CACHE_HOME / "australianimagingservice" / "lut"
+    )
+)
+
+
+def parse_lut(lut_file: ty.Union[str, Path]) -> list[tuple[int, str]]:
+    """Parse a lookup table in any of the formats that MRtrix's labelconvert accepts,
+    returning the (index, name) entries that labelconvert matches on. An index may
+    appear more than once (e.g. "Left-Thalamus" and "Left-Thalamus-Proper" in
+    fs_default.txt), so all entries are kept in file order.
+
+    The format is determined by the number of columns:
+
+        2: basic (index name)
+        3: AAL (index short_name name)
+        6: FreeSurfer (index name r g b a), including the tab-separated MICA CSVs
+        7: MRtrix (index short_name name r g b a)
+        8: ITK-SNAP (index r g b a visibility mesh "name")
+    """
+    lut = []
+    with open(lut_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            # Only ITK-SNAP tables quote their names
+            cols = shlex.split(line) if '"' in line else line.split()
+            try:
+                index = int(cols[0])
+            except ValueError:
+                continue
+            if len(cols) in (2, 6):
+                name = cols[1]
+            elif len(cols) in (3, 7):
+                name = cols[2]
+            elif len(cols) == 8:
+                name = cols[7]
+            else:
+                raise ValueError(
+                    f"Unrecognised lookup table line in {lut_file}: {line!r}"
+                )
+            lut.append((index, name))
+    return lut
+
+
+def lut_entries(
+    lut_file: ty.Union[str, Path], bundle: ty.Optional[ResourceBundle] = None
+) -> list[tuple[int, str]]:
+    """The (index, name) entries of a lookup table, as returned by ``parse_lut``, taken
+    from the resources bundle if it is packed in it"""
+    entries = bundle.lut(lut_file) if bundle is not None else None
+    return entries if entries is not None else parse_lut(lut_file)
+
+
+def lut_mapping(
+    lut_in: ty.Union[str, Path],
+    lut_out: ty.Union[str, Path],
+    bundle: ty.Optional[ResourceBundle] = None,
+) -> np.ndarray:
+    """Compile a (lut_in, lut_out) pair into a dense lookup array that maps each input
+    index to the output index with the same name (0 where there is no match), as
+    labelconvert does"""
+    in_lut = lut_entries(lut_in, bundle)
+    out_indices = lut_indices(lut_out, bundle)
+    mapping = np.zeros(max((i for i, _ in in_lut), default=0) + 1, dtype=np.uint32)
+    for index, name in in_lut:
+        if index >= 0 and not mapping[index]:
+            mapping[index] = out_indices.get(name, 0)
+    return mapping
+
+
+def lut_indices(
+    lut_file: ty.Union[str, Path], bundle: ty.Optional[ResourceBundle] = None
+) -> dict[str, int]:
+    """Map each name in a lookup table to its (first) index, taking the parsed table
+    from the resources bundle if it is packed in it"""
+    indices: dict[str, int] = {}
+    for index, name in lut_entries(lut_file, bundle):
+        indices.setdefault(name, index)
+    return indices
+
+
+def _file_digest(path: ty.Union[str, Path]) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@functools.lru_cache(maxsize=64)
+def _load_compiled_mapping(
+    key: str, lut_in: str, lut_out: str, bundle: ty.Optional[ResourceBundle]
+) -> np.ndarray:
+    cache_path = LUT_CACHE_DIR / f"{key}.npy"
+    try:
+        return np.load(cache_path)
+    except (OSError, ValueError):
+        pass
+    mapping = lut_mapping(lut_in, lut_out, bundle)
+    try:
+        LUT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, mapping)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning("Could not cache compiled LUT mapping in %s: %s", cache_path, e)
+    return mapping
+
+
+def compiled_lut_mapping(
+    lut_in: ty.Union[str, Path],
+    lut_out: ty.Union[str, Path],
+    bundle: ty.Optional[ResourceBundle] = None,
+) -> np.ndarray:
+    """Return the dense lookup array for a (lut_in, lut_out) pair, compiling it only
+    the first time the pair is seen. Compiled arrays are cached in memory and on disk
+    (see LUT_CACHE_DIR), keyed by the contents of both LUT files so that edits to
+    either file invalidate the cache.
+
+    Pairs that are precompiled in the resources bundle are served straight from it,
+    without reading either LUT file."""
+    if bundle is not None:
+        mapping = bundle.lut_mapping(lut_in, lut_out)
+        if mapping is not None:
+            return mapping
+    key = hashlib.sha256(
+        f"{LUT_CACHE_VERSION}:{_file_digest(lut_in)}:{_file_digest(lut_out)}".encode()
+    ).hexdigest()
+    mapping = _load_compiled_mapping(key, str(lut_in), str(lut_out), bundle)
+    mapping.flags.writeable = False
+    return mapping
+
+
+def apply_mapping(labels: np.ndarray, mapping: np.ndarray) -> np.ndarray:
+    """Remap an integer label array through a dense lookup array, setting labels that
+    are outside of the lookup table to 0"""
+    labels = np.asanyarray(labels)
+    if labels.size and (labels.min() < 0 or labels.max() >= len(mapping)):
+        valid = (labels >= 0) & (labels < len(mapping))
+        out = np.take(mapping, np.where(valid, labels, 0).astype(np.intp))
+        out[~valid] = 0
+        return out
+    return np.take(mapping, labels)
+
+
+def reorient_to_std(
+    data: np.ndarray, affine: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Permute/flip the axes of an image to the orientation of the MNI152 template, as
+    fslreorient2std does, returning the reoriented data (a view) and its affine"""
+    transform = ornt_transform(io_orientation(affine), axcodes2ornt(STD_AXCODES))
+    reoriented = apply_orientation(data, transform)
+    return reoriented, affine @ inv_ornt_aff(transform, data.shape)
+
+
+@python.define(outputs=["out_file"])
+def FusedLabelConvert(
+    in_file: File,
+    lut_in: str,
+    lut_out: str,
+    out_file: str,
+    threshold: int = 1000,
+    reorient_std: bool = True,
+    resource_bundle: str | None = None,
+) -> ImageFormatGz:
+    """Reorient to standard, threshold and relabel a label volume in a single pass,
+    writing the result straight to MIF (replaces the fslreorient2std ->
+    fslmaths -thr -> labelconvert chain).
+
+    The output is voxel-for-voxel identical to that of the chain it replaces, i.e.
+    labels below ``threshold`` are zeroed before the lookup-table conversion and the
+    result is stored as UInt32 with the standard-orientation layout. The lookup
+    array is taken from ``resource_bundle`` (see bundle.py) if it is packed in it.
+    """
+    img = nib.load(str(in_file))
+    data = np.asanyarray(img.dataobj)
+    affine = img.affine
+    if reorient_std:
+        data, affine = reorient_to_std(data, affine)
+    # fslmaths -thr zeroes values below the threshold
+    data = np.where(data < threshold, 0, data).astype(np.int64)
+    mapping = compiled_lut_mapping(lut_in, lut_out, open_bundle(resource_bundle))
+    relabelled = apply_mapping(data, mapping)
+    return save_mif(Path(out_file).absolute(), relabelled, affine)
+
+
+@python.define(outputs=["out_file"])
+def RelabelImage(
+    in_file: File,
+    lut_in: str,
+    lut_out: str,
+    out_file: str = "relabelled.mif",
+    resource_bundle: str | None = None,
+) -> Mif:
+    """Convert the labels of a parcellation image from one lookup table to another
+    (replaces labelconvert), using the compiled LUT cache and a single gather over the
+    memory-mapped input image. The output is UInt32 with the layout of the input."""
+    img = nib.load(str(in_file), mmap=True)
+    relabelled = apply_mapping(
+        np.asanyarray(img.dataobj),
+        compiled_lut_mapping(lut_in, lut_out, open_bundle(resource_bundle)),
+    )
+    return save_mif(Path(out_file).absolute(), relabelled, img.affine)
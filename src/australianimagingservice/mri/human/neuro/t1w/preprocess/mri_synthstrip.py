@@ -1,6 +1,19 @@
+import ast
+import logging
+import os
+import runpy
+import shlex
+import shutil
+import sys
+import typing as ty
+from pathlib import Path
 from fileformats.medimage import NiftiGz
 from fileformats.generic import File
-from pydra.compose import shell
+from pydra.compose import python, shell
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.mri_synthstrip"
+)
 
 
 @shell.define
@@ -71,3 +84,104 @@ class MriSynthstrip(shell.Task["MriSynthstrip.Outputs"]):
             path_template="sdt.nii.gz",
             default=None,
         )
+
+
+# Version of the SynthStrip model that the mri_synthstrip script must declare (as its
+# module-level ``version``) to be run in-process by MriSynthstripBatch
+SYNTHSTRIP_MODEL_VERSION = "1"
+
+
+def _synthstrip_script(script: ty.Optional[str] = None) -> ty.Optional[Path]:
+    """Locate the Python script behind mri_synthstrip (in FreeSurfer the executable on
+    the PATH is a wrapper around $FREESURFER_HOME/python/scripts/mri_synthstrip)"""
+    candidates = [script, shutil.which("mri_synthstrip")]
+    fs_home = os.environ.get("FREESURFER_HOME")
+    if fs_home:
+        candidates.append(os.path.join(fs_home, "python", "scripts", "mri_synthstrip"))
+    for candidate in candidates:
+        if not candidate or not os.path.isfile(candidate):
+            continue
+        with open(candidate, "rb") as f:
+            head = f.read(4096)
+        if b"StripModel" in head or b"python" in head.split(b"\n", 1)[0]:
+            return Path(candidate)
+    return None
+
+
+def synthstrip_script_version(script: ty.Union[str, Path]) -> ty.Optional[str]:
+    """The model version declared by an mri_synthstrip script (read from its source
+    without running it), or None if it doesn't declare one"""
+    tree = ast.parse(Path(script).read_text(), filename=str(script))
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or not isinstance(node.value, ast.Constant):
+            continue
+        if [getattr(t, "id", None) for t in node.targets] == ["version"]:
+            return str(node.value.value)
+    return None
+
+
+def _run_script(script: Path, args: list[str]) -> None:
+    """Run the mri_synthstrip script in this process, as if it had been called with
+    ``args`` on the command line"""
+    argv = sys.argv
+    sys.argv = [str(script), *args]
+    try:
+        runpy.run_path(str(script), run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError(f"{script} {shlex.join(args)} exited with {e.code}")
+    finally:
+        sys.argv = argv
+
+
+@python.define(outputs=["mask_files"])
+def MriSynthstripBatch(
+    in_files: list[File],
+    border: int = 1,
+    threads: int | None = None,
+    no_csf: bool = False,
+    gpu: bool = False,
+    model: File | None = None,
+    script: str | None = None,
+) -> list[NiftiGz]:
+    """Skull-strip a list of images with SynthStrip in a single process, returning a
+    binary brain mask for each (in the same order).
+
+    Each call of MriSynthstrip pays for starting Python and importing PyTorch, which
+    takes longer than the CPU inference on a mean b0, so here the installed
+    mri_synthstrip script is run on all the inputs in this one process (once the
+    first run has imported its dependencies, the later ones only load the model and
+    run the inference).
+
+    The script is only run in-process if it declares the pinned model version
+    (SYNTHSTRIP_MODEL_VERSION), and any failure is raised rather than falling back to
+    a subprocess per image, so a FreeSurfer upgrade that changes the script shows up
+    as an error instead of a silent slowdown.
+    """
+    script_path = _synthstrip_script(script)
+    if script_path is None:
+        raise RuntimeError(
+            "Could not find the mri_synthstrip Python script (pass its path as "
+            "'script' or set $FREESURFER_HOME)"
+        )
+    version = synthstrip_script_version(script_path)
+    if version != SYNTHSTRIP_MODEL_VERSION:
+        raise RuntimeError(
+            f"'{script_path}' declares SynthStrip model version {version!r}, whereas "
+            f"MriSynthstripBatch is pinned to {SYNTHSTRIP_MODEL_VERSION!r}"
+        )
+    options = ["-b", str(border)]
+    if threads:
+        options += ["-t", str(threads)]
+    if no_csf:
+        options.append("--no-csf")
+    if gpu:
+        options.append("-g")
+    if model:
+        options += ["--model", str(model)]
+    mask_files = [
+        Path(f"brain_mask_{i:03d}.nii.gz").absolute() for i in range(len(in_files))
+    ]
+    for in_file, mask_file in zip(in_files, mask_files):
+        _run_script(script_path, ["-i", str(in_file), "-m", str(mask_file), *options])
+    return mask_files
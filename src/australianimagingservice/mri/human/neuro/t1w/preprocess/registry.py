@@ -0,0 +1,208 @@
+"""Declarative registry of the parcellations (atlases) that can be generated from the
+FastSurfer outputs of a subject.
+
+Each atlas belongs to one of three families, which determine how it is generated:
+
+    "mica": MICA-MNI fsaverage5 annotation, projected into the cortical ribbon then
+        thresholded and relabelled into a single image (cortex only)
+    "annot": other fsaverage/fsaverage5 annotations (HCPMMP1, Yeo2011), projected into
+        the cortical ribbon, relabelled and with their sub-cortical grey matter
+        replaced by FIRST's segmentation
+    "freesurfer": volumetric FreeSurfer parcellations, relabelled and with their
+        sub-cortical grey matter replaced by FIRST's segmentation
+
+Paths are given relative to one of the roots passed to ``ParcellationEntry.resolve``:
+"resources" (the resources directory of this package), "freesurfer_home",
+"mrtrix_lut_dir" or "subject" (the FastSurfer subject directory).
+"""
+
+import typing as ty
+from dataclasses import dataclass
+from pathlib import Path
+
+FAMILIES = ("mica", "annot", "freesurfer")
+
+
+@dataclass(frozen=True)
+class ParcellationEntry:
+    """A single atlas in the registry
+
+    Parameters
+    ----------
+    name : str
+        the name of the parcellation
+    family : str
+        how the parcellation is generated, one of FAMILIES
+    parc_lut : tuple[str, str]
+        (root, relative path) of the lookup table the parcellation is labelled with
+    mrtrix_lut : tuple[str, str]
+        (root, relative path) of the lookup table the output is relabelled to
+    template : str, optional
+        the fsaverage template the annotations are defined on (surface atlases only)
+    source_annot : tuple[str, str], optional
+        (root, relative path) of the template annotations, with "{hemi}" in place of
+        the hemisphere (surface atlases only)
+    annot_short : str, optional
+        the name of the annotation in the subject's label/ directory (surface atlases
+        only), i.e. label/{hemi}.{annot_short}.annot
+    volume : tuple[str, str], optional
+        (root, relative path) of the parcellation volume (volumetric atlases only)
+    seg_only_volume : tuple[str, str], optional
+        (root, relative path) of the equivalent volume produced by FastSurfer's CNN
+        segmentation alone (i.e. --seg_only), for atlases that can be generated
+        without recon-surf
+    """
+
+    name: str
+    family: str
+    parc_lut: tuple[str, str]
+    mrtrix_lut: tuple[str, str]
+    template: ty.Optional[str] = None
+    source_annot: ty.Optional[tuple[str, str]] = None
+    annot_short: ty.Optional[str] = None
+    volume: ty.Optional[tuple[str, str]] = None
+    seg_only_volume: ty.Optional[tuple[str, str]] = None
+
+    def __post_init__(self) -> None:
+        if self.family not in FAMILIES:
+            raise ValueError(
+                f"Unrecognised family '{self.family}' for parcellation '{self.name}'"
+            )
+
+    @property
+    def is_surface(self) -> bool:
+        """Whether the atlas is defined on an fsaverage surface"""
+        return self.template is not None
+
+    @property
+    def replaces_sgm(self) -> bool:
+        """Whether the atlas has its sub-cortical grey matter replaced using FIRST"""
+        return self.family in ("annot", "freesurfer")
+
+    @property
+    def supports_seg_only(self) -> bool:
+        """Whether the atlas can be generated from FastSurfer's segmentation alone"""
+        return self.seg_only_volume is not None
+
+    @staticmethod
+    def resolve(
+        path: ty.Optional[tuple[str, str]], roots: dict[str, ty.Union[str, Path]]
+    ) -> str:
+        """Resolve a (root, relative path) pair against the given roots ("" if None)"""
+        if path is None:
+            return ""
+        root, relpath = path
+        return str(Path(roots[root]) / relpath)
+
+
+def _mica(name: str) -> ParcellationEntry:
+    return ParcellationEntry(
+        name=name,
+        family="mica",
+        parc_lut=("resources", f"mica-mni-parcellations/lut/lut_{name}_mics.csv"),
+        mrtrix_lut=("resources", f"neuro-parcellations/{name}_reordered_LUT.txt"),
+        template="fsaverage5",
+        source_annot=(
+            "resources",
+            f"mica-mni-parcellations/{{hemi}}.{name}_mics.annot",
+        ),
+        annot_short=f"{name}_mics",
+    )
+
+
+def _yeo(n_networks: int) -> ParcellationEntry:
+    yeo_dir = "yeo2011-parcellations"
+    return ParcellationEntry(
+        name=f"Yeo{n_networks}",
+        family="annot",
+        parc_lut=(
+            "resources",
+            f"{yeo_dir}/Yeo2011_{n_networks}networks_Split_Components_LUT.txt",
+        ),
+        mrtrix_lut=(
+            "resources",
+            f"neuro-parcellations/Yeo2011_{n_networks}N_split.txt",
+        ),
+        template="fsaverage5",
+        source_annot=(
+            "resources",
+            f"{yeo_dir}/{{hemi}}.Yeo2011_{n_networks}Networks_N1000.split_components.annot",
+        ),
+        annot_short=f"Yeo{n_networks}",
+    )
+
+
+PARCELLATIONS: dict[str, ParcellationEntry] = {
+    e.name: e
+    for e in [
+        _mica("aparca2009s"),
+        _mica("aparc"),
+        ParcellationEntry(
+            name="desikan",
+            family="freesurfer",
+            parc_lut=("freesurfer_home", "FreeSurferColorLUT.txt"),
+            mrtrix_lut=("mrtrix_lut_dir", "fs_default.txt"),
+            volume=("subject", "mri/aparc+aseg.mgz"),
+            # the DKT (Desikan-Killiany-Tourville) labels predicted by FastSurferCNN
+            seg_only_volume=("subject", "mri/aparc.DKTatlas+aseg.deep.mgz"),
+        ),
+        ParcellationEntry(
+            name="destrieux",
+            family="freesurfer",
+            parc_lut=("freesurfer_home", "FreeSurferColorLUT.txt"),
+            mrtrix_lut=("mrtrix_lut_dir", "fs_a2009s.txt"),
+            volume=("subject", "mri/aparc.a2009s+aseg.mgz"),
+        ),
+        _mica("economo"),
+        _mica("glasser360"),
+        ParcellationEntry(
+            name="hcpmmp1",
+            family="annot",
+            parc_lut=("resources", "neuro-parcellations/hcpmmp1_original.txt"),
+            mrtrix_lut=("resources", "neuro-parcellations/hcpmmp1_ordered.txt"),
+            template="fsaverage",
+            source_annot=("resources", "hcpmmp1-parcellations/{hemi}.HCPMMP1.annot"),
+            annot_short="HCPMMP1",
+        ),
+        *(_mica(f"schaefer{n}") for n in sorted(range(100, 1001, 100), key=str)),
+        *(_mica(f"vosdewael{n}") for n in (100, 200, 300, 400)),
+        _yeo(17),
+        _yeo(7),
+    ]
+}
+
+
+def get_parcellation(name: str) -> ParcellationEntry:
+    """Look up a parcellation in the registry by name"""
+    try:
+        return PARCELLATIONS[name]
+    except KeyError:
+        choices = ", ".join(f"'{p}'" for p in PARCELLATIONS)
+        raise ValueError(
+            f"Parcellation '{name}' not recognised. Please choose from: {choices}"
+        ) from None
+
+
+def select_parcellations(
+    names: ty.Optional[ty.Iterable[str]], seg_only: bool = False
+) -> list[str]:
+    """Validate a selection of parcellations, returning all of them (in registry order)
+    if none are selected. With ``seg_only``, only atlases that can be generated from
+    FastSurfer's segmentation alone are allowed (and selected by default)."""
+    if names is None:
+        return [
+            n for n, e in PARCELLATIONS.items() if e.supports_seg_only or not seg_only
+        ]
+    names = list(dict.fromkeys(names))
+    for name in names:
+        entry = get_parcellation(name)
+        if seg_only and not entry.supports_seg_only:
+            choices = ", ".join(
+                f"'{n}'" for n, e in PARCELLATIONS.items() if e.supports_seg_only
+            )
+            raise ValueError(
+                f"Parcellation '{name}' needs FastSurfer's surface reconstruction, so "
+                "can't be generated in segmentation-only mode. Please choose from: "
+                f"{choices}"
+            )
+    return names
@@ -1,28 +1,23 @@
 import logging
 
 from pydra.compose import workflow
-from pydra.tasks.fsl.v6 import Reorient2Std, Threshold
-from pydra.tasks.freesurfer.v8 import (
-    SurfaceTransform,
-    Label2Vol,
-    Aparc2Aseg,
-)
-from pydra.tasks.mrtrix3.v3_1 import (
-    LabelConvert,
-    Fivett2Vis,
-    FivettGen_Hsvs,
-    FivettGen_Freesurfer,
-    FivettGen_Fsl,
-    LabelSgmfirst,
-)
 from fileformats.generic import Directory, File
 from fileformats.medimage import NiftiGz
 from fileformats.vendor.mrtrix3.medimage import ImageFormat as Mif, ImageFormatGz
-from pydra.environments.docker import Docker
-from pydra.environments.native import Native
-from pydra.tasks.fastsurfer.latest import Fastsurfer
+from .bundle import find_bundle
+from .fastsurfer import FastsurferStage, fastsurfer_images
+from .first import FirstSegmentation, SgmReplace
+from .fivett import FivettStage
 from .helpers import JoinTaskCatalogue
+from .labels import FusedLabelConvert, RelabelImage
 from .mri_synthstrip import MriSynthstrip
+from .registry import get_parcellation, select_parcellations
+from .surface import (
+    SurfaceCorrespondence,
+    RibbonProjection,
+    ResampleAnnotation,
+    AnnotationToVolume,
+)
 
 # from pydra.engine.task import FunctionTask
 # from pydra.engine.specs import BaseSpec
@@ -61,6 +56,13 @@ def SingleParcellation(
     fastsurfer_batch: int = 16,
     labelsgmfirst_executable: str = "labelsgmfix",
     fastsurfer_nthreads: int = 24,
+    fastsurfer_dir: Directory | None = None,
+    generate_5tt: bool = True,
+    first_sgm_image: NiftiGz | None = None,
+    fastsurfer_store: Path | None = None,
+    seg_only: bool = False,
+    surface_correspondence: File | None = None,
+    ribbon_projection: File | None = None,
 ) -> tuple[
     ImageFormatGz,
     Mif | None,
@@ -72,139 +74,65 @@ def SingleParcellation(
     Directory,
 ]:
 
+    entry = get_parcellation(parcellation)
+    # In segmentation-only mode (FastSurfer without recon-surf) only the atlases that
+    # FastSurferCNN predicts directly are available
+    select_parcellations([parcellation], seg_only=seg_only)
+
+    # The native tasks read their annotations/LUTs from the packed resources bundle
+    # when one has been built (see bundle.py), instead of parsing the files
+    bundle = find_bundle(resources_dir)
+    resource_bundle = str(bundle) if bundle else None
+
     # ###################
     # # FASTSURFER TASK #
     # ###################
 
-    if in_fastsurfer_container:
-        fs_environment = Native()
-        # executable = "/fastsurfer-run/run-script.sh"
-        logger.info(f"Using FastSurfer executable in container")
-    else:
-        fs_environment = Docker(
-            image="deepmi/fastsurfer",
-            tag="cpu-v2.4.2",
-            xargs=[
-                "--user",
-                "1000:1000",
-                "--entrypoint",
-                "/bin/bash",
-            ],
+    if fastsurfer_dir is None:
+        fastsurfer = workflow.add(
+            FastsurferStage(
+                t1w=t1w,
+                fs_license=fs_license,
+                subjects_dir=subjects_dir,
+                in_fastsurfer_container=in_fastsurfer_container,
+                fastsurfer_batch=fastsurfer_batch,
+                fastsurfer_nthreads=fastsurfer_nthreads,
+                fastsurfer_store=fastsurfer_store,
+                seg_only=seg_only,
+            )
         )
-        # executable = "/fastsurfer/run_fastsurfer.sh"
-
-        logger.info(f"Using FastSurfer in separate Docker container")
-
-    fastsurfer = workflow.add(
-        Fastsurfer(
-            # executable=executable,
-            T1_files=t1w,
-            fs_license=fs_license,
-            subject_id="FS_outputs",
-            # norm_img="norm.mgz",
-            # aparcaseg_img="aparcaseg.mgz",
-            fsaparc=True,
-            parallel=True,
-            batch=fastsurfer_batch,
-            threads=fastsurfer_nthreads,
-            subjects_dir=subjects_dir,
-            allow_root=True,
-        ),
-        environment=fs_environment,
-    )
-
-    logger.info("Fastsurfer executable is '%s'", fastsurfer.inputs.executable)
-
-    if in_fastsurfer_container:
-        fastsurfer.inputs.py = "/venv/bin/python"
-        fastsurfer.inputs.executable = "/fastsurfer/run_fastsurfer.sh"
+        fs_dir = fastsurfer.subjects_dir_output
+        norm_img = fastsurfer.norm_img
+        aparcaseg_img = fastsurfer.aparcaseg_img
     else:
-        fastsurfer.inputs.py = "/venv/bin/python"
+        # FastSurfer has already been run upstream (e.g. once per subject in
+        # AllParcellations), so reuse its outputs instead of running it again
+        logger.info("Using precomputed FastSurfer outputs in '%s'", fastsurfer_dir)
+        fs_dir = fastsurfer_dir
+        norm_img, aparcaseg_img = fastsurfer_images(fastsurfer_dir, seg_only)
 
     # #################################################
     # # FIVE TISSUE TYPE Generation and visualisation #
     # #################################################
-    if (
-        parcellation
-        == parcellation  # this loop is a placeholder for if/when we decide to iterate through each parcellation image"aparc-a2009s"
-    ):  # to avoid repeating this on every iteration of loop, only exectute on one (first) parcellation
-
-        # Five tissue-type task HSVS
-        fTTgen_task_hsvs = workflow.add(
-            FivettGen_Hsvs(
-                in_file=fastsurfer.subjects_dir_output,
-                # out_file="5TT_hsvs.mif.gz",
-                nocrop=True,
-                sgm_amyg_hipp=True,
-                nocleanup=True,
-                white_stem=True,
-                config=None,
-            )
-        )
-
-        # Five tissue-type visualisation task HSVS
-        fTTvis_task_hsvs = workflow.add(
-            Fivett2Vis(
-                in_file=fTTgen_task_hsvs.out_file,
-                # out_file="5TTvis_hsvs.mif.gz",
-                config=None,
-            ),
-            name="fTTvis_task_hsvs",
-        )
-
-        # Five tissue-type task FreeSurfer
-
-        fTTgen_task_freesurfer = workflow.add(
-            FivettGen_Freesurfer(
-                in_file=fastsurfer.aparcaseg_img,
-                # out_file="5TT_freesurfer.mif.gz",
-                nocrop=True,
-                sgm_amyg_hipp=True,
-                nocleanup=True,
-                config=None,
-            )
-        )
 
-        # Five tissue-type visualisation task FreeSurfer
-        fTTvis_task_freesurfer = workflow.add(
-            Fivett2Vis(
-                in_file=fTTgen_task_freesurfer.out_file,
-                # out_file="5TTvis_freesurfer.mif.gz",
-                config=None,
-            ),
-            name="fTTvis_task_freesurfer",
-        )
-
-        # Five tissue-type task fsl
-
-        fTTgen_task_fsl = workflow.add(
-            FivettGen_Fsl(
-                in_file=fastsurfer.norm_img,
-                # out_file="5TT_fsl.mif.gz",
-                nocrop=True,
-                sgm_amyg_hipp=True,
-                nocleanup=True,
-                premasked=True,
-                config=None,
+    if generate_5tt:
+        fTT_task = workflow.add(
+            FivettStage(
+                fastsurfer_dir=fs_dir,
+                norm_img=norm_img,
+                aparcaseg_img=aparcaseg_img,
+                seg_only=seg_only,
             )
         )
-
-        # Five tissue-type visualisation task FSL
-        fTTvis_task_fsl = workflow.add(
-            Fivett2Vis(
-                in_file=fTTgen_task_fsl.out_file,
-                #    out_file="5TTvis_fsl.mif.gz",
-                config=None,
-            ),
-            name="fTTvis_task_fsl",
-        )
-        fTTgen_task_hsvs_out = fTTgen_task_hsvs.out_file
-        fTTvis_task_hsvs_out = fTTvis_task_hsvs.out_file
-        fTTgen_task_freesurfer_out = fTTgen_task_freesurfer.out_file
-        fTTvis_task_freesurfer_out = fTTvis_task_freesurfer.out_file
-        fTTgen_task_fsl_out = fTTgen_task_fsl.out_file
-        fTTvis_task_fsl_out = fTTvis_task_fsl.out_file
+        fTTgen_task_hsvs_out = fTT_task.ftt_image_hsvs
+        fTTvis_task_hsvs_out = fTT_task.vis_image_hsvs
+        fTTgen_task_freesurfer_out = fTT_task.ftt_image_freesurfer
+        fTTvis_task_freesurfer_out = fTT_task.vis_image_freesurfer
+        fTTgen_task_fsl_out = fTT_task.ftt_image_fsl
+        fTTvis_task_fsl_out = fTT_task.vis_image_fsl
     else:
+        # 5TT images are generated elsewhere (e.g. once per subject in
+        # AllParcellations) or not required
         fTTgen_task_hsvs_out = None
         fTTvis_task_hsvs_out = None
         fTTgen_task_freesurfer_out = None
@@ -218,133 +146,88 @@ def SingleParcellation(
 
     join_task = workflow.add(
         JoinTaskCatalogue(
-            FS_dir=fastsurfer.subjects_dir_output,  # FS_dir,
+            FS_dir=fs_dir,
             parcellation=parcellation,
             freesurfer_home=freesurfer_home,
             mrtrix_lut_dir=mrtrix_lut_dir,
             resources_dir=resources_dir,
+            seg_only=seg_only,
         )  # pyright: ignore[reportArgumentType]
     )
 
+    ###################################################
+    # SUBJECT <-> FSAVERAGE / RIBBON CORRESPONDENCES  #
+    ###################################################
+
+    # The vertex correspondence and ribbon projection may have already been built
+    # upstream (e.g. once per subject in AllParcellations)
+    is_surface_atlas = entry.is_surface
+    correspondence = surface_correspondence
+    if is_surface_atlas and correspondence is None:
+        correspondence = workflow.add(
+            SurfaceCorrespondence(
+                fastsurfer_dir=fs_dir,
+                freesurfer_home=freesurfer_home,
+                templates=(entry.template,),
+            )
+        ).correspondence
+    if is_surface_atlas and ribbon_projection is None:
+        ribbon_projection = workflow.add(
+            RibbonProjection(fastsurfer_dir=fs_dir)
+        ).out_file
+
     #########################
     # # v2 atlas processing #
     #########################
 
-    if (
-        "schaefer" in parcellation
-        or "aparc" in parcellation
-        or "vosdewael" in parcellation
-        or parcellation == "economo"
-        or parcellation == "glasser360"
-    ):
-
-        ##################################
-        # mri_surf2surf task - lh and rh #
-        ##################################
-        hemispheres = ["lh"]
-        # mri_s2s_tasks = {}
-        for hemi in hemispheres:
-            mri_s2s_task1_v2atlas = workflow.add(
-                SurfaceTransform(
-                    source_subject=join_task.fsavg_dir,
-                    target_subject=fastsurfer.subjects_dir_output,
-                    source_annot_file=getattr(
-                        join_task, f"source_annotation_file_{hemi}"
-                    ),
-                    out_file=getattr(join_task, f"{hemi}_annotation"),
-                    hemi=hemi,
-                ),
-                name="mri_s2s_task_lh",
-            )
-
-        hemispheres = ["rh"]
-        # mri_s2s_tasks2 = {}
-        for hemi in hemispheres:
-            mri_s2s_task2_v2atlas = workflow.add(
-                SurfaceTransform(
-                    source_subject=join_task.fsavg_dir,
-                    target_subject=fastsurfer.subjects_dir_output,
-                    source_annot_file=getattr(
-                        join_task, f"source_annotation_file_{hemi}"
-                    ),
-                    out_file=getattr(join_task, f"{hemi}_annotation"),
-                    hemi=hemi,
-                ),
-                name="mri_s2s_task_rh",
-            )
-
-        # ###########################################################
-        # # dummy task to ensure aparc2aseg occurs after surf2surf  #
-        # ###########################################################
-
-        # dependency_task = workflow.add(
-        #     Dependency(
-        #         subjects_dir=join_task.fsavg_dir,
-        #         annot_file_lh=mri_s2s_task1.out_file,
-        #         annot_file_rh=mri_s2s_task2.out_file,
-        #     )
-        # )
-        # ########################
-        # # mri_aparc2aseg task  #
-        # ########################
-
-        mri_a2a_task_v2atlas = workflow.add(
-            Aparc2Aseg(
-                subject_id=fastsurfer.subjects_dir_output,
-                annot=join_task.annot_short,
-                volmask=True,  # same as --new-ribbon
-                lh_annotation=mri_s2s_task1_v2atlas.out_file,
-                rh_annotation=mri_s2s_task2_v2atlas.out_file,
+    if entry.family == "mica":
+
+        ##########################################
+        # annotation resampling task - lh and rh #
+        ##########################################
+        resample_annot_v2atlas = workflow.add(
+            ResampleAnnotation(
+                correspondence=correspondence,
+                fsavg_dir=join_task.fsavg_dir,
+                source_annotation_file_lh=join_task.source_annotation_file_lh,
+                source_annotation_file_rh=join_task.source_annotation_file_rh,
+                lh_annotation=join_task.lh_annotation,
+                rh_annotation=join_task.rh_annotation,
+                resource_bundle=resource_bundle,
             ),
-            name="mri_a2a_task_v2atlasprocessing",
-        )
-
-        # ##########################
-        # # mri_label2volume task  #
-        # ##########################
-
-        mri_l2v_task = workflow.add(
-            Label2Vol(
-                seg_file=mri_a2a_task_v2atlas.out_file,  # volfile,
-                template_file=join_task.l2v_temp,
-                reg_header=join_task.l2v_regheader,
-            )
-        )
-
-        # reorient to standard
-        fslreorient2std_task = workflow.add(
-            Reorient2Std(
-                in_file=mri_l2v_task.vol_label_file,  # l2v_mgz2nii_task.out_file,
-            )
+            name="resample_annot_task",
         )
 
-        # remove values less than 1000
-        threshold_task = workflow.add(
-            Threshold(
-                # name="threshold_task",
-                # executable="fslmaths",
-                # input_spec=fslthreshold_input_spec,
-                # output_spec=fslthreshold_output_spec,
-                # output_image="label2vol_out_std_threshold.nii.gz",  # join_task.output_parcellation_filename,
-                in_file=fslreorient2std_task.out_file,
-                use_robust_range=False,
-                thresh=1000,
-            )
+        ########################################
+        # ribbon projection (aparc2aseg) task  #
+        ########################################
+
+        annot2vol_task_v2atlas = workflow.add(
+            AnnotationToVolume(
+                fastsurfer_dir=fs_dir,
+                ribbon_projection=ribbon_projection,
+                lh_annotation=resample_annot_v2atlas.lh_annotation,
+                rh_annotation=resample_annot_v2atlas.rh_annotation,
+                out_file=f"{parcellation}+aseg.nii",
+            ),
+            name="annot2vol_task_v2atlasprocessing",
         )
 
-        # relabel segmenetation to ascending integers from 1 to N
+        # reorient to standard, remove values less than 1000 and relabel
+        # segmentation to ascending integers from 1 to N in a single pass
         LabelConvert_task = workflow.add(
-            LabelConvert(
-                path_in=threshold_task.out_file,
+            FusedLabelConvert(
+                in_file=annot2vol_task_v2atlas.out_file,
                 lut_in=join_task.parc_lut_file,
                 lut_out=join_task.mrtrix_lut_file,
-                image_out=join_task.final_parc_image,  # type: ignore[]
-                # name="LabelConvert_task",
-                config=None,
-            )
+                out_file=join_task.final_parc_image,
+                threshold=1000,
+                resource_bundle=resource_bundle,
+            ),
+            name="LabelConvert_task",
         )
 
-        return_image = LabelConvert_task.image_out
+        return_image = LabelConvert_task.out_file
 
     # else:
     #     return_image = SGMfix_task.out_file
@@ -355,72 +238,79 @@ def SingleParcellation(
 
     volfile = join_task.output_parcellation_filename
 
-    if parcellation in ["hcpmmp1", "Yeo17", "Yeo7"]:
-        ##################################
-        # mri_surf2surf task - lh and rh #
-        ##################################
-        mri_s2s_task_originals_lh = workflow.add(
-            SurfaceTransform(
-                source_subject=join_task.fsavg_dir,
-                target_subject=fastsurfer.subjects_dir_output,
-                source_annot_file=join_task.source_annotation_file_lh,
-                out_file=join_task.lh_annotation,
-                hemi="lh",
+    if entry.family == "annot":
+        ##########################################
+        # annotation resampling task - lh and rh #
+        ##########################################
+        resample_annot_originals = workflow.add(
+            ResampleAnnotation(
+                correspondence=correspondence,
+                fsavg_dir=join_task.fsavg_dir,
+                source_annotation_file_lh=join_task.source_annotation_file_lh,
+                source_annotation_file_rh=join_task.source_annotation_file_rh,
+                lh_annotation=join_task.lh_annotation,
+                rh_annotation=join_task.rh_annotation,
+                resource_bundle=resource_bundle,
             ),
-            name="mri_s2s_task_originals_lh",
+            name="resample_annot_task_originals",
         )
 
-        mri_s2s_task_originals_rh = workflow.add(
-            SurfaceTransform(
-                source_subject=join_task.fsavg_dir,
-                target_subject=fastsurfer.subjects_dir_output,
-                source_annot_file=join_task.source_annotation_file_rh,
-                out_file=join_task.rh_annotation,
-                hemi="rh",
+        ########################################
+        # ribbon projection (aparc2aseg) task  #
+        ########################################
+
+        annot2vol_task_originals = workflow.add(
+            AnnotationToVolume(
+                fastsurfer_dir=fs_dir,
+                ribbon_projection=ribbon_projection,
+                lh_annotation=resample_annot_originals.lh_annotation,
+                rh_annotation=resample_annot_originals.rh_annotation,
+                out_file=f"{parcellation}+aseg.nii",
             ),
-            name="mri_s2s_task_originals_rh",
-        )
-
-        # ########################
-        # # mri_aparc2aseg task  #
-        # ########################
-
-        mri_a2a_task_originals = workflow.add(
-            Aparc2Aseg(
-                subject_id=fastsurfer.subjects_dir_output,
-                annot=join_task.annot_short,
-                volmask=True,
-                lh_annotation=mri_s2s_task_originals_lh.out_file,
-                rh_annotation=mri_s2s_task_originals_rh.out_file,
-            )
+            name="annot2vol_task_originals",
         )
 
-        volfile = mri_a2a_task_originals.out_file
+        volfile = annot2vol_task_originals.out_file
 
-    if parcellation in ["destrieux", "desikan", "hcpmmp1", "Yeo17", "Yeo7"]:
+    if entry.replaces_sgm:
         # relabel segmenetation to integers
         LabelConvert_task_originals = workflow.add(
-            LabelConvert(
-                path_in=volfile,
+            RelabelImage(
+                in_file=volfile,
                 lut_in=join_task.parc_lut_file,
                 lut_out=join_task.mrtrix_lut_file,
-                # image_out="labelconvert.mif",  # join_task.node_image,
-                config=None,
-            )
+                out_file="labelconvert.mif",
+                resource_bundle=resource_bundle,
+            ),
+            name="LabelConvert",
         )
 
+        # FIRST only needs to be run once per subject, so it is skipped here if its
+        # segmentation has been provided (e.g. by AllParcellations)
+        if first_sgm_image is None:
+            first_task = workflow.add(
+                FirstSegmentation(
+                    fastsurfer_dir=fs_dir,
+                    # without recon-surf there is no skull-stripped norm.mgz
+                    premasked=not seg_only,
+                    sgm_amyg_hipp=True,
+                    t1_image="orig.mgz" if seg_only else "norm.mgz",
+                )
+            )
+            sgm_image = first_task.sgm_image
+        else:
+            sgm_image = first_sgm_image
+
         sgm_first = workflow.add(
-            LabelSgmfirst(
-                parc=LabelConvert_task_originals.image_out,
-                t1=join_task.normimg_path,
+            SgmReplace(
+                parc=LabelConvert_task_originals.out_file,
+                sgm_image=sgm_image,
                 lut=join_task.mrtrix_lut_file,
-                # out_file=join_task.final_parc_image,
-                nocleanup=True,
-                premasked=True,
                 sgm_amyg_hipp=True,
-                executable=labelsgmfirst_executable,
-                config=None,
-            )
+                out_file=join_task.final_parc_image,
+                resource_bundle=resource_bundle,
+            ),
+            name="LabelSgmfirst",
         )
 
         return_image = sgm_first.out_file
@@ -435,5 +325,5 @@ def SingleParcellation(
         fTTgen_task_freesurfer_out,
         fTTvis_task_hsvs_out,
         fTTgen_task_hsvs_out,
-        fastsurfer.subjects_dir_output,
+        fs_dir,
     )
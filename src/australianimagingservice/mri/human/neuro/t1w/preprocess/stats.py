@@ -0,0 +1,151 @@
+"""Per-region statistics of the parcellations (voxel count, volume and mean intensity),
+computed with a single ``np.bincount`` pass over each label image rather than running
+mrstats/labelstats per atlas and region."""
+
+import csv
+import logging
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from australianimagingservice.mri.human.neuro.mif import load_mif
+from .labels import parse_lut
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.stats"
+)
+
+REGION_STATS_NAME = "region_stats.csv"
+REGION_STATS_COLUMNS = (
+    "atlas",
+    "index",
+    "name",
+    "voxels",
+    "volume_mm3",
+    "mean_intensity",
+)
+
+
+def _load_labels(path: Path) -> tuple[np.ndarray, np.ndarray]:
+    if path.name.endswith((".mif", ".mif.gz")):
+        data, affine = load_mif(path)
+    else:
+        img = nib.load(str(path))
+        data, affine = np.asanyarray(img.dataobj), img.affine
+    return data, affine
+
+
+def region_stats(
+    labels: np.ndarray,
+    affine: np.ndarray,
+    intensity: ty.Optional[np.ndarray] = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Voxel counts, volumes (mm³) and mean intensities of every label in an image
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        the label image (3D, non-negative integer labels)
+    affine : np.ndarray
+        the voxel -> scanner affine of the label image
+    intensity : np.ndarray, optional
+        an intensity image on the same voxel grid (and in the same axis order)
+
+    Returns
+    -------
+    indices : np.ndarray
+        the labels present in the image (excluding 0)
+    voxels : np.ndarray
+        the number of voxels of each label
+    volumes : np.ndarray
+        the volume of each label in mm³
+    means : np.ndarray
+        the mean intensity of each label (NaN without an intensity image)
+    """
+    flat = np.asarray(labels).reshape(-1).astype(np.int64, copy=False)
+    if flat.size and flat.min() < 0:
+        raise ValueError("Label images must not contain negative labels")
+    counts = np.bincount(flat)
+    indices = np.flatnonzero(counts)
+    indices = indices[indices != 0]
+    voxels = counts[indices]
+    volumes = voxels * abs(np.linalg.det(affine[:3, :3]))
+    if intensity is not None:
+        sums = np.bincount(
+            flat,
+            weights=np.asarray(intensity, dtype=np.float64).reshape(-1),
+            minlength=counts.size,
+        )
+        means = sums[indices] / voxels
+    else:
+        means = np.full(indices.shape, np.nan)
+    return indices, voxels, volumes, means
+
+
+def write_region_stats(
+    atlases: dict[str, Path],
+    luts: dict[str, ty.Optional[Path]],
+    intensity_image: ty.Optional[Path],
+    out_file: Path,
+) -> Path:
+    """Write a table of the regions of all atlases of a subject, with their voxel
+    count, volume and mean intensity in ``intensity_image`` (e.g. norm.mgz), naming
+    the regions from the atlases' lookup tables"""
+    intensity_img = None
+    if intensity_image is not None and Path(intensity_image).exists():
+        intensity_img = nib.load(str(intensity_image))
+        intensity_data = np.asanyarray(intensity_img.dataobj)
+    reoriented: dict[bytes, np.ndarray] = {}
+
+    rows = []
+    for atlas, path in sorted(atlases.items()):
+        labels, affine = _load_labels(Path(path))
+        labels = labels.reshape(labels.shape[:3])
+        intensity = None
+        if intensity_img is not None:
+            # The atlases are on the T1 grid, but may store it in another axis order
+            ornt = nib.orientations.ornt_transform(
+                nib.orientations.io_orientation(intensity_img.affine),
+                nib.orientations.io_orientation(affine),
+            )
+            key = ornt.tobytes()
+            if key not in reoriented:
+                reoriented[key] = nib.orientations.apply_orientation(
+                    intensity_data, ornt
+                )
+            intensity = reoriented[key]
+            if intensity.shape[:3] != labels.shape:
+                logger.warning(
+                    "%s %s does not match the grid of atlas %s %s, so its mean "
+                    "intensities are left empty",
+                    intensity_image,
+                    intensity.shape,
+                    atlas,
+                    labels.shape,
+                )
+                intensity = None
+        names: dict[int, str] = {}
+        lut = luts.get(atlas)
+        if lut is not None and Path(lut).exists():
+            for index, name in parse_lut(lut):
+                names.setdefault(index, name)
+        for index, voxels, volume, mean in zip(
+            *region_stats(labels, affine, intensity)
+        ):
+            rows.append(
+                (
+                    atlas,
+                    int(index),
+                    names.get(int(index), ""),
+                    int(voxels),
+                    f"{volume:.3f}",
+                    "" if np.isnan(mean) else f"{mean:.4f}",
+                )
+            )
+
+    out_file = Path(out_file)
+    with open(out_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(REGION_STATS_COLUMNS)
+        writer.writerows(rows)
+    return out_file
@@ -0,0 +1,268 @@
+import logging
+import typing as ty
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import nibabel.freesurfer.io as fsio
+from fileformats.generic import Directory, File
+from fileformats.medimage import Nifti1
+from pydra.compose import python
+from .bundle import ResourceBundle, open_bundle
+
+logger = logging.getLogger(
+    "australianimagingservice.mri.human.neuro.t1w.preprocess.surface"
+)
+
+HEMISPHERES = ("lh", "rh")
+
+# Templates that the atlases in resources/ are defined on (see JoinTaskCatalogue)
+FSAVERAGE_TEMPLATES = ("fsaverage", "fsaverage5")
+
+# Cortical labels used in ribbon.mgz/aseg.mgz and the offsets that mri_aparc2aseg adds
+# to the annotation's colour-table index for each hemisphere
+CORTEX_LABELS = {"lh": 3, "rh": 42}
+ANNOT_LABEL_OFFSETS = {"lh": 1000, "rh": 2000}
+
+
+def correspondence_key(template: str, hemi: str) -> str:
+    """Key of the index of a template/hemisphere in the correspondence .npz"""
+    return f"{template}_{hemi}"
+
+
+def build_correspondence_index(
+    fastsurfer_dir: ty.Union[str, Path],
+    template_dir: ty.Union[str, Path],
+    hemi: str,
+) -> np.ndarray:
+    """Build the nearest-neighbour correspondence between the vertices of the subject's
+    registered sphere and the template's sphere.
+
+    Parameters
+    ----------
+    fastsurfer_dir : str or Path
+        the FastSurfer/FreeSurfer subject directory
+    template_dir : str or Path
+        the template subject directory (e.g. $FREESURFER_HOME/subjects/fsaverage5)
+    hemi : str
+        the hemisphere, "lh" or "rh"
+
+    Returns
+    -------
+    index : np.ndarray[int32]
+        for each subject vertex, the index of the nearest template vertex on the sphere
+    """
+    from scipy.spatial import cKDTree
+
+    subject_sphere = Path(fastsurfer_dir) / "surf" / f"{hemi}.sphere.reg"
+    template_sphere = Path(template_dir) / "surf" / f"{hemi}.sphere.reg"
+    logger.info(
+        "Building %s vertex correspondence between %s and %s",
+        hemi,
+        fastsurfer_dir,
+        Path(template_dir).name,
+    )
+    template_coords, _ = fsio.read_geometry(str(template_sphere))
+    subject_coords, _ = fsio.read_geometry(str(subject_sphere))
+    _, index = cKDTree(template_coords).query(subject_coords, k=1)
+    return index.astype(np.int32)
+
+
+def build_correspondence(
+    fastsurfer_dir: ty.Union[str, Path],
+    freesurfer_home: ty.Union[str, Path],
+    templates: ty.Sequence[str],
+    out_file: ty.Union[str, Path],
+) -> Path:
+    """Write the correspondence indices of both hemispheres of the subject with each
+    template into a single .npz, keyed by ``correspondence_key``"""
+    indices = {}
+    for template in templates:
+        template_dir = Path(freesurfer_home) / "subjects" / template
+        for hemi in HEMISPHERES:
+            indices[correspondence_key(template, hemi)] = build_correspondence_index(
+                fastsurfer_dir, template_dir, hemi
+            )
+    with open(out_file, "wb") as f:
+        np.savez(f, **indices)
+    return Path(out_file)
+
+
+def build_ribbon_projection(
+    fastsurfer_dir: ty.Union[str, Path], out_file: ty.Union[str, Path]
+) -> Path:
+    """Build the map from each cortical-ribbon voxel to its nearest vertex on either the
+    white or pial surface of the same hemisphere, i.e. the geometric part of
+    ``mri_aparc2aseg --volmask`` that does not depend on the annotation.
+
+    Parameters
+    ----------
+    fastsurfer_dir : str or Path
+        the FastSurfer/FreeSurfer subject directory
+    out_file : str or Path
+        the .npz to write the map to, holding "{hemi}_voxels" (flat voxel indices into
+        ribbon.mgz) and "{hemi}_vertices" (the corresponding surface vertex indices)
+        for each hemisphere
+
+    Returns
+    -------
+    out_file : Path
+        the written map
+    """
+    from scipy.spatial import cKDTree
+
+    fs_dir = Path(fastsurfer_dir)
+    logger.info("Building cortical ribbon projection for %s", fs_dir)
+    ribbon = nib.load(str(fs_dir / "mri" / "ribbon.mgz"))
+    ribbon_data = np.asanyarray(ribbon.dataobj).ravel(order="F")
+    vox2ras_tkr = ribbon.header.get_vox2ras_tkr()
+
+    projection = {}
+    for hemi in HEMISPHERES:
+        voxels = np.flatnonzero(ribbon_data == CORTEX_LABELS[hemi])
+        ijk = np.column_stack(np.unravel_index(voxels, ribbon.shape, order="F"))
+        coords = ijk @ vox2ras_tkr[:3, :3].T + vox2ras_tkr[:3, 3]
+        white, _ = fsio.read_geometry(str(fs_dir / "surf" / f"{hemi}.white"))
+        pial, _ = fsio.read_geometry(str(fs_dir / "surf" / f"{hemi}.pial"))
+        # Query the white and pial surfaces together and take whichever is closer
+        _, nearest = cKDTree(np.vstack([white, pial])).query(coords, k=1)
+        projection[f"{hemi}_voxels"] = voxels.astype(np.int64)
+        projection[f"{hemi}_vertices"] = (nearest % len(white)).astype(np.int32)
+
+    with open(out_file, "wb") as f:
+        np.savez(f, **projection)
+    return Path(out_file)
+
+
+def annotation_to_volume(
+    fastsurfer_dir: ty.Union[str, Path],
+    ribbon_projection: ty.Union[str, Path],
+    lh_annotation: ty.Union[str, Path],
+    rh_annotation: ty.Union[str, Path],
+    out_file: ty.Union[str, Path],
+) -> Path:
+    """Label the cortical ribbon of aseg.mgz with a pair of subject-space annotations
+    (offset by 1000/2000 as mri_aparc2aseg does) via the ribbon projection.
+
+    Cortical aseg voxels outside of the ribbon are set to 0, as per ``--volmask``.
+    Ribbon voxels projecting to unlabelled vertices keep their aseg cortex label.
+    """
+    aseg = nib.load(str(Path(fastsurfer_dir) / "mri" / "aseg.mgz"))
+    labels = np.asanyarray(aseg.dataobj).astype(np.int32).ravel(order="F")
+    labels[np.isin(labels, list(CORTEX_LABELS.values()))] = 0
+
+    with np.load(str(ribbon_projection)) as projection:
+        for hemi, annot_file in (("lh", lh_annotation), ("rh", rh_annotation)):
+            annot_labels, _, _ = fsio.read_annot(str(annot_file))
+            voxels = projection[f"{hemi}_voxels"]
+            vertex_labels = annot_labels[projection[f"{hemi}_vertices"]]
+            labels[voxels] = np.where(
+                vertex_labels >= 0,
+                vertex_labels + ANNOT_LABEL_OFFSETS[hemi],
+                CORTEX_LABELS[hemi],
+            )
+
+    out_img = nib.Nifti1Image(labels.reshape(aseg.shape, order="F"), aseg.affine)
+    out_img.set_data_dtype(np.int32)
+    nib.save(out_img, str(out_file))
+    return Path(out_file)
+
+
+def resample_annotation(
+    index: np.ndarray,
+    source_annot: ty.Union[str, Path],
+    out_file: ty.Union[str, Path],
+    bundle: ty.Optional[ResourceBundle] = None,
+) -> Path:
+    """Map an annotation defined on a template surface onto the subject surface via a
+    precomputed correspondence index (i.e. a single vectorised gather), reading the
+    template annotation from the resources bundle if it is packed in it"""
+    annot = bundle.annotation(source_annot) if bundle is not None else None
+    if annot is None:
+        annot = fsio.read_annot(str(source_annot))
+    labels, ctab, names = annot
+    fsio.write_annot(
+        str(out_file),
+        labels[index],
+        ctab,
+        [n.decode() if isinstance(n, bytes) else n for n in names],
+        fill_ctab=False,
+    )
+    return Path(out_file)
+
+
+@python.define(outputs=["correspondence"])
+def SurfaceCorrespondence(
+    fastsurfer_dir: Directory,
+    freesurfer_home: Directory,
+    templates: tuple[str, ...] = FSAVERAGE_TEMPLATES,
+    out_file: str = "nn_index.npz",
+) -> File:
+    """Build the per-hemisphere vertex correspondence between the subject's registered
+    sphere and each fsaverage template once, as compact index arrays that are shared by
+    the ResampleAnnotation tasks of every surface-based atlas.
+
+    The indices are written to the task's own directory, not to the FastSurfer outputs
+    (which are an input and mustn't change), so they are cached by pydra on the
+    checksums of the subject's surfaces.
+    """
+    return build_correspondence(
+        fastsurfer_dir, freesurfer_home, templates, Path(out_file).absolute()
+    )
+
+
+@python.define(outputs=["lh_annotation", "rh_annotation"])
+def ResampleAnnotation(
+    correspondence: File,
+    fsavg_dir: str,
+    source_annotation_file_lh: str,
+    source_annotation_file_rh: str,
+    lh_annotation: str,
+    rh_annotation: str,
+    resource_bundle: str | None = None,
+) -> tuple[File, File]:
+    """Resample a pair of lh/rh annotations from an fsaverage template onto the subject
+    using the vertex correspondence from SurfaceCorrespondence (replaces a pair of
+    mri_surf2surf calls)"""
+    bundle = open_bundle(resource_bundle)
+    template = Path(fsavg_dir).name
+    out_files = []
+    with np.load(str(correspondence)) as indices:
+        for hemi, source, out_file in (
+            ("lh", source_annotation_file_lh, lh_annotation),
+            ("rh", source_annotation_file_rh, rh_annotation),
+        ):
+            index = indices[correspondence_key(template, hemi)]
+            out_files.append(
+                resample_annotation(index, source, Path(out_file).absolute(), bundle)
+            )
+    return tuple(out_files)
+
+
+@python.define(outputs=["out_file"])
+def RibbonProjection(
+    fastsurfer_dir: Directory, out_file: str = "ribbon.nn_vertex.npz"
+) -> File:
+    """Map every cortical-ribbon voxel of the subject to its nearest white/pial surface
+    vertex once, so that projecting an atlas into the volume reduces to an index
+    lookup. Like the vertex correspondence, the map is written to the task's own
+    directory rather than to the FastSurfer outputs it is built from."""
+    return build_ribbon_projection(fastsurfer_dir, Path(out_file).absolute())
+
+
+@python.define(outputs=["out_file"])
+def AnnotationToVolume(
+    fastsurfer_dir: Directory,
+    ribbon_projection: File,
+    lh_annotation: File,
+    rh_annotation: File,
+    out_file: str = "aparc+aseg.nii",
+) -> Nifti1:
+    """Project a pair of subject-space annotations into the cortical ribbon of the
+    subject's aseg volume (replaces mri_aparc2aseg --volmask + mri_label2vol)"""
+    return annotation_to_volume(
+        fastsurfer_dir,
+        ribbon_projection,
+        lh_annotation,
+        rh_annotation,
+        Path(out_file).absolute(),
+    )
@@ -0,0 +1,145 @@
+import csv
+import subprocess
+from pathlib import Path
+import pytest
+from australianimagingservice.mri.human.neuro.t1w.preprocess import batch
+from australianimagingservice.mri.human.neuro.t1w.preprocess.batch import (
+    SubjectJob,
+    available_cpus,
+    collect_jobs,
+    plan_pool,
+    run_batch,
+)
+
+
+def _touch(path: Path) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    return path
+
+
+def test_plan_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(batch.os, "sched_getaffinity", lambda pid: set(range(32)))
+    assert available_cpus() == 32
+    # Limited by the CPUs (at least min_threads each)
+    assert plan_pool(20, 32, None) == (8, 4)
+    assert plan_pool(20, 32, None, min_threads=8) == (4, 8)
+    # Limited by the memory budget
+    assert plan_pool(20, 32, 64.0, mem_per_subject_gb=16.0) == (4, 8)
+    # Limited by the number of subjects, which get all the CPUs between them
+    assert plan_pool(3, 32, 1000.0) == (3, 10)
+    assert plan_pool(20, 32, None, max_subjects=2) == (2, 16)
+    # Always at least one subject with at least one thread
+    assert plan_pool(5, 2, 8.0) == (1, 2)
+    assert plan_pool(5, 1, None, min_threads=0) == (1, 1)
+
+
+def test_collect_jobs(tmp_path: Path) -> None:
+    single = _touch(tmp_path / "single" / "sub-01_T1w.nii.gz")
+    for name in ("sub-02_T1w.nii.gz", "sub-03_T1w.nii"):
+        _touch(tmp_path / "globbed" / name)
+    _touch(tmp_path / "csv" / "images" / "a.nii.gz")
+    subjects_csv = tmp_path / "csv" / "subjects.csv"
+    subjects_csv.write_text(
+        f"subject_id,t1w\nsub-04,images/a.nii.gz\n,{tmp_path}/elsewhere/b.nii.gz\n"
+    )
+
+    jobs = collect_jobs(
+        [str(single), str(tmp_path / "globbed" / "*.nii*"), str(subjects_csv)]
+    )
+    assert jobs == [
+        SubjectJob("sub-01_T1w", single),
+        SubjectJob("sub-02_T1w", tmp_path / "globbed" / "sub-02_T1w.nii.gz"),
+        SubjectJob("sub-03_T1w", tmp_path / "globbed" / "sub-03_T1w.nii"),
+        # Relative paths are relative to the CSV, and IDs default to the file name
+        SubjectJob("sub-04", subjects_csv.parent / "images" / "a.nii.gz"),
+        SubjectJob("b", tmp_path / "elsewhere" / "b.nii.gz"),
+    ]
+    # Missing images are reported when their subject runs, not here
+    assert collect_jobs([str(tmp_path / "missing.nii.gz")]) == [
+        SubjectJob("missing", tmp_path / "missing.nii.gz")
+    ]
+
+    with pytest.raises(ValueError, match="shared by"):
+        collect_jobs([str(single), str(tmp_path / "single" / "*.nii.gz")])
+    with pytest.raises(ValueError, match="did not match"):
+        collect_jobs([str(tmp_path / "nowhere" / "*.nii.gz")])
+    bad_csv = tmp_path / "bad.csv"
+    bad_csv.write_text("subject_id,image\nsub-05,a.nii.gz\n")
+    with pytest.raises(ValueError, match="no 't1w' column"):
+        collect_jobs([str(bad_csv)])
+
+
+def test_run_batch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = {}
+
+    def fake_run(cmd, stdout, stderr, env):
+        subject_id = Path(cmd[3]).name.split(".")[0]
+        calls[subject_id] = (cmd, env)
+        stdout.write(f"running {subject_id}\n")
+        if subject_id == "sub-crash":
+            raise OSError("exec failed")
+        return subprocess.CompletedProcess(cmd, -9 if subject_id == "sub-oom" else 0)
+
+    monkeypatch.setattr(batch.subprocess, "run", fake_run)
+    names = ["sub-01", "sub-oom", "sub-missing", "sub-crash", "sub-02"]
+    jobs = []
+    for name in names:
+        t1w = tmp_path / "in" / f"{name}.nii.gz"
+        if name != "sub-missing":
+            _touch(t1w)
+        jobs.append(SubjectJob(name, t1w))
+    results = run_batch(
+        jobs,
+        tmp_path / "work",
+        tmp_path / "out",
+        ["/opt/freesurfer", "/opt/luts", "/opt/license.txt", "/opt/resources"],
+        n_workers=2,
+        threads_per_subject=3,
+        extra_flags=["--seg_only"],
+    )
+
+    # Each subject's outcome is reported, in order, whatever happened to the others
+    assert [r.subject_id for r in results] == names
+    assert [r.status for r in results] == [
+        "success",
+        "failed",
+        "failed",
+        "failed",
+        "success",
+    ]
+    assert [r.returncode for r in results] == [0, -9, None, None, 0]
+    assert "exited with code -9" in results[1].error
+    assert "does not exist" in results[2].error
+    assert results[3].error == "exec failed"
+    assert "sub-missing" not in calls
+    assert (tmp_path / "work" / "sub-02" / "all_parcs.log").read_text() == (
+        "running sub-02\n"
+    )
+
+    cmd, env = calls["sub-01"]
+    assert cmd[3:] == [
+        str(tmp_path / "in" / "sub-01.nii.gz"),
+        str(tmp_path / "work" / "sub-01" / "subjects"),
+        "/opt/freesurfer",
+        "/opt/luts",
+        str(tmp_path / "work" / "sub-01" / "cache"),
+        "/opt/license.txt",
+        "--nthreads",
+        "3",
+        "--seg_only",
+    ]
+    assert env["RESOURCES_DIR"] == "/opt/resources"
+    assert env["OUTPUT_DIR"] == str(tmp_path / "out" / "sub-01")
+    assert env["OMP_NUM_THREADS"] == "3"
+
+    batch.write_report(results, tmp_path / "report.csv")
+    with open(tmp_path / "report.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [(r["subject_id"], r["status"], r["returncode"]) for r in rows] == [
+        ("sub-01", "success", "0"),
+        ("sub-oom", "failed", "-9"),
+        ("sub-missing", "failed", ""),
+        ("sub-crash", "failed", ""),
+        ("sub-02", "success", "0"),
+    ]
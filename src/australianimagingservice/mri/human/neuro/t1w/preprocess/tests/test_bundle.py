@@ -0,0 +1,35 @@
+import os
+from pathlib import Path
+import numpy as np
+import nibabel.freesurfer.io as fsio
+from australianimagingservice.mri.human.neuro.t1w.preprocess.bundle import (
+    ResourceBundle,
+    build_bundle,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.labels import parse_lut
+
+
+def test_bundle(tmp_path: Path) -> None:
+    resources = tmp_path / "resources"
+    (resources / "neuro-parcellations").mkdir(parents=True)
+    (resources / "atlas").mkdir()
+    lut = resources / "neuro-parcellations" / "atlas_LUT.txt"
+    lut.write_text("0 Unknown\n1 region1\n2 region2\n")
+    annot = resources / "atlas" / "lh.atlas.annot"
+    ctab = np.array([[25, 5, 25, 0], [220, 20, 10, 0]])
+    labels = np.array([0, 1, 1, -1, 0], dtype=np.int32)
+    fsio.write_annot(str(annot), labels, ctab, ["unknown", "region1"])
+
+    bundle = ResourceBundle(build_bundle(resources))
+    assert bundle.lut(lut) == parse_lut(lut)
+    out_labels, _, names = bundle.annotation(annot)
+    assert np.array_equal(out_labels, labels)
+    assert names == ["unknown", "region1"]
+    assert bundle.lut(tmp_path / "elsewhere.txt") is None
+
+    # Entries are keyed on the contents of their sources, so a new mtime (e.g. from a
+    # fresh checkout) doesn't invalidate them but an edit does
+    os.utime(lut, ns=(0, 0))
+    assert bundle.lut(lut) == parse_lut(lut)
+    lut.write_text("0 Unknown\n1 region2\n2 region1\n")
+    assert bundle.lut(lut) is None
@@ -0,0 +1,102 @@
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import pytest
+from pydra.engine.workflow import Workflow
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer import (
+    FastsurferSeg,
+    FastsurferStage,
+    FastsurferSurf,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer_store import (
+    FASTSURFER_SUBJECT_ID,
+)
+
+
+@pytest.fixture
+def inputs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> dict[str, Path]:
+    monkeypatch.delenv("AIS_FASTSURFER_STORE", raising=False)
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4)), np.eye(4)), tmp_path / "t1.nii.gz")
+    (tmp_path / "license.txt").write_text("license")
+    (tmp_path / "subjects").mkdir()
+    return {
+        "t1w": tmp_path / "t1.nii.gz",
+        "fs_license": tmp_path / "license.txt",
+        "subjects_dir": tmp_path / "subjects",
+    }
+
+
+def _seg_img(tmp_path: Path) -> Path:
+    seg_img = tmp_path / "subjects" / FASTSURFER_SUBJECT_ID / "mri" / "seg.mgz"
+    seg_img.parent.mkdir(parents=True)
+    img = nib.MGHImage(np.zeros((4, 4, 4), dtype=np.int32), np.eye(4))
+    nib.save(img, str(seg_img))
+    return seg_img
+
+
+def test_split_cmdlines(inputs: dict[str, Path], tmp_path: Path) -> None:
+    seg = FastsurferSeg(
+        T1_files=inputs["t1w"],
+        fs_license=inputs["fs_license"],
+        subject_id=FASTSURFER_SUBJECT_ID,
+        subjects_dir=inputs["subjects_dir"],
+    )
+    seg_args = seg.cmdline.split()
+    assert "--seg_only" in seg_args
+    assert "--surf_only" not in seg_args
+
+    seg_img = _seg_img(tmp_path)
+    surf = FastsurferSurf(
+        seg_img=seg_img,
+        fs_license=inputs["fs_license"],
+        subject_id=FASTSURFER_SUBJECT_ID,
+        subjects_dir=inputs["subjects_dir"],
+    )
+    surf_args = surf.cmdline.split()
+    assert "--surf_only" in surf_args
+    assert "--seg_only" not in surf_args
+    assert "--t1" not in surf_args
+    # The segmentation is only an input to chain the stages, recon-surf finds it in
+    # the subject directory the segmentation was written to
+    assert str(seg_img) not in surf.cmdline
+    for flag in ("--sd", "--sid"):
+        assert (
+            seg_args[seg_args.index(flag) + 1] == surf_args[surf_args.index(flag) + 1]
+        )
+
+
+def test_split_stages(inputs: dict[str, Path]) -> None:
+    stage = Workflow.construct(FastsurferStage(**inputs))
+    assert stage.node_names == ["FastsurferSeg", "FastsurferSurf"]
+    seg, surf = stage["FastsurferSeg"].inputs, stage["FastsurferSurf"].inputs
+    # recon-surf runs on the segmentation's subject directory
+    assert surf.seg_img._node.name == "FastsurferSeg"
+    assert surf.seg_img._field == "seg_img"
+    assert (surf.subjects_dir, surf.subject_id) == (seg.subjects_dir, seg.subject_id)
+    assert seg.seg_only and surf.surf_only and surf.fsaparc
+    for name, field in (("norm_img", "norm_img"), ("aparcaseg_img", "aparcaseg_img")):
+        assert getattr(stage.outputs, name)._node.name == "FastsurferSurf"
+        assert getattr(stage.outputs, name)._field == field
+
+
+def test_seg_checksum(inputs: dict[str, Path], tmp_path: Path) -> None:
+    """Changing recon-surf's options (or skipping it) doesn't invalidate the cached
+    segmentation"""
+
+    def construct(**kwargs) -> Workflow:
+        return Workflow.construct(FastsurferStage(**inputs, **kwargs), dont_cache=True)
+
+    seg_checksum = construct()["FastsurferSeg"]._task._checksum
+    assert construct(seg_only=True)["FastsurferSeg"]._task._checksum == seg_checksum
+
+    seg_img = _seg_img(tmp_path)
+    surf_checksums = set()
+    for options in ({}, {"fsaparc": False}, {"parallel": False}, {"threads": 8}):
+        stage = construct()
+        seg, surf = stage["FastsurferSeg"], stage["FastsurferSurf"]
+        surf.inputs.seg_img = seg_img
+        for name, value in options.items():
+            setattr(surf.inputs, name, value)
+        assert seg._task._checksum == seg_checksum
+        surf_checksums.add(surf._task._checksum)
+    assert len(surf_checksums) == 4
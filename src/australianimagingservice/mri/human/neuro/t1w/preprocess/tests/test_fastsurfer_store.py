@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer_store import (
+    FASTSURFER_SUBJECT_ID,
+    MaterialiseFastsurfer,
+    installed_fastsurfer_version,
+    lookup,
+    publish,
+    store_key,
+    t1_content_hash,
+)
+
+
+def _subject_dir(path: Path) -> Path:
+    (path / "mri").mkdir(parents=True)
+    (path / "label").mkdir()
+    for i, name in enumerate(("orig.mgz", "norm.mgz", "aparc+aseg.mgz")):
+        data = np.full((4, 4, 4), i, dtype=np.int32)
+        nib.save(nib.MGHImage(data, np.eye(4)), str(path / "mri" / name))
+    (path / "label" / "lh.aparc.annot").write_bytes(b"annot")
+    return path
+
+
+def test_t1_content_hash(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, size=(10, 9, 40)).astype(np.int16)
+    affine = np.diag([1.0, 1.0, 1.2, 1.0])
+    img = nib.Nifti1Image(data, affine)
+    nib.save(img, str(tmp_path / "t1.nii.gz"))
+    img.header["descrip"] = b"renamed and re-described"
+    nib.save(img, str(tmp_path / "other.nii"))
+    nib.save(
+        nib.Nifti1Image(data, np.diag([1.0, 1.0, 1.0, 1.0])), str(tmp_path / "b.nii")
+    )
+
+    t1_hash = t1_content_hash(tmp_path / "t1.nii.gz")
+    assert t1_content_hash(tmp_path / "other.nii") == t1_hash
+    assert t1_content_hash(tmp_path / "b.nii") != t1_hash
+    assert store_key(t1_hash, fastsurfer="a") != store_key(t1_hash, fastsurfer="b")
+
+
+def test_publish_and_materialise(tmp_path: Path) -> None:
+    store = tmp_path / "store"
+    key = store_key("0" * 64, fastsurfer="deepmi/fastsurfer:test", seg_only=False)
+    assert lookup(store, key) is None
+    subject_dir = _subject_dir(tmp_path / "cache" / FASTSURFER_SUBJECT_ID)
+    stored = publish(store, key, subject_dir, {"t1w": "t1.nii.gz"})
+    assert lookup(store, key) == stored
+    # A second publication of the same key leaves the first in place
+    assert publish(store, key, subject_dir) == stored
+
+    outputs = MaterialiseFastsurfer(
+        store_dir=str(stored), subjects_dir=tmp_path / "subjects"
+    )(cache_root=tmp_path / "pydra")
+    materialised = Path(outputs.subjects_dir_output)
+    norm = (subject_dir / "mri" / "norm.mgz").read_bytes()
+    assert Path(outputs.norm_img).read_bytes() == norm
+    # Neither copy shares its inodes with the store, so rewriting a file in place
+    # leaves the stored entry intact
+    for path in (subject_dir, materialised):
+        for rel in ("mri/norm.mgz", "label/lh.aparc.annot"):
+            assert not os.path.samefile(path / rel, stored / rel)
+    with open(materialised / "label" / "lh.aparc.annot", "wb") as f:
+        f.write(b"rewritten")
+    assert (stored / "label" / "lh.aparc.annot").read_bytes() == b"annot"
+
+
+def test_installed_fastsurfer_version(tmp_path: Path) -> None:
+    assert installed_fastsurfer_version(tmp_path) is None
+    script = tmp_path / "run_fastsurfer.sh"
+    script.write_text("#!/bin/sh\necho 2.4.2+abc123\n")
+    script.chmod(0o755)
+    assert installed_fastsurfer_version(tmp_path) == "2.4.2+abc123"
@@ -0,0 +1,43 @@
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from australianimagingservice.mri.human.neuro.mif import load_mif
+from australianimagingservice.mri.human.neuro.t1w.preprocess.first import (
+    SgmReplace,
+    sgm_structures,
+)
+
+
+def test_sgm_replace(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    structures = sgm_structures(sgm_amyg_hipp=True)
+    # A LUT with the FIRST structures (the thalamus under its FreeSurfer 7 name) among
+    # cortical regions
+    names = ["ctx-lh-a", "ctx-rh-b"] + [n[-1] for n in structures.values()]
+    lut = tmp_path / "lut.txt"
+    lut.write_text("".join(f"{i} {n}\n" for i, n in enumerate(names, start=1)))
+    sgm_indices = np.arange(3, len(names) + 1)
+
+    shape = (9, 8, 7)
+    affine = np.diag([-1.0, 1.0, 1.0, 1.0])
+    parc = rng.integers(0, len(names) + 1, size=shape).astype(np.int32)
+    sgm = rng.integers(0, len(structures) + 1, size=shape).astype(np.int16)
+    sgm[rng.random(shape) < 0.7] = 0
+    nib.save(nib.Nifti1Image(parc, affine), str(tmp_path / "parc.nii.gz"))
+    # The FIRST segmentation is stored on the same grid with the x axis flipped
+    flipped_affine = np.eye(4)
+    flipped_affine[0, 3] = -(shape[0] - 1)
+    nib.save(nib.Nifti1Image(sgm[::-1], flipped_affine), str(tmp_path / "sgm.nii.gz"))
+
+    out_file = SgmReplace(
+        parc=tmp_path / "parc.nii.gz",
+        sgm_image=tmp_path / "sgm.nii.gz",
+        lut=lut,
+        sgm_amyg_hipp=True,
+    )(cache_root=tmp_path / "cache").out_file
+
+    expected = np.where(np.isin(parc, sgm_indices), 0, parc)
+    expected = np.where(sgm > 0, sgm + 2, expected)
+    data, _ = load_mif(out_file)
+    assert data.dtype == np.uint32
+    assert np.array_equal(data, expected)
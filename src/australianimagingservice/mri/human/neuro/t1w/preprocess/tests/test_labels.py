@@ -0,0 +1,129 @@
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import pytest
+from australianimagingservice.mri.human.neuro.mif import load_mif
+from australianimagingservice.mri.human.neuro.t1w.preprocess import labels
+from australianimagingservice.mri.human.neuro.t1w.preprocess.bundle import (
+    build_bundle,
+    open_bundle,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.labels import (
+    FusedLabelConvert,
+    compiled_lut_mapping,
+    lut_mapping,
+)
+
+# Voxel -> scanner affines of the input parcellation: RAS, and i, j, k stored as
+# A, S, L (i.e. permuted)
+RAS_AFFINE = np.array(
+    [
+        [1.0, 0.0, 0.0, -10.0],
+        [0.0, 1.5, 0.0, -20.0],
+        [0.0, 0.0, 2.0, -30.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+ASL_AFFINE = np.array(
+    [
+        [0.0, 0.0, -2.0, 30.0],
+        [1.0, 0.0, 0.0, -10.0],
+        [0.0, 1.5, 0.0, -20.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+
+
+def _write_luts(tmp_path: Path) -> tuple[Path, Path, dict[int, int]]:
+    """An input LUT in FreeSurfer format and an output LUT in MRtrix format that
+    renumbers, drops and reorders its regions, along with the expected relabelling"""
+    in_names = {0: "Unknown", 10: "Left-Thalamus"}
+    in_names.update({1000 + i: f"ctx-lh-region{i}" for i in range(1, 9)})
+    in_names.update({2000 + i: f"ctx-rh-region{i}" for i in range(1, 9)})
+    lut_in = tmp_path / "lut_in.txt"
+    rows = "".join(f"{i}\t{n}\t10 20 30 0\n" for i, n in in_names.items())
+    lut_in.write_text("# index name r g b a\n" + rows)
+    # Leave out region8 of each hemisphere
+    out_names = [n for i, n in in_names.items() if i and not str(i).endswith("8")]
+    out_names = out_names[::-1]
+    lut_out = tmp_path / "lut_out.txt"
+    lut_out.write_text(
+        "".join(
+            f"{i} {n[:8]} {n} 10 20 30 255\n" for i, n in enumerate(out_names, start=1)
+        )
+    )
+    out_index = {n: i for i, n in enumerate(out_names, start=1)}
+    return lut_in, lut_out, {i: out_index.get(n, 0) for i, n in in_names.items()}
+
+
+def _labelconvert_chain(
+    data: np.ndarray, affine: np.ndarray, threshold: int, relabel: dict[int, int]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Emulate fslreorient2std -> fslmaths -thr -> labelconvert for the two test
+    orientations, reorienting to LAS by explicit flips/transposes"""
+    if np.allclose(affine, RAS_AFFINE):
+        flip = np.diag([-1.0, 1.0, 1.0, 1.0])
+        flip[0, 3] = data.shape[0] - 1
+        data, affine = data[::-1], affine @ flip
+    else:
+        perm = np.zeros((4, 4))
+        perm[[0, 1, 2, 3], [1, 2, 0, 3]] = 1
+        data, affine = data.transpose(2, 0, 1), affine @ perm
+    data = np.where(data < threshold, 0, data)
+    return np.vectorize(lambda v: relabel.get(v, 0))(data), affine
+
+
+@pytest.mark.parametrize("affine", [RAS_AFFINE, ASL_AFFINE])
+def test_fused_label_convert(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, affine: np.ndarray
+) -> None:
+    monkeypatch.setattr(labels, "LUT_CACHE_DIR", tmp_path / "lut_cache")
+    rng = np.random.default_rng(0)
+    lut_in, lut_out, relabel = _write_luts(tmp_path)
+    values = np.array(list(relabel) + [1500, 3000])  # plus labels missing from the LUT
+    parc = rng.choice(values, size=(9, 8, 7)).astype(np.int32)
+    nib.save(nib.Nifti1Image(parc, affine), str(tmp_path / "parc.nii.gz"))
+
+    out_file = FusedLabelConvert(
+        in_file=tmp_path / "parc.nii.gz",
+        lut_in=str(lut_in),
+        lut_out=str(lut_out),
+        out_file="parc.mif.gz",
+    )(cache_root=tmp_path / "cache").out_file
+
+    expected, expected_affine = _labelconvert_chain(parc, affine, 1000, relabel)
+    data, out_affine = load_mif(out_file)
+    assert data.dtype == np.uint32
+    assert np.array_equal(data, expected)
+    assert np.allclose(out_affine, expected_affine)
+
+
+def test_compiled_lut_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(labels, "LUT_CACHE_DIR", tmp_path / "cache")
+    lut_in, lut_out, relabel = _write_luts(tmp_path)
+    mapping = compiled_lut_mapping(lut_in, lut_out)
+    assert {i: int(mapping[i]) for i in relabel} == relabel
+    assert not mapping.flags.writeable
+    assert len(list((tmp_path / "cache").glob("*.npy"))) == 1
+    # Editing either LUT invalidates the cached array
+    lut_out.write_text("1 Left-Thalamus Left-Thalamus 10 20 30 255\n")
+    mapping = compiled_lut_mapping(lut_in, lut_out)
+    assert mapping[10] == 1 and not mapping[1001]
+    assert len(list((tmp_path / "cache").glob("*.npy"))) == 2
+
+
+def test_lut_mapping_from_bundle(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    resources = tmp_path / "resources"
+    (resources / "neuro-parcellations").mkdir(parents=True)
+    lut_in, lut_out, _ = _write_luts(resources / "neuro-parcellations")
+    expected = lut_mapping(lut_in, lut_out)
+    bundle = open_bundle(build_bundle(resources))
+
+    # Both lookup tables are served from the bundle without parsing either file
+    def parse_lut(path):
+        raise AssertionError(f"{path} was parsed")
+
+    monkeypatch.setattr(labels, "parse_lut", parse_lut)
+    assert np.array_equal(lut_mapping(lut_in, lut_out, bundle), expected)
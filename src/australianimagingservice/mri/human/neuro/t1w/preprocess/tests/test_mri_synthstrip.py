@@ -0,0 +1,62 @@
+import gzip
+from pathlib import Path
+import pytest
+from australianimagingservice.mri.human.neuro.t1w.preprocess.mri_synthstrip import (
+    MriSynthstripBatch,
+    synthstrip_script_version,
+)
+
+# Stand-in for FreeSurfer's mri_synthstrip script, which "strips" an image by writing
+# its contents and the options it was given into the mask
+FAKE_SCRIPT = """\
+#!/usr/bin/env python3
+import argparse, gzip, sys
+
+version = {version!r}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-i", "--image", required=True)
+parser.add_argument("-m", "--mask", required=True)
+parser.add_argument("-b", "--border", type=int, default=1)
+parser.add_argument("-t", "--threads", type=int)
+parser.add_argument("--no-csf", action="store_true")
+args = parser.parse_args()
+if "fail" in open(args.image).read():
+    sys.exit("could not strip " + args.image)
+with gzip.open(args.mask, "wt") as f:
+    f.write(open(args.image).read() + f" b={{args.border}} t={{args.threads}}")
+"""
+
+
+def write_fake_script(path: Path, version: str = "1") -> Path:
+    path.write_text(FAKE_SCRIPT.format(version=version))
+    return path
+
+
+def test_synthstrip_batch(tmp_path: Path) -> None:
+    script = write_fake_script(tmp_path / "mri_synthstrip")
+    assert synthstrip_script_version(script) == "1"
+    in_files = []
+    for name in ("sub-03", "sub-01", "sub-02"):
+        in_files.append(tmp_path / f"{name}.nii")
+        in_files[-1].write_text(name)
+
+    mask_files = MriSynthstripBatch(
+        in_files=in_files, border=2, threads=3, script=str(script)
+    )(cache_root=tmp_path / "cache").mask_files
+
+    contents = [gzip.decompress(Path(m).read_bytes()).decode() for m in mask_files]
+    assert contents == ["sub-03 b=2 t=3", "sub-01 b=2 t=3", "sub-02 b=2 t=3"]
+
+
+@pytest.mark.parametrize("version,contents", [("2", "sub-01"), ("1", "fail")])
+def test_synthstrip_batch_fails_loudly(
+    tmp_path: Path, version: str, contents: str
+) -> None:
+    script = write_fake_script(tmp_path / "mri_synthstrip", version=version)
+    in_file = tmp_path / "sub-01.nii"
+    in_file.write_text(contents)
+    with pytest.raises(RuntimeError):
+        MriSynthstripBatch(in_files=[in_file], script=str(script))(
+            cache_root=tmp_path / "cache"
+        )
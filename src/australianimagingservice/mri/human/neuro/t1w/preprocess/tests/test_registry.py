@@ -0,0 +1,141 @@
+import os
+from pathlib import Path
+import pytest
+from australianimagingservice.mri.human.neuro.t1w.preprocess.all_parcs import _lut_src
+from australianimagingservice.mri.human.neuro.t1w.preprocess.helpers import (
+    JoinTaskCatalogue,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.registry import (
+    PARCELLATIONS,
+    ParcellationEntry,
+    get_parcellation,
+    select_parcellations,
+)
+
+RESOURCES_DIR = Path(__file__).parents[8] / "resources"
+
+# The atlases in the order they were always generated (and listed) in
+ALL_PARCELLATIONS = [
+    "aparca2009s",
+    "aparc",
+    "desikan",
+    "destrieux",
+    "economo",
+    "glasser360",
+    "hcpmmp1",
+    "schaefer100",
+    "schaefer1000",
+    "schaefer200",
+    "schaefer300",
+    "schaefer400",
+    "schaefer500",
+    "schaefer600",
+    "schaefer700",
+    "schaefer800",
+    "schaefer900",
+    "vosdewael100",
+    "vosdewael200",
+    "vosdewael300",
+    "vosdewael400",
+    "Yeo17",
+    "Yeo7",
+]
+
+
+def _expected_catalogue(
+    name: str, fs_dir: Path, fs_home: Path, lut_dir: Path
+) -> dict[str, str]:
+    """The paths the per-atlas branches of the original JoinTaskCatalogue gave"""
+    neuro_luts = RESOURCES_DIR / "neuro-parcellations"
+    if name in ("desikan", "destrieux"):
+        volume = "aparc+aseg.mgz" if name == "desikan" else "aparc.a2009s+aseg.mgz"
+        lut = "fs_default.txt" if name == "desikan" else "fs_a2009s.txt"
+        return {
+            "family": "freesurfer",
+            "fsavg_dir": "",
+            "parc_lut_file": str(fs_home / "FreeSurferColorLUT.txt"),
+            "mrtrix_lut_file": str(lut_dir / lut),
+            "output_parcellation_filename": str(fs_dir / "mri" / volume),
+            "source_annotation_file_lh": "",
+            "source_annotation_file_rh": "",
+            "annot_short": "",
+        }
+    if name == "hcpmmp1":
+        family, template, annot_short = "annot", "fsaverage", "HCPMMP1"
+        parc_lut = neuro_luts / "hcpmmp1_original.txt"
+        mrtrix_lut = neuro_luts / "hcpmmp1_ordered.txt"
+        source = RESOURCES_DIR / "hcpmmp1-parcellations" / "{hemi}.HCPMMP1.annot"
+    elif name.startswith("Yeo"):
+        n = name[len("Yeo") :]
+        yeo_dir = RESOURCES_DIR / "yeo2011-parcellations"
+        family, template, annot_short = "annot", "fsaverage5", name
+        parc_lut = yeo_dir / f"Yeo2011_{n}networks_Split_Components_LUT.txt"
+        mrtrix_lut = neuro_luts / f"Yeo2011_{n}N_split.txt"
+        source = yeo_dir / f"{{hemi}}.Yeo2011_{n}Networks_N1000.split_components.annot"
+    else:
+        mica = RESOURCES_DIR / "mica-mni-parcellations"
+        family, template, annot_short = "mica", "fsaverage5", f"{name}_mics"
+        parc_lut = mica / "lut" / f"lut_{name}_mics.csv"
+        mrtrix_lut = neuro_luts / f"{name}_reordered_LUT.txt"
+        source = mica / f"{{hemi}}.{name}_mics.annot"
+    return {
+        "family": family,
+        "fsavg_dir": str(fs_home / "subjects" / template),
+        "parc_lut_file": str(parc_lut),
+        "mrtrix_lut_file": str(mrtrix_lut),
+        "output_parcellation_filename": str(fs_dir / "mri" / f"{name}.nii.gz"),
+        "source_annotation_file_lh": str(source).format(hemi="lh"),
+        "source_annotation_file_rh": str(source).format(hemi="rh"),
+        "annot_short": annot_short,
+    }
+
+
+def test_default_selection() -> None:
+    assert list(PARCELLATIONS) == ALL_PARCELLATIONS
+    assert select_parcellations(None) == ALL_PARCELLATIONS
+    assert select_parcellations(["Yeo7", "desikan"]) == ["Yeo7", "desikan"]
+    # Duplicates are only generated once
+    assert select_parcellations(["aparc", "desikan", "aparc"]) == ["aparc", "desikan"]
+
+
+def test_unknown_parcellation() -> None:
+    for select in (get_parcellation, lambda n: select_parcellations(["aparc", n])):
+        with pytest.raises(ValueError, match="'schaefer150' not recognised") as e:
+            select("schaefer150")
+        assert all(f"'{n}'" in str(e.value) for n in ALL_PARCELLATIONS)
+    with pytest.raises(ValueError, match="Unrecognised family"):
+        ParcellationEntry("atlas", "other", ("resources", "a"), ("resources", "b"))
+
+
+@pytest.mark.parametrize("name", ALL_PARCELLATIONS)
+def test_catalogue(tmp_path: Path, name: str) -> None:
+    fs_dir, fs_home, lut_dir = (tmp_path / d for d in ("FS", "fs_home", "luts"))
+    for d in (fs_dir, fs_home, lut_dir):
+        d.mkdir()
+    expected = _expected_catalogue(name, fs_dir, fs_home, lut_dir)
+    entry = get_parcellation(name)
+    assert entry.family == expected.pop("family")
+    assert entry.is_surface == bool(expected["annot_short"])
+    assert entry.replaces_sgm == (entry.family != "mica")
+
+    outputs = JoinTaskCatalogue(
+        parcellation=name,
+        FS_dir=fs_dir,
+        freesurfer_home=fs_home,
+        mrtrix_lut_dir=lut_dir,
+        resources_dir=RESOURCES_DIR,
+    )(cache_root=tmp_path / "cache")
+    for field, value in expected.items():
+        assert getattr(outputs, field) == value, field
+    assert outputs.normimg_path == str(fs_dir / "mri" / "norm.mgz")
+    assert outputs.final_parc_image == f"Atlas_{name}.mif.gz"
+    assert _lut_src(name, RESOURCES_DIR, lut_dir) == Path(outputs.mrtrix_lut_file)
+    # The atlases' own files are shipped in the resources directory
+    for path in (
+        outputs.parc_lut_file,
+        outputs.mrtrix_lut_file,
+        outputs.source_annotation_file_lh,
+        outputs.source_annotation_file_rh,
+    ):
+        if path.startswith(str(RESOURCES_DIR)):
+            assert os.path.exists(path), path
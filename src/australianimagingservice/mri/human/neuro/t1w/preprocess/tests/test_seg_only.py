@@ -0,0 +1,156 @@
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import pytest
+from pydra.engine.workflow import Workflow
+from australianimagingservice.mri.human.neuro.t1w.preprocess.all_parcs import (
+    AllParcellations,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fastsurfer import (
+    FastsurferStage,
+    fastsurfer_images,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.fivett import (
+    FIVETT_ALGORITHMS,
+    FivettStage,
+    select_fivett_algorithms,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.helpers import (
+    JoinTaskCatalogue,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.registry import (
+    get_parcellation,
+    select_parcellations,
+)
+from australianimagingservice.mri.human.neuro.t1w.preprocess.single_parc import (
+    SingleParcellation,
+)
+
+SEG_ONLY_IMAGES = ("orig.mgz", "aparc.DKTatlas+aseg.deep.mgz")
+
+
+@pytest.fixture
+def inputs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> dict[str, Path]:
+    """The inputs of the parcellation workflows, with a FastSurfer subject directory
+    as left by a segmentation-only run"""
+    monkeypatch.delenv("AIS_FASTSURFER_STORE", raising=False)
+    fs_dir = tmp_path / "FS_outputs"
+    (fs_dir / "mri").mkdir(parents=True)
+    for name in SEG_ONLY_IMAGES:
+        img = nib.MGHImage(np.zeros((4, 4, 4), dtype=np.int32), np.eye(4))
+        nib.save(img, str(fs_dir / "mri" / name))
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4)), np.eye(4)), tmp_path / "t1.nii.gz")
+    (tmp_path / "license.txt").write_text("license")
+    for name in ("freesurfer_home", "luts", "subjects", "resources"):
+        (tmp_path / name).mkdir()
+    return {
+        "t1w": tmp_path / "t1.nii.gz",
+        "subjects_dir": tmp_path / "subjects",
+        "freesurfer_home": tmp_path / "freesurfer_home",
+        "mrtrix_lut_dir": tmp_path / "luts",
+        "fs_license": tmp_path / "license.txt",
+        "resources_dir": tmp_path / "resources",
+        "fastsurfer_dir": fs_dir,
+    }
+
+
+def test_seg_only_parcellations(inputs: dict[str, Path], tmp_path: Path) -> None:
+    assert select_parcellations(None, seg_only=True) == ["desikan"]
+    assert select_parcellations(["desikan"], seg_only=True) == ["desikan"]
+    for name in ("destrieux", "aparc", "hcpmmp1", "Yeo7"):
+        with pytest.raises(ValueError, match="segmentation-only mode.*'desikan'"):
+            select_parcellations(["desikan", name], seg_only=True)
+
+    # desikan is taken from FastSurferCNN's DKT labels
+    fs_dir = inputs["fastsurfer_dir"]
+    outputs = JoinTaskCatalogue(
+        parcellation="desikan",
+        FS_dir=fs_dir,
+        freesurfer_home=inputs["freesurfer_home"],
+        mrtrix_lut_dir=inputs["mrtrix_lut_dir"],
+        resources_dir=inputs["resources_dir"],
+        seg_only=True,
+    )(cache_root=tmp_path / "cache")
+    assert outputs.output_parcellation_filename == str(
+        fs_dir / "mri" / "aparc.DKTatlas+aseg.deep.mgz"
+    )
+    assert get_parcellation("desikan").supports_seg_only
+
+
+def test_seg_only_fivett_algorithms(inputs: dict[str, Path]) -> None:
+    assert select_fivett_algorithms() == FIVETT_ALGORITHMS
+    assert select_fivett_algorithms(seg_only=True) == ("freesurfer",)
+    assert select_fivett_algorithms(("fsl", "fsl"), seg_only=False) == ("fsl",)
+    for algorithms in (("hsvs",), ("fsl",), ("freesurfer", "hsvs")):
+        with pytest.raises(ValueError, match="segmentation-only mode"):
+            select_fivett_algorithms(algorithms, seg_only=True)
+    with pytest.raises(ValueError, match="Unrecognised 5TT algorithm"):
+        select_fivett_algorithms(("msmt",))
+
+    norm_img, aparcaseg_img = fastsurfer_images(inputs["fastsurfer_dir"], True)
+    fivett = Workflow.construct(
+        FivettStage(
+            fastsurfer_dir=inputs["fastsurfer_dir"],
+            norm_img=norm_img,
+            aparcaseg_img=aparcaseg_img,
+            seg_only=True,
+        )
+    )
+    assert fivett.node_names == ["FivettGen_Freesurfer", "fTTvis_task_freesurfer"]
+    with pytest.raises(ValueError, match="segmentation-only mode"):
+        Workflow.construct(
+            FivettStage(
+                fastsurfer_dir=inputs["fastsurfer_dir"],
+                norm_img=norm_img,
+                aparcaseg_img=aparcaseg_img,
+                algorithms=("hsvs", "freesurfer"),
+                seg_only=True,
+            )
+        )
+
+
+def test_seg_only_images(inputs: dict[str, Path]) -> None:
+    fs_dir = inputs["fastsurfer_dir"]
+    assert fastsurfer_images(fs_dir, seg_only=True) == tuple(
+        fs_dir / "mri" / n for n in SEG_ONLY_IMAGES
+    )
+    assert fastsurfer_images(fs_dir) == (
+        fs_dir / "mri" / "norm.mgz",
+        fs_dir / "mri" / "aparc+aseg.mgz",
+    )
+
+    # Without recon-surf, FastsurferStage passes on the segmentation's outputs
+    stage = Workflow.construct(
+        FastsurferStage(
+            t1w=inputs["t1w"],
+            fs_license=inputs["fs_license"],
+            subjects_dir=inputs["subjects_dir"],
+            seg_only=True,
+        )
+    )
+    assert stage.node_names == ["FastsurferSeg"]
+    assert stage.outputs.norm_img._node.name == "FastsurferSeg"
+    assert stage.outputs.norm_img._field == "orig_img"
+    assert stage.outputs.aparcaseg_img._field == "seg_img"
+
+    # ...which the 5TT and FIRST stages of the workflows receive
+    single = Workflow.construct(
+        SingleParcellation(parcellation="desikan", seg_only=True, **inputs)
+    )
+    fivett = single["FivettStage"].inputs
+    assert (Path(fivett.norm_img), Path(fivett.aparcaseg_img)) == fastsurfer_images(
+        fs_dir, True
+    )
+    assert fivett.seg_only
+    first = single["FirstSegmentation"].inputs
+    assert (first.t1_image, first.premasked) == ("orig.mgz", False)
+
+    del inputs["fastsurfer_dir"]
+    combined = Workflow.construct(AllParcellations(seg_only=True, **inputs))
+    assert combined["FastsurferStage"].inputs.seg_only
+    fivett = combined["FivettStage"].inputs
+    assert fivett.seg_only
+    assert fivett.norm_img._node.name == "FastsurferStage"
+    assert fivett.norm_img._field == "norm_img"
+    first = combined["FirstSegmentation"].inputs
+    assert (first.t1_image, first.premasked) == ("orig.mgz", False)
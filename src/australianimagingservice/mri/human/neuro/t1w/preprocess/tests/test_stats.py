@@ -0,0 +1,129 @@
+import csv
+import logging
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from nibabel.orientations import (
+    apply_orientation,
+    axcodes2ornt,
+    inv_ornt_aff,
+    io_orientation,
+    ornt_transform,
+)
+from australianimagingservice.mri.human.neuro.mif import save_mif
+from australianimagingservice.mri.human.neuro.t1w.preprocess.stats import (
+    REGION_STATS_COLUMNS,
+    region_stats,
+    write_region_stats,
+)
+
+# 1.2 x 1.0 x 1.5 mm voxels
+AFFINE = np.array(
+    [
+        [1.2, 0.0, 0.0, -10.0],
+        [0.0, 1.0, 0.0, -20.0],
+        [0.0, 0.0, 1.5, -30.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+VOXEL_VOLUME = 1.2 * 1.0 * 1.5
+
+
+def _images() -> tuple[np.ndarray, np.ndarray]:
+    """A label image (without label 3) and an intensity image on the same RAS grid"""
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 1, 2, 4, 5, 17], size=(6, 7, 8)).astype(np.int32)
+    intensity = rng.uniform(0, 200, size=labels.shape).astype(np.float32)
+    return labels, intensity
+
+
+def _reorient(
+    data: np.ndarray, affine: np.ndarray, axcodes: tuple[str, str, str]
+) -> tuple[np.ndarray, np.ndarray]:
+    """The same image stored with its axes in the orientation ``axcodes``"""
+    transform = ornt_transform(io_orientation(affine), axcodes2ornt(axcodes))
+    return (
+        apply_orientation(data, transform),
+        affine @ inv_ornt_aff(transform, data.shape),
+    )
+
+
+def _expected(labels: np.ndarray, intensity: np.ndarray) -> dict[int, tuple]:
+    return {
+        k: (
+            int((labels == k).sum()),
+            (labels == k).sum() * VOXEL_VOLUME,
+            float(intensity[labels == k].mean()),
+        )
+        for k in np.unique(labels)
+        if k != 0
+    }
+
+
+def test_region_stats() -> None:
+    labels, intensity = _images()
+    indices, voxels, volumes, means = region_stats(labels, AFFINE, intensity)
+    expected = _expected(labels, intensity)
+    assert list(indices) == sorted(expected)
+    for k, v, vol, mean in zip(indices, voxels, volumes, means):
+        assert v == expected[k][0]
+        assert np.isclose(vol, expected[k][1])
+        assert np.isclose(mean, expected[k][2])
+    # Without an intensity image the means are NaN
+    assert np.isnan(region_stats(labels, AFFINE)[3]).all()
+
+
+def test_write_region_stats(tmp_path: Path, caplog) -> None:
+    labels, intensity = _images()
+    expected = _expected(labels, intensity)
+    # norm.mgz is stored in LIA (as FreeSurfer conforms it) and the atlases in LAS
+    # (as mrconvert writes NIfTI) or RAS-aligned MIF
+    norm = nib.MGHImage(*_reorient(intensity, AFFINE, ("L", "I", "A")))
+    nib.save(norm, str(tmp_path / "norm.mgz"))
+    nib.save(
+        nib.Nifti1Image(*_reorient(labels, AFFINE, ("L", "A", "S"))),
+        str(tmp_path / "las.nii.gz"),
+    )
+    save_mif(tmp_path / "ras.mif", labels, AFFINE)
+    # An atlas on another grid
+    nib.save(
+        nib.Nifti1Image(labels[:-1], AFFINE),
+        str(tmp_path / "cropped.nii.gz"),
+    )
+    lut = tmp_path / "las_LUT.txt"
+    lut.write_text("0 Unknown\n1 region1\n2 region2\n4 region4\n")
+
+    with caplog.at_level(logging.WARNING):
+        out_file = write_region_stats(
+            {
+                "las": tmp_path / "las.nii.gz",
+                "ras": tmp_path / "ras.mif",
+                "cropped": tmp_path / "cropped.nii.gz",
+            },
+            {"las": lut, "ras": tmp_path / "missing_LUT.txt"},
+            tmp_path / "norm.mgz",
+            tmp_path / "region_stats.csv",
+        )
+    assert "does not match the grid of atlas cropped" in caplog.text
+
+    with open(out_file, newline="") as f:
+        reader = csv.reader(f)
+        assert tuple(next(reader)) == REGION_STATS_COLUMNS
+        rows = list(reader)
+    by_atlas: dict[str, list[list[str]]] = {}
+    for row in rows:
+        by_atlas.setdefault(row[0], []).append(row[1:])
+    assert sorted(by_atlas) == ["cropped", "las", "ras"]
+    for atlas in ("las", "ras"):
+        assert [int(r[0]) for r in by_atlas[atlas]] == sorted(expected)
+        for index, _, voxels, volume, mean in by_atlas[atlas]:
+            count, mm3, mean_intensity = expected[int(index)]
+            assert int(voxels) == count
+            assert np.isclose(float(volume), mm3, atol=1e-3)
+            assert np.isclose(float(mean), mean_intensity, atol=1e-3)
+    names = {int(r[0]): r[1] for r in by_atlas["las"]}
+    assert names == {1: "region1", 2: "region2", 4: "region4", 5: "", 17: ""}
+    assert all(r[1] == "" for r in by_atlas["ras"])
+    # Mismatched grids still have their volumes, but no mean intensities
+    assert by_atlas["cropped"]
+    assert all(r[4] == "" and float(r[3]) > 0 for r in by_atlas["cropped"])
@@ -0,0 +1,131 @@
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import nibabel.freesurfer.io as fsio
+from australianimagingservice.mri.human.neuro.t1w.preprocess.surface import (
+    ANNOT_LABEL_OFFSETS,
+    CORTEX_LABELS,
+    HEMISPHERES,
+    AnnotationToVolume,
+    ResampleAnnotation,
+    RibbonProjection,
+    SurfaceCorrespondence,
+)
+
+
+def _sphere(rng: np.random.Generator, n: int) -> np.ndarray:
+    coords = rng.normal(size=(n, 3))
+    return 100 * coords / np.linalg.norm(coords, axis=1, keepdims=True)
+
+
+def _write_sphere(path: Path, coords: np.ndarray) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fsio.write_geometry(str(path), coords, np.array([[0, 1, 2]], dtype=np.int32))
+
+
+def _snapshot(path: Path) -> dict[str, bytes]:
+    return {
+        str(p.relative_to(path)): p.read_bytes() for p in path.rglob("*") if p.is_file()
+    }
+
+
+def test_resample_annotation(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    fs_dir = tmp_path / "subject"
+    freesurfer_home = tmp_path / "freesurfer"
+    template_dir = freesurfer_home / "subjects" / "fsaverage5"
+    ctab = np.array([[25, 5, 25, 0], [220, 20, 10, 0], [20, 30, 140, 0]])
+    names = ["unknown", "region1", "region2"]
+    sources, expected = {}, {}
+    for hemi in HEMISPHERES:
+        subject_coords, template_coords = _sphere(rng, 500), _sphere(rng, 200)
+        _write_sphere(fs_dir / "surf" / f"{hemi}.sphere.reg", subject_coords)
+        _write_sphere(template_dir / "surf" / f"{hemi}.sphere.reg", template_coords)
+        labels = rng.integers(-1, len(names), size=len(template_coords))
+        sources[hemi] = tmp_path / f"{hemi}.test.annot"
+        fsio.write_annot(str(sources[hemi]), labels, ctab, names)
+        dists = np.linalg.norm(
+            subject_coords[:, None, :] - template_coords[None, :, :], axis=2
+        )
+        expected[hemi] = labels[dists.argmin(axis=1)]
+    before = _snapshot(fs_dir)
+
+    correspondence = SurfaceCorrespondence(
+        fastsurfer_dir=fs_dir,
+        freesurfer_home=freesurfer_home,
+        templates=("fsaverage5",),
+    )(cache_root=tmp_path / "cache").correspondence
+    outputs = ResampleAnnotation(
+        correspondence=correspondence,
+        fsavg_dir=str(template_dir),
+        source_annotation_file_lh=str(sources["lh"]),
+        source_annotation_file_rh=str(sources["rh"]),
+        lh_annotation="lh.test.annot",
+        rh_annotation="rh.test.annot",
+    )(cache_root=tmp_path / "cache")
+
+    for hemi in HEMISPHERES:
+        labels, _, out_names = fsio.read_annot(
+            str(getattr(outputs, f"{hemi}_annotation"))
+        )
+        assert np.array_equal(labels, expected[hemi])
+        assert [n.decode() for n in out_names] == names
+    # The FastSurfer outputs are an input of the tasks, so must be left untouched
+    assert _snapshot(fs_dir) == before
+
+
+def test_annotation_to_volume(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    fs_dir = tmp_path / "subject"
+    (fs_dir / "mri").mkdir(parents=True)
+    (fs_dir / "surf").mkdir()
+    shape = (12, 10, 8)
+    affine = np.eye(4)
+    ribbon = np.zeros(shape, dtype=np.int32)
+    ribbon[:6][rng.random((6,) + shape[1:]) < 0.3] = CORTEX_LABELS["lh"]
+    ribbon[6:][rng.random((6,) + shape[1:]) < 0.3] = CORTEX_LABELS["rh"]
+    aseg = np.where(ribbon > 0, ribbon, 10).astype(np.int32)
+    # Cortex voxels of aseg outside the ribbon are cleared (as per --volmask)
+    outside = (ribbon == 0) & (rng.random(shape) < 0.1)
+    aseg[outside] = CORTEX_LABELS["lh"]
+    ribbon_img = nib.MGHImage(ribbon, affine)
+    nib.save(ribbon_img, str(fs_dir / "mri" / "ribbon.mgz"))
+    nib.save(nib.MGHImage(aseg, affine), str(fs_dir / "mri" / "aseg.mgz"))
+
+    vox2ras_tkr = ribbon_img.header.get_vox2ras_tkr()
+    ctab = np.array([[25, 5, 25, 0], [220, 20, 10, 0], [20, 30, 140, 0]])
+    names = ["unknown", "region1", "region2"]
+    expected = np.where(outside, 0, aseg)
+    annots = {}
+    for hemi in HEMISPHERES:
+        white = rng.uniform(-6, 6, size=(50, 3))
+        pial = rng.uniform(-6, 6, size=(50, 3))
+        for name, coords in (("white", white), ("pial", pial)):
+            _write_sphere(fs_dir / "surf" / f"{hemi}.{name}", coords)
+        labels = rng.integers(-1, len(names), size=len(white))
+        annots[hemi] = tmp_path / f"{hemi}.test.annot"
+        fsio.write_annot(str(annots[hemi]), labels, ctab, names)
+        ijk = np.argwhere(ribbon == CORTEX_LABELS[hemi])
+        coords = ijk @ vox2ras_tkr[:3, :3].T + vox2ras_tkr[:3, 3]
+        vertices = np.vstack([white, pial])
+        dists = np.linalg.norm(coords[:, None, :] - vertices[None, :, :], axis=2)
+        vertex_labels = labels[dists.argmin(axis=1) % len(white)]
+        expected[tuple(ijk.T)] = np.where(
+            vertex_labels >= 0,
+            vertex_labels + ANNOT_LABEL_OFFSETS[hemi],
+            CORTEX_LABELS[hemi],
+        )
+    before = _snapshot(fs_dir)
+
+    projection = RibbonProjection(fastsurfer_dir=fs_dir)(
+        cache_root=tmp_path / "cache"
+    ).out_file
+    out_file = AnnotationToVolume(
+        fastsurfer_dir=fs_dir,
+        ribbon_projection=projection,
+        lh_annotation=annots["lh"],
+        rh_annotation=annots["rh"],
+    )(cache_root=tmp_path / "cache").out_file
+
+    assert np.array_equal(np.asanyarray(nib.load(str(out_file)).dataobj), expected)
+    assert _snapshot(fs_dir) == before
@@ -0,0 +1,104 @@
+import gzip
+from pathlib import Path
+import nibabel as nib
+import numpy as np
+import pytest
+from australianimagingservice.mri.human.neuro.dwi.bzero import MeanBzero, mean_bzero
+from australianimagingservice.mri.human.neuro.mif import load_mif, mif_header, save_mif
+
+AFFINE = np.array(
+    [
+        [2.0, 0.0, 0.0, -40.0],
+        [0.0, 2.0, 0.0, -50.0],
+        [0.0, 0.0, 2.5, -30.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+# b=0 volumes (including one just under the b=0 threshold) among two shells
+BVALUES = [0, 1000, 1000, 5, 2000, 1000, 2000, 0, 2000, 1000, 2000, 0]
+BZEROS = [0, 3, 7, 11]
+
+
+def _dw_scheme() -> str:
+    rng = np.random.default_rng(0)
+    rows = []
+    for b in BVALUES:
+        vector = rng.normal(size=3) if b > 10 else np.zeros(3)
+        vector /= max(np.linalg.norm(vector), 1.0)
+        rows.append(",".join(f"{v:.10g}" for v in [*vector, b]))
+    return "\n".join(rows)
+
+
+def _dwi() -> np.ndarray:
+    """A DWI series with negative intensities for the clamping to remove"""
+    rng = np.random.default_rng(1)
+    return rng.normal(100, 80, size=(6, 5, 4, len(BVALUES))).astype(np.float32)
+
+
+def _expected(data: np.ndarray, clamp: bool = True) -> np.ndarray:
+    """dwiextract -bzero | mrcalc - 0 -max | mrmath - mean -axis 3"""
+    bzero = data[..., BZEROS]
+    if clamp:
+        bzero = np.maximum(bzero, 0)
+    return bzero.mean(axis=3)
+
+
+def _load(path: Path) -> nib.Nifti1Image:
+    """Load an image in the RAS+ orientation, whatever order it was stored in"""
+    if path.name.endswith((".mif", ".mif.gz")):
+        img = nib.Nifti1Image(*load_mif(path))
+    else:
+        img = nib.load(str(path))
+    return nib.as_closest_canonical(img)
+
+
+def _save_slice_contiguous(path: Path, data: np.ndarray) -> Path:
+    """Write a MIF with the volumes varying fastest and the first axis flipped (as
+    e.g. ``mrconvert -strides -2,3,4,1`` does), so that each slab is a slice"""
+    header, layout = mif_header(data, AFFINE, {"dw_scheme": _dw_scheme()})
+    assert layout == "+0,+1,+2,+3"
+    header = header.replace(b"layout: +0,+1,+2,+3", b"layout: -1,+2,+3,+0")
+    payload = np.transpose(data[::-1], (3, 0, 1, 2)).tobytes(order="F")
+    if path.name.endswith(".gz"):
+        path.write_bytes(gzip.compress(header + payload))
+    else:
+        path.write_bytes(header + payload)
+    return path
+
+
+@pytest.mark.parametrize("clamp", [True, False])
+@pytest.mark.parametrize("out_ext", [".nii.gz", ".mif"])
+def test_volume_contiguous(tmp_path: Path, clamp: bool, out_ext: str) -> None:
+    data = _dwi()
+    in_file = save_mif(tmp_path / "dwi.mif", data, AFFINE, {"dw_scheme": _dw_scheme()})
+    out_file = mean_bzero(in_file, tmp_path / f"meanb0{out_ext}", clamp=clamp)
+    img = _load(out_file)
+    assert img.get_fdata().shape == data.shape[:3]
+    assert np.allclose(img.get_fdata(), _expected(data, clamp), atol=1e-4)
+    assert np.allclose(img.affine, AFFINE)
+
+
+@pytest.mark.parametrize("ext", [".mif", ".mif.gz"])
+def test_slice_contiguous(tmp_path: Path, ext: str) -> None:
+    data = _dwi()
+    in_file = _save_slice_contiguous(tmp_path / f"dwi{ext}", data)
+    # The hand-written layout is read back as the image it describes
+    assert np.allclose(_load(in_file).get_fdata(), data)
+    img = _load(mean_bzero(in_file, tmp_path / "meanb0.nii.gz"))
+    assert np.allclose(img.get_fdata(), _expected(data), atol=1e-4)
+    assert np.allclose(img.affine, AFFINE)
+
+
+def test_nifti(tmp_path: Path) -> None:
+    data = _dwi()
+    in_file = tmp_path / "dwi.nii.gz"
+    nib.save(nib.Nifti1Image(data, AFFINE), str(in_file))
+    with pytest.raises(ValueError, match="No diffusion gradient table"):
+        mean_bzero(in_file, tmp_path / "meanb0.nii.gz")
+    scheme = np.array([[float(v) for v in r.split(",")] for r in _dw_scheme().split()])
+    np.savetxt(tmp_path / "dwi.bval", scheme[:, 3][None])
+    np.savetxt(tmp_path / "dwi.bvec", scheme[:, :3].T)
+    outputs = MeanBzero(in_file=in_file)(cache_root=tmp_path / "cache")
+    img = _load(Path(outputs.out))
+    assert np.allclose(img.get_fdata(), _expected(data), atol=1e-4)
+    assert np.allclose(img.affine, AFFINE)
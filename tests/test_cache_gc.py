@@ -0,0 +1,181 @@
+import os
+import time
+from pathlib import Path
+import pytest
+from australianimagingservice.mri.human.neuro import cache_gc
+from australianimagingservice.mri.human.neuro.cache_gc import (
+    collect_garbage,
+    parse_size,
+    scan_cache,
+    task_dirs,
+)
+
+KB = 1024
+
+
+def _task_dir(
+    cache_root: Path, name: str, task: str, size: int, age: float, complete=True
+) -> Path:
+    """A task directory of ``size`` bytes, last used ``age`` seconds ago"""
+    path = cache_root / name
+    path.mkdir(parents=True)
+    (path / "_job.pklz").write_bytes(b"\x80\x04" + task.encode() + b"\x94")
+    (path / "output.bin").write_bytes(b"\0" * size)
+    used = time.time() - age
+    if complete:
+        (path / "_result.pklz").write_bytes(b"result")
+        os.utime(path / "_result.pklz", (used, used))
+    os.utime(path / "_job.pklz", (used, used))
+    return path
+
+
+@pytest.fixture
+def cache_root(tmp_path: Path) -> Path:
+    root = tmp_path / "cache"
+    _task_dir(root, "python-aaaa", "FastsurferSeg", 64 * KB, age=40000)
+    _task_dir(root, "shell-bbbb", "MrConvert", 16 * KB, age=30000)
+    _task_dir(root, "shell-cccc", "LabelConvert", 16 * KB, age=20000)
+    _task_dir(root, "workflow-dddd", "Parcellation", 16 * KB, age=10000)
+    _task_dir(root, "python-eeee", "LabelSgmfix", 16 * KB, age=10)
+    # Not a task directory, so never considered
+    (root / "FS_outputs").mkdir()
+    (root / "FS_outputs" / "norm.mgz").write_bytes(b"\0" * 64 * KB)
+    return root
+
+
+def _remaining(cache_root: Path) -> list[str]:
+    return sorted(p.name for p in cache_root.iterdir() if not p.name.startswith("."))
+
+
+def test_parse_size() -> None:
+    assert parse_size(100) == 100
+    assert parse_size("100") == 100
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5 GiB") == int(1.5 * 1024**3)
+    assert parse_size("200g") == 200 * 1024**3
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_scan_cache(cache_root: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    entries = {e.path.name: e for e in scan_cache(cache_root)}
+    assert sorted(entries) == [
+        "python-aaaa",
+        "python-eeee",
+        "shell-bbbb",
+        "shell-cccc",
+        "workflow-dddd",
+    ]
+    assert entries["python-aaaa"].pinned
+    assert entries["python-aaaa"].task == "FastsurferSeg"
+    assert not entries["shell-bbbb"].pinned
+    assert entries["shell-bbbb"].size >= 16 * KB
+
+    # Unchanged directories are read from the index rather than walked again
+    walked = []
+    tree_size = cache_gc._tree_size
+    monkeypatch.setattr(
+        cache_gc, "_tree_size", lambda p: walked.append(p.name) or tree_size(p)
+    )
+    scan_cache(cache_root)
+    assert walked == []
+    (cache_root / "shell-bbbb" / "extra.bin").write_bytes(b"\0" * KB)
+    scan_cache(cache_root)
+    assert walked == ["shell-bbbb"]
+
+
+def test_evicts_least_recently_used(cache_root: Path) -> None:
+    # Evicting the two oldest unpinned directories is enough to fit the budget
+    total = sum(e.size for e in scan_cache(cache_root))
+    report = collect_garbage(cache_root, total - 30 * KB, min_age=60)
+    assert [e.path.name for e in report.evicted] == ["shell-bbbb", "shell-cccc"]
+    assert report.freed == sum(e.size for e in report.evicted)
+    assert _remaining(cache_root) == [
+        "FS_outputs",
+        "python-aaaa",
+        "python-eeee",
+        "workflow-dddd",
+    ]
+
+
+def test_pins_and_min_age(cache_root: Path) -> None:
+    # Even an empty budget keeps the pinned and the recently used directories
+    report = collect_garbage(cache_root, 0, min_age=60)
+    assert report.skipped_in_use == 1
+    assert _remaining(cache_root) == ["FS_outputs", "python-aaaa", "python-eeee"]
+    collect_garbage(cache_root, 0, pins=(), min_age=0)
+    assert _remaining(cache_root) == ["FS_outputs"]
+
+
+def test_locked_directories_are_kept(cache_root: Path) -> None:
+    (cache_root / "shell-bbbb.lock").write_text("")
+    report = collect_garbage(cache_root, 0, min_age=60)
+    assert report.skipped_in_use == 2
+    assert "shell-bbbb" in _remaining(cache_root)
+    assert "shell-cccc" not in _remaining(cache_root)
+
+
+def test_protect(cache_root: Path) -> None:
+    final = cache_root / "workflow-dddd" / "outputs"
+    collect_garbage(cache_root, 0, min_age=60, protect=[final])
+    assert _remaining(cache_root) == [
+        "FS_outputs",
+        "python-aaaa",
+        "python-eeee",
+        "workflow-dddd",
+    ]
+
+
+def test_dry_run(cache_root: Path) -> None:
+    before = _remaining(cache_root)
+    report = collect_garbage(cache_root, 0, min_age=60, dry_run=True)
+    assert sorted(e.path.name for e in report.evicted) == [
+        "shell-bbbb",
+        "shell-cccc",
+        "workflow-dddd",
+    ]
+    assert _remaining(cache_root) == before
+
+
+def test_owned_directories_of_finished_run(cache_root: Path) -> None:
+    existing = {p.name for p in task_dirs(cache_root)}
+    # A run that has just finished, sharing the cache root with an earlier one
+    _task_dir(cache_root, "python-ffff", "FastsurferSurf", 16 * KB, age=5)
+    _task_dir(cache_root, "shell-abab", "FivettGen", 16 * KB, age=5)
+    _task_dir(cache_root, "workflow-cdcd", "AllParcellations", 16 * KB, age=1)
+    owned = [p for p in task_dirs(cache_root) if p.name not in existing]
+    assert sorted(p.name for p in owned) == [
+        "python-ffff",
+        "shell-abab",
+        "workflow-cdcd",
+    ]
+    collect_garbage(cache_root, 0, min_age=3600, owned=owned)
+    # Its unpinned directories are removed and its pinned ones kept, whereas the
+    # recently used directory of the other run is left alone
+    assert _remaining(cache_root) == [
+        "FS_outputs",
+        "python-aaaa",
+        "python-eeee",
+        "python-ffff",
+    ]
+
+
+def test_inputs_of_running_jobs_are_kept(cache_root: Path) -> None:
+    # A running job (holding its lock) that reads the outputs of an old directory
+    consumer = _task_dir(cache_root, "shell-ffff", "Dwi2Response", 0, age=0)
+    upstream = cache_root / "shell-bbbb" / "output.bin"
+    (consumer / "_job.pklz").write_bytes(b"\x80\x04" + str(upstream).encode())
+    (cache_root / "shell-ffff.lock").write_text("")
+    collect_garbage(cache_root, 0, min_age=60)
+    assert _remaining(cache_root) == [
+        "FS_outputs",
+        "python-aaaa",
+        "python-eeee",
+        "shell-bbbb",
+        "shell-ffff",
+        "shell-ffff.lock",
+    ]
+    # Once the consumer has finished its input can go
+    (cache_root / "shell-ffff.lock").unlink()
+    collect_garbage(cache_root, 0, min_age=60, owned=[consumer])
+    assert _remaining(cache_root) == ["FS_outputs", "python-aaaa", "python-eeee"]
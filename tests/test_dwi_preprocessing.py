@@ -0,0 +1,154 @@
+import gzip
+import os
+from pathlib import Path
+import pytest
+from fileformats.generic import File
+from pydra.compose import python
+from australianimagingservice.mri.human.neuro.dwi import dwi_preprocessing
+from australianimagingservice.mri.human.neuro.dwi.dwi_preprocessing import (
+    DwiCohortPreprocessing,
+)
+
+# Stand-in for FreeSurfer's mri_synthstrip script, which writes the contents of the
+# image into the mask
+FAKE_SYNTHSTRIP = """\
+#!/usr/bin/env python3
+import argparse, gzip
+
+version = "1"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-i", "--image", required=True)
+parser.add_argument("-m", "--mask", required=True)
+parser.add_argument("-b", "--border", type=int, default=1)
+args = parser.parse_args()
+with gzip.open(args.mask, "wt") as f:
+    f.write(open(args.image).read())
+"""
+
+
+def _read(path) -> str:
+    data = Path(path).read_bytes()
+    return gzip.decompress(data).decode() if data[:2] == b"\x1f\x8b" else data.decode()
+
+
+def _write(name: str, contents: str) -> Path:
+    path = Path(name).absolute()
+    path.write_text(contents)
+    return path
+
+
+# Stand-ins for the per-subject stages, which tag each output with the subject (read
+# from the input it is derived from) so that misaligned inputs are detected
+
+
+@python.define(outputs=["dwi_degibbs", "se_epi", "early_meanb0", "grad_warning"])
+def PrepareStage(
+    dwi_raw_mif: File,
+    rpe_mode: str = "rpe_none",
+    rpe_file: str | None = None,
+    intermediate_format: str = "mif",
+) -> tuple[File, File | None, File, str]:
+    subject = Path(dwi_raw_mif).read_text()
+    return (
+        _write("degibbs.txt", subject),
+        None,
+        _write("early_meanb0.txt", f"{subject}:early"),
+        f"{subject}:{rpe_mode}",
+    )
+
+
+@python.define(outputs=["dwi_corrected", "preproc_meanb0"])
+def CorrectStage(
+    dwi_degibbs: File,
+    eddy_mask: File,
+    se_epi: File | None = None,
+    pe_dir: str = "AP",
+    rpe_mode: str = "rpe_none",
+    readout_time: float | None = None,
+    eddy_options: str = "",
+    intermediate_format: str = "mif",
+) -> tuple[File, File]:
+    subject = _read(dwi_degibbs)
+    assert _read(eddy_mask) == f"{subject}:early"
+    return (
+        _write("corrected.txt", f"{subject}:{pe_dir}:{readout_time}"),
+        _write("preproc_meanb0.txt", f"{subject}:corrected"),
+    )
+
+
+@python.define(
+    outputs=[
+        "dwi_preprocessed",
+        "dwimask_preprocessed",
+        "response_wm",
+        "response_gm",
+        "response_csf",
+        "execution_log",
+    ]
+)
+def FinaliseStage(
+    dwi_corrected: File,
+    brain_mask: File,
+    grad_warning: str,
+    pe_dir: str = "AP",
+    rpe_mode: str = "rpe_none",
+    readout_time: float | None = None,
+    eddy_options: str = "",
+    fod_algorithm: str = "msmt_csd",
+    start_time: str = "",
+    cache_root: str = "",
+    intermediate_format: str = "mif",
+) -> tuple[File, File, File, File, File, str]:
+    corrected = _read(dwi_corrected)
+    mask = _read(brain_mask)
+    return (
+        _write("dwi.txt", corrected),
+        _write("mask.txt", mask),
+        _write("wm.txt", f"{grad_warning}:{fod_algorithm}"),
+        _write("gm.txt", cache_root),
+        _write("csf.txt", rpe_mode),
+        f"{corrected}|{mask}",
+    )
+
+
+def test_cohort_outputs_aligned_with_subjects(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(dwi_preprocessing, "DwiPrepareStage", PrepareStage)
+    monkeypatch.setattr(dwi_preprocessing, "DwiCorrectStage", CorrectStage)
+    monkeypatch.setattr(dwi_preprocessing, "DwiFinaliseStage", FinaliseStage)
+    # The stand-in SynthStrip script is found first on the PATH
+    script = tmp_path / "bin" / "mri_synthstrip"
+    script.parent.mkdir()
+    script.write_text(FAKE_SYNTHSTRIP)
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{script.parent}{os.pathsep}{os.environ['PATH']}")
+
+    # Subjects out of alphabetical order, with differing per-subject options
+    names = ["sub-c", "sub-a", "sub-d", "sub-b"]
+    subjects = []
+    for i, name in enumerate(names):
+        dwi = tmp_path / f"{name}.mif"
+        dwi.write_text(name)
+        subjects.append(
+            {
+                "dwi_raw_mif": dwi,
+                "pe_dir": "AP" if i % 2 else "PA",
+                "readout_time": 0.01 * (i + 1),
+                "fod_algorithm": "csd" if i == 2 else "msmt_csd",
+                "cache_root": f"cache-{name}",
+            }
+        )
+
+    outputs = DwiCohortPreprocessing(subjects=subjects)(cache_root=tmp_path / "cache")
+
+    for i, (name, subject) in enumerate(zip(names, subjects)):
+        corrected = f"{name}:{subject['pe_dir']}:{subject['readout_time']}"
+        assert _read(outputs.dwi_preprocessed[i]) == corrected
+        assert _read(outputs.dwimask_preprocessed[i]) == f"{name}:corrected"
+        assert _read(outputs.response_wm[i]) == (
+            f"{name}:rpe_none:{subject['fod_algorithm']}"
+        )
+        assert _read(outputs.response_gm[i]) == subject["cache_root"]
+        assert outputs.execution_log[i] == f"{corrected}|{name}:corrected"
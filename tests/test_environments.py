@@ -0,0 +1,66 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+import pytest
+from pydra.compose import shell
+from australianimagingservice.mri.human.neuro import environments
+from australianimagingservice.mri.human.neuro.environments import (
+    ContainerRuntime,
+    PersistentContainer,
+)
+
+Cat = shell.define("cat <in_file:generic/file>")
+
+
+def _wait_for(condition, timeout: float = 30.0) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_local_runtime(tmp_path: Path) -> None:
+    env = PersistentContainer(image="ais/test", tag="latest", runtime="local")
+    handles = []
+    for name in ("a.txt", "b.txt"):
+        in_dir = tmp_path / name.split(".")[0]
+        in_dir.mkdir()
+        (in_dir / name).write_text(f"contents of {name}\n")
+        outputs = Cat(in_file=in_dir / name)(
+            cache_root=tmp_path / "cache", environment=env
+        )
+        assert outputs.stdout == f"contents of {name}\n"
+        handles.append(
+            {c.handle for c in environments._CONTAINERS.values() if not c.retired}
+        )
+    # The second input needed a new mount, so the container was restarted with both
+    assert handles[0] != handles[1]
+    assert not any(Path(h).exists() for h in handles[0])
+    environments._stop_all()
+    assert not any(Path(h).exists() for h in handles[1])
+
+
+def test_container_removed_on_os_exit(tmp_path: Path) -> None:
+    # Pool workers exit via os._exit, which skips atexit handlers
+    script = f"""
+import os
+from australianimagingservice.mri.human.neuro.environments import PersistentContainer
+env = PersistentContainer(image="ais/test", tag="latest", runtime="local")
+container = env._acquire({{{str(tmp_path)!r}: "ro"}})
+print(container.handle, flush=True)
+os._exit(0)
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    handle = Path(result.stdout.strip())
+    assert str(handle).startswith("/")
+    assert _wait_for(lambda: not handle.exists())
+
+
+def test_runtime_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        ContainerRuntime()
@@ -0,0 +1,55 @@
+import gzip
+from pathlib import Path
+import numpy as np
+import pytest
+from australianimagingservice.mri.human.neuro import fileops
+from australianimagingservice.mri.human.neuro.fileops import (
+    compress_file,
+    gzip_file,
+    place_tree,
+)
+
+
+@pytest.mark.parametrize("size", [0, 1000, 300_000])
+@pytest.mark.parametrize("threads", [1, 4])
+def test_gzip_file(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, size: int, threads: int
+) -> None:
+    # Small blocks so that the larger files are split across many of them
+    monkeypatch.setattr(fileops, "COMPRESS_BLOCK_SIZE", 64 * 1024)
+    rng = np.random.default_rng(0)
+    # Compressible data with repeats that span the block boundaries
+    data = rng.integers(0, 16, size=size, dtype=np.uint8).tobytes()
+    data = (data[: size // 3] * 3 + data)[:size]
+    src = tmp_path / "image.mif"
+    src.write_bytes(data)
+
+    dest = gzip_file(src, tmp_path / "image.mif.gz", threads=threads)
+    assert dest == tmp_path / "image.mif.gz"
+    assert gzip.decompress(dest.read_bytes()) == data
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".")] == []
+
+
+def test_compress_file_default_dest(tmp_path: Path) -> None:
+    src = tmp_path / "tracks.tck"
+    src.write_bytes(b"tracks" * 1000)
+    dest = compress_file(src)
+    assert dest == tmp_path / "tracks.tck.gz"
+    assert gzip.decompress(dest.read_bytes()) == src.read_bytes()
+    with pytest.raises(ValueError, match="Unrecognised codec"):
+        compress_file(src, codec="bz2")
+
+
+def test_place_tree(tmp_path: Path) -> None:
+    src = tmp_path / "src"
+    (src / "mri").mkdir(parents=True)
+    (src / "mri" / "norm.mgz").write_bytes(b"norm")
+    (src / "surf").symlink_to("mri")
+    dest = tmp_path / "dest"
+    (dest / "stale").mkdir(parents=True)
+    (dest / "stale" / "old.txt").write_text("old")
+
+    place_tree(src, dest)
+    assert (dest / "mri" / "norm.mgz").read_bytes() == b"norm"
+    assert (dest / "surf").is_symlink()
+    assert not (dest / "stale").exists()
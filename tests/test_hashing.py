@@ -0,0 +1,96 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pytest
+from australianimagingservice.mri.human.neuro import hashing
+from australianimagingservice.mri.human.neuro.hashing import (
+    HASH_CACHE_ENV,
+    directory_fingerprint,
+    file_digest,
+    hash_cache,
+)
+
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    root = tmp_path / "FS_outputs"
+    (root / "mri").mkdir(parents=True)
+    (root / "surf").mkdir()
+    (root / "mri" / "norm.mgz").write_bytes(b"norm" * 1000)
+    (root / "surf" / "lh.white").write_bytes(b"white")
+    (root / "surf" / "lh.pial").symlink_to("lh.white")
+    return root
+
+
+def _snapshot(path: Path) -> dict[str, str]:
+    return {
+        str(p.relative_to(path)): os.readlink(p) if p.is_symlink() else p.read_text()
+        for p in path.rglob("*")
+        if p.is_symlink() or p.is_file()
+    }
+
+
+@pytest.fixture(params=[False, True], ids=["in-memory", "hash-cache"])
+def manifests(request, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(hashing, "_MANIFESTS", {})
+    if request.param:
+        monkeypatch.setenv(HASH_CACHE_ENV, str(tmp_path / "hashes.sqlite"))
+    else:
+        monkeypatch.delenv(HASH_CACHE_ENV, raising=False)
+
+
+def test_directory_fingerprint(
+    tree: Path, manifests: None, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    before = _snapshot(tree)
+    fingerprint = directory_fingerprint(tree)
+    # Nothing is written into the hashed directory
+    assert _snapshot(tree) == before
+
+    # Unchanged files aren't read again
+    read = []
+    monkeypatch.setattr(
+        hashing, "file_digest", lambda p: read.append(p) or file_digest(p)
+    )
+    assert directory_fingerprint(tree) == fingerprint
+    assert read == []
+
+    (tree / "surf" / "lh.white").write_bytes(b"WHITE")
+    changed = directory_fingerprint(tree)
+    assert changed != fingerprint
+    assert read == [tree / "surf" / "lh.white"]
+
+    (tree / "surf" / "lh.pial").unlink()
+    (tree / "surf" / "lh.pial").symlink_to("../mri/norm.mgz")
+    assert directory_fingerprint(tree) != changed
+
+
+def test_fingerprint_is_location_independent(tree: Path, manifests: None) -> None:
+    fingerprint = directory_fingerprint(tree)
+    moved = tree.rename(tree.with_name("moved"))
+    assert directory_fingerprint(moved) == fingerprint
+
+
+def test_concurrent_fingerprints(tree: Path, manifests: None) -> None:
+    for i in range(50):
+        (tree / "mri" / f"file{i}.txt").write_text(str(i))
+    with ThreadPoolExecutor(8) as pool:
+        fingerprints = set(pool.map(directory_fingerprint, [tree] * 16))
+    assert len(fingerprints) == 1
+    assert sorted(os.listdir(tree)) == ["mri", "surf"]
+
+
+def test_file_hash_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv(HASH_CACHE_ENV, str(tmp_path / "hashes.sqlite"))
+    path = tmp_path / "dwi.mif"
+    path.write_bytes(b"dwi" * 1000)
+    digest = file_digest(path)
+    assert hash_cache().digest(path) == digest
+
+    # Digests are read from the database while the file is unchanged
+    monkeypatch.setattr(hashing, "_read_digest", lambda p: "rehashed")
+    assert file_digest(path) == digest
+    os.link(path, tmp_path / "linked.mif")
+    assert file_digest(tmp_path / "linked.mif") == digest
+    path.write_bytes(b"DWI" * 1000)
+    assert file_digest(path) == "rehashed"
@@ -0,0 +1,173 @@
+import json
+import os
+from pathlib import Path
+import nibabel as nib
+import numpy as np
+import pytest
+from australianimagingservice.mri.human.neuro import image_header
+from australianimagingservice.mri.human.neuro.image_header import (
+    HEADER_INDEX_ENV,
+    bzero_volumes,
+    cluster_shells,
+    enable_header_index,
+    header_index,
+    image_summary,
+    pe_directions,
+    read_image_header,
+    scaled_bvalues,
+    shell_bvalues,
+    summarise_header,
+)
+from australianimagingservice.mri.human.neuro.mif import save_mif
+
+AFFINE = np.diag([2.0, 2.0, 2.5, 1.0])
+
+
+def _dw_scheme(nvols_per_shell: int = 12) -> np.ndarray:
+    """Three b=0 volumes interleaved with two jittered shells"""
+    rng = np.random.default_rng(0)
+    bvalues = [0.0] * 3
+    bvalues += list(1000 + rng.uniform(-5, 5, nvols_per_shell))
+    bvalues += list(3000 + rng.uniform(-5, 5, nvols_per_shell))
+    bvalues = np.array(bvalues)[rng.permutation(len(bvalues))]
+    vectors = rng.normal(size=(len(bvalues), 3))
+    vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+    vectors[bvalues == 0] = 0
+    return np.column_stack([vectors, bvalues])
+
+
+def _format_rows(rows: np.ndarray) -> str:
+    return "\n".join(",".join(f"{v:.10g}" for v in row) for row in rows)
+
+
+def test_shells() -> None:
+    scheme = _dw_scheme()
+    bvalues = scheme[:, 3]
+    shells = cluster_shells(bvalues)
+    assert len(shells) == 3
+    assert sorted(i for s in shells for i in s) == list(range(len(bvalues)))
+    assert np.allclose(shell_bvalues(scheme), [0, 1000, 3000], atol=5)
+    assert bzero_volumes(scheme) == [int(i) for i in np.flatnonzero(bvalues == 0)]
+
+    # A b-value without enough neighbours isn't assigned to any shell
+    outlier = np.vstack([scheme, [1.0, 0.0, 0.0, 2000.0]])
+    assert len(outlier) - 1 not in [i for s in cluster_shells(outlier[:, 3]) for i in s]
+
+    # Gradient directions that aren't unit vectors scale the b-values
+    halved = scheme.copy()
+    halved[:, :3] /= np.sqrt(2)
+    assert np.allclose(scaled_bvalues(halved), bvalues / 2)
+
+    # More shells than the square root of the number of volumes isn't a HARDI scheme
+    with pytest.raises(ValueError):
+        cluster_shells(np.repeat(np.arange(1, 17) * 200.0, 3))
+
+
+@pytest.mark.parametrize("ext", [".mif", ".mif.gz"])
+def test_read_mif(tmp_path: Path, ext: str) -> None:
+    scheme = _dw_scheme()
+    data = np.zeros((4, 5, 3, len(scheme)), dtype=np.float32)
+    path = save_mif(
+        tmp_path / f"dwi{ext}",
+        data,
+        AFFINE,
+        {
+            "dw_scheme": _format_rows(scheme),
+            "PhaseEncodingDirection": "j-",
+            "TotalReadoutTime": "0.05",
+        },
+    )
+    header = read_image_header(path)
+    assert header.dims == data.shape
+    assert header.vox == (2.0, 2.0, 2.5, 1.0)
+    assert header.nvols == len(scheme)
+    assert np.allclose(header.dw_scheme, scheme)
+    assert header.phase_encoding_direction == "j-"
+    assert header.pe_scheme.shape == (len(scheme), 4)
+    assert pe_directions(header.pe_scheme) == [(0, -1, 0)] * len(scheme)
+    assert np.allclose(header.pe_scheme[:, 3], 0.05)
+
+    # An explicit pe_scheme takes precedence over the direction
+    pe_scheme = np.array([[0, 1, 0, 0.05]] * 2 + [[0, -1, 0, 0.05]] * 2)
+    path = save_mif(
+        tmp_path / f"se_epi{ext}",
+        data[..., :4],
+        AFFINE,
+        {"pe_scheme": _format_rows(pe_scheme), "PhaseEncodingDirection": "j"},
+    )
+    header = read_image_header(path)
+    assert header.dw_scheme is None
+    assert np.allclose(header.pe_scheme, pe_scheme)
+
+
+def test_read_nifti(tmp_path: Path) -> None:
+    scheme = _dw_scheme()
+    data = np.zeros((4, 5, 3, len(scheme)), dtype=np.int16)
+    path = tmp_path / "dwi.nii.gz"
+    nib.save(nib.Nifti1Image(data, AFFINE), str(path))
+    header = read_image_header(path)
+    assert header.dims == data.shape
+    assert header.dw_scheme is None and header.pe_scheme is None
+
+    # FSL gradient files (with the b-vectors as rows) and a BIDS sidecar
+    np.savetxt(tmp_path / "dwi.bval", scheme[:, 3][None])
+    np.savetxt(tmp_path / "dwi.bvec", scheme[:, :3].T)
+    (tmp_path / "dwi.json").write_text(
+        json.dumps({"PhaseEncodingDirection": "i", "TotalReadoutTime": 0.04})
+    )
+    header = read_image_header(path)
+    assert np.allclose(header.dw_scheme, scheme)
+    assert header.phase_encoding_direction == "i"
+    assert np.allclose(header.pe_scheme, [[1, 0, 0, 0.04]] * len(scheme))
+
+    summary = summarise_header(path)
+    assert summary.nvols == len(scheme)
+    assert np.allclose(summary.shell_bvalues, [0, 1000, 3000], atol=5)
+    assert summary.pe_counts == [((1, 0, 0), len(scheme))]
+    assert summary.sidecar_pe_direction == "i"
+
+    # Gradients that don't match the image are ignored, as without -fslgrad
+    np.savetxt(tmp_path / "dwi.bval", scheme[:-1, 3][None])
+    assert read_image_header(path).dw_scheme is None
+
+
+def test_unrecognised_format(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        read_image_header(tmp_path / "dwi.mgz")
+
+
+def test_header_index(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Restored after the test, as enable_header_index sets it
+    monkeypatch.setenv(HEADER_INDEX_ENV, "")
+    scheme = _dw_scheme()
+    path = tmp_path / "dwi.nii.gz"
+    nib.save(nib.Nifti1Image(np.zeros((4, 5, 3, len(scheme))), AFFINE), str(path))
+    np.savetxt(tmp_path / "dwi.bval", scheme[:, 3][None])
+    np.savetxt(tmp_path / "dwi.bvec", scheme[:, :3].T)
+    (tmp_path / "dwi.json").write_text(json.dumps({"PhaseEncodingDirection": "j"}))
+    assert header_index() is None
+    summary = image_summary(path)
+
+    enable_header_index(tmp_path / "index" / "headers.sqlite")
+    assert os.environ[HEADER_INDEX_ENV] == str(tmp_path / "index" / "headers.sqlite")
+    assert image_summary(path) == summary
+
+    # Summaries of unchanged images (and sidecars) are read from the database
+    read = []
+    summarise = image_header.summarise_header
+    monkeypatch.setattr(
+        image_header, "summarise_header", lambda p: read.append(p) or summarise(p)
+    )
+    assert image_summary(path) == summary
+    assert read == []
+
+    (tmp_path / "dwi.json").write_text(json.dumps({"PhaseEncodingDirection": "i"}))
+    changed = image_summary(path)
+    assert read == [path]
+    assert changed.pe_counts == [((1, 0, 0), len(scheme))]
+    assert changed.shell_bvalues == summary.shell_bvalues
+
+    # The database is shared with other processes, e.g. those of later runs
+    monkeypatch.setattr(image_header, "_HEADER_INDEX", None)
+    assert image_summary(path) == changed
+    assert read == [path]
@@ -0,0 +1,76 @@
+from pathlib import Path
+import numpy as np
+import pytest
+from australianimagingservice.mri.human.neuro.mif import (
+    iter_mif_slabs,
+    load_mif,
+    read_mif_header,
+    save_mif,
+    storage_axes,
+)
+
+AFFINE = np.array(
+    [
+        [1.25, 0.0, 0.0, -80.0],
+        [0.0, 1.0, 0.0, -100.0],
+        [0.0, 0.0, 2.0, -60.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+# On-disk axes i, j, k stored as S, L, P (i.e. not RAS)
+PERMUTED_AFFINE = np.array(
+    [
+        [0.0, -1.0, 0.0, 90.0],
+        [0.0, 0.0, -1.5, 120.0],
+        [2.0, 0.0, 0.0, -70.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+
+
+@pytest.mark.parametrize("ext", [".mif", ".mif.gz"])
+@pytest.mark.parametrize(
+    "shape,dtype",
+    [((7, 6, 5), np.uint32), ((7, 6, 5, 4), np.float32), ((4, 3, 2), np.int16)],
+)
+@pytest.mark.parametrize("affine", [AFFINE, PERMUTED_AFFINE])
+def test_mif_round_trip(
+    tmp_path: Path, ext: str, shape: tuple[int, ...], dtype: type, affine: np.ndarray
+) -> None:
+    rng = np.random.default_rng(0)
+    data = (rng.random(shape) * 1000).astype(dtype)
+    path = save_mif(tmp_path / f"image{ext}", data, affine, keyval={"comments": "a\nb"})
+
+    loaded, loaded_affine = load_mif(path)
+    assert loaded.dtype == data.dtype
+    assert np.array_equal(loaded, data)
+    assert np.allclose(loaded_affine, affine)
+
+    header = read_mif_header(path)
+    assert header["comments"] == "a\nb"
+    # The image axes are realigned to be as close as possible to RAS, as MRtrix does
+    transform = np.array(
+        [[float(v) for v in t.split(",")] for t in header["transform"]]
+    )
+    assert np.allclose(transform[:3, :3], np.eye(3))
+    # Voxel (0, 0, 0) on disk is at the scanner position given by the image transform
+    dims = [int(d) for d in header["dim"].split(",")]
+    vox = [float(v) for v in header["vox"].split(",")]
+    layout = header["layout"].split(",")
+    image_index = [
+        dims[axis] - 1 if layout[axis].startswith("-") else 0 for axis in range(3)
+    ]
+    position = transform[:3, 3] + np.multiply(vox[:3], image_index)
+    assert np.allclose(position, affine[:3, 3])
+
+
+@pytest.mark.parametrize("ext", [".mif", ".mif.gz"])
+def test_iter_mif_slabs(tmp_path: Path, ext: str) -> None:
+    data = np.arange(7 * 6 * 5 * 4, dtype=np.float32).reshape((7, 6, 5, 4))
+    path = save_mif(tmp_path / f"dwi{ext}", data, AFFINE)
+    header = read_mif_header(path)
+    assert storage_axes(header) == [0, 1, 2, 3]
+    slabs = dict(iter_mif_slabs(path, only={1, 3}))
+    assert sorted(slabs) == [1, 3]
+    for index, slab in slabs.items():
+        assert np.array_equal(slab, data[..., index])